@@ -0,0 +1,164 @@
+"""Admission control for the public endpoints.
+
+Public playlists are polled by players and set-top boxes nobody controls, on
+the same event loop that serves the authenticated API. Requests to the public
+routes go through two token buckets, one per client IP and one per public
+token: when either is empty the request gets a 429 with a Retry-After saying
+when it would be admitted. Renders that miss the render cache also need one of
+RENDER_MAX_CONCURRENCY slots; up to RENDER_MAX_QUEUE requests wait for one (at
+most RENDER_QUEUE_TIMEOUT_SECONDS), the others get a 503 right away.
+
+Everything is per worker process. Behind a reverse proxy the client IP comes
+from X-Forwarded-For only when uvicorn trusts the proxy (FORWARDED_ALLOW_IPS).
+"""
+from typing import Callable, Optional
+from collections import OrderedDict
+import asyncio
+import math
+import os
+import time
+
+from fastapi import HTTPException, Request
+from fastapi.responses import StreamingResponse
+
+from metrics import ADMISSION_REJECTED, RENDERS_IN_FLIGHT
+
+class RateLimiter:
+    """Token buckets by key: `rate` requests per second, bursts up to `burst`"""
+
+    def __init__(self, rate: float, burst: float, max_keys: int):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_keys = max_keys
+        # chiave -> [gettoni, ultimo aggiornamento]; le chiavi inattive escono per prime
+        self._buckets: "OrderedDict[str, list]" = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def _refill(self, key: str, now: float) -> list:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [self.burst, now]
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        return bucket
+
+    def wait(self, key: str, now: float) -> float:
+        """0 if a request for `key` would be admitted, otherwise seconds until it would be"""
+        bucket = self._refill(key, now)
+        if bucket[0] >= 1:
+            return 0.0
+        return (1 - bucket[0]) / self.rate
+
+    def take(self, key: str):
+        """Consume the token of an admitted request (after `wait` returned 0)"""
+        self._buckets[key][0] -= 1
+
+class RenderSlots:
+    """Caps the renders running at once, shedding load beyond a short queue"""
+
+    def __init__(self, limit: int, queue: int, timeout: float):
+        self.limit = limit
+        self.queue = queue
+        self.timeout = timeout
+        self.running = 0
+        self._waiting = 0
+        self._semaphore = asyncio.Semaphore(max(limit, 1))
+
+    async def acquire(self) -> bool:
+        """Take a slot or raise a 503; True if it had to wait for one"""
+        if self.limit <= 0:
+            return False
+        waited = self._semaphore.locked()
+        if waited:
+            if self._waiting >= self.queue:
+                _overloaded()
+            self._waiting += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), self.timeout)
+            except asyncio.TimeoutError:
+                _overloaded()
+            finally:
+                self._waiting -= 1
+        else:
+            await self._semaphore.acquire()
+        self.running += 1
+        RENDERS_IN_FLIGHT.set(self.running)
+        return waited
+
+    def release(self):
+        if self.limit <= 0:
+            return
+        self.running -= 1
+        RENDERS_IN_FLIGHT.set(self.running)
+        self._semaphore.release()
+
+def _overloaded():
+    ADMISSION_REJECTED.inc(reason="overload")
+    raise HTTPException(status_code=503, detail="Server busy, retry later", headers={"Retry-After": "1"})
+
+class SlotStreamingResponse(StreamingResponse):
+    """Streaming response that gives its render slot back once sent, or on disconnect"""
+
+    def __init__(self, *args, release: Callable[[], None], **kwargs):
+        super().__init__(*args, **kwargs)
+        self._release: Optional[Callable[[], None]] = release
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            release, self._release = self._release, None
+            if release is not None:
+                release()
+
+def client_ip(request: Request) -> str:
+    return request.client.host if request.client else "unknown"
+
+ip_limiter = RateLimiter(
+    rate=float(os.getenv("PUBLIC_RATE_PER_IP", 5)),
+    burst=float(os.getenv("PUBLIC_BURST_PER_IP", 100)),
+    max_keys=int(os.getenv("ADMISSION_MAX_KEYS", 100_000))
+)
+token_limiter = RateLimiter(
+    rate=float(os.getenv("PUBLIC_RATE_PER_TOKEN", 2)),
+    burst=float(os.getenv("PUBLIC_BURST_PER_TOKEN", 60)),
+    max_keys=int(os.getenv("ADMISSION_MAX_KEYS", 100_000))
+)
+render_slots = RenderSlots(
+    limit=int(os.getenv("RENDER_MAX_CONCURRENCY", 8)),
+    queue=int(os.getenv("RENDER_MAX_QUEUE", 32)),
+    timeout=float(os.getenv("RENDER_QUEUE_TIMEOUT_SECONDS", 2))
+)
+
+def _admit(*checks):
+    now = time.monotonic()
+    checks = [check for check in checks if check[0].enabled]
+    # Si consuma solo se tutti i bucket ammettono: un 429 per token non costa gettoni all'IP
+    for limiter, key, reason in checks:
+        wait = limiter.wait(key, now)
+        if wait:
+            ADMISSION_REJECTED.inc(reason=reason)
+            raise HTTPException(
+                status_code=429,
+                detail="Too many requests",
+                headers={"Retry-After": str(math.ceil(wait))}
+            )
+    for limiter, key, _ in checks:
+        limiter.take(key)
+
+async def admit_public(request: Request, token: str):
+    """Dependency of the public playlist routes: rate limits per client IP, then per token"""
+    # Prima l'IP: token inventati non riempiono la tabella dei token
+    _admit((ip_limiter, client_ip(request), "ip_rate"), (token_limiter, token, "token_rate"))
+
+async def admit_play(request: Request):
+    """Dependency of the stream redirects: per client IP only, since every viewer
+    of a shared playlist zaps through the same token"""
+    _admit((ip_limiter, client_ip(request), "ip_rate"))
@@ -1,29 +1,67 @@
 from datetime import datetime, timedelta
+import os
 from typing import Optional
 from jose import JWTError, jwt
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from database import verify_password, get_db
 from models import TokenData, User
+from repository import repo
+from cache import cache
+from passwords import verify_password
+from metrics import LOGINS
 
 # Configurazione sicurezza
 SECRET_KEY = "your-secret-key-here"  # In produzione, usa una chiave sicura e segreta
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 1440  # 24 ore
+# Per quanto un utente risolto da un token resta in cache
+AUTH_CACHE_TTL_SECONDS = float(os.getenv("AUTH_CACHE_TTL_SECONDS", 300))
+# Utenti con accesso agli endpoint di amministrazione (separati da virgola)
+ADMIN_USERNAMES = {name.strip() for name in os.getenv("ADMIN_USERNAMES", "admin").split(",") if name.strip()}
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+# EventSource non può inviare header: per gli stream il token può arrivare in query
+oauth2_scheme_optional = OAuth2PasswordBearer(tokenUrl="token", auto_error=False)
 
-def authenticate_user(username: str, password: str) -> Optional[User]:
+async def authenticate_user(username: str, password: str) -> Optional[User]:
     """Autentica un utente e restituisce l'oggetto User se le credenziali sono corrette"""
-    if verify_password(username, password):
-        with get_db() as db:
-            user_data = db.execute(
-                "SELECT * FROM users WHERE username = ?",
-                (username,)
-            ).fetchone()
-            if user_data:
-                return User(**user_data)
-    return None
+    user_data = await repo.get_user(username)
+    if not user_data:
+        LOGINS.inc(result="unknown_user")
+        return None
+    # bcrypt gira nel pool dedicato: il loop continua a servire le altre richieste
+    valid, new_hash = await verify_password(password, user_data['password_hash'])
+    if not valid:
+        LOGINS.inc(result="wrong_password")
+        return None
+    if new_hash:
+        # Hash con un costo diverso da BCRYPT_ROUNDS: sostituito ora che la password è nota
+        await repo.set_password_hash(user_data['id'], new_hash)
+        await invalidate_cached_users()
+        LOGINS.inc(result="rehashed")
+    else:
+        LOGINS.inc(result="ok")
+    return User(**user_data)
+
+async def _lookup_user(username: str) -> Optional[User]:
+    """Risolve l'utente di un token passando dalla cache condivisa tra i worker"""
+    key = await cache.key("users", f"auth:{username}")
+    if key:
+        data = await cache.get(key, "users")
+        if data is not None:
+            return User.model_validate_json(data)
+
+    user_data = await repo.get_user(username)
+    if user_data is None:
+        return None
+    user = User(**user_data)
+    if key:
+        await cache.set(key, user.model_dump_json().encode(), "users", ttl=AUTH_CACHE_TTL_SECONDS)
+    return user
+
+async def invalidate_cached_users():
+    """Da chiamare quando cambiano i dati degli utenti (tutti i worker rileggono dal database)"""
+    await cache.bump("users")
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     """Crea un token JWT"""
@@ -36,13 +74,15 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(token: str = Depends(oauth2_scheme)) -> User:
-    """Ottiene l'utente corrente dal token JWT"""
+async def _user_from_token(token: Optional[str]) -> User:
+    """Valida un token JWT e restituisce l'utente corrispondente"""
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    if not token:
+        raise credentials_exception
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
@@ -52,18 +92,33 @@ async def get_current_user(token: str = Depends(oauth2_scheme)) -> User:
     except JWTError:
         raise credentials_exception
 
-    with get_db() as db:
-        user_data = db.execute(
-            "SELECT * FROM users WHERE username = ?",
-            (token_data.username,)
-        ).fetchone()
-        
-        if user_data is None:
-            raise credentials_exception
-            
-        return User(**user_data)
+    user = await _lookup_user(token_data.username)
+    if user is None:
+        raise credentials_exception
+
+    return user
+
+async def get_current_user(token: str = Depends(oauth2_scheme)) -> User:
+    """Ottiene l'utente corrente dal token JWT"""
+    return await _user_from_token(token)
 
 # Dependency per le route protette
 async def get_current_user_id(current_user: User = Depends(get_current_user)) -> int:
     """Restituisce l'ID dell'utente corrente"""
     return current_user.id
+
+async def get_stream_user_id(
+    token: Optional[str] = Depends(oauth2_scheme_optional),
+    access_token: Optional[str] = None
+) -> int:
+    """Come get_current_user_id, ma accetta anche ?access_token= (per EventSource)"""
+    return (await _user_from_token(token or access_token)).id
+
+async def require_admin(current_user: User = Depends(get_current_user)) -> User:
+    """Consente l'accesso solo agli utenti amministratori"""
+    if current_user.username not in ADMIN_USERNAMES:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin privileges required"
+        )
+    return current_user
@@ -0,0 +1,72 @@
+"""Memory footprint of parse_m3u / generate_m3u.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_memory --channels 500000
+
+Pass --compare with the path of another m3u_utils.py (e.g. an older revision
+extracted with `git show <rev>:backend/m3u_utils.py > /tmp/old_m3u_utils.py`)
+to print the same figures for it side by side.
+"""
+from typing import Dict
+import argparse
+import gc
+import importlib.util
+import json
+import time
+import tracemalloc
+
+import m3u_utils
+from benchmarks.m3u_gen import generate_m3u_text
+
+def load_module(path: str):
+    spec = importlib.util.spec_from_file_location("m3u_utils_compare", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def measure(module, content: str) -> Dict:
+    """Parse and render `content` with `module`, tracking retained and peak allocations"""
+    gc.collect()
+    tracemalloc.start()
+    base, _ = tracemalloc.get_traced_memory()
+
+    started = time.perf_counter()
+    channels = module.parse_m3u(content)
+    parse_seconds = time.perf_counter() - started
+    retained, parse_peak = tracemalloc.get_traced_memory()
+
+    tracemalloc.reset_peak()
+    started = time.perf_counter()
+    rendered = module.generate_m3u(channels, "http://epg.example.com/guide.xml")
+    render_seconds = time.perf_counter() - started
+    _, render_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    count = len(channels)
+    del rendered, channels
+    return {
+        "channels": count,
+        "retained_bytes_per_channel": round((retained - base) / count, 1),
+        "parse_peak_bytes_per_channel": round((parse_peak - base) / count, 1),
+        "render_peak_bytes_per_channel": round((render_peak - retained) / count, 1),
+        "parse_seconds": round(parse_seconds, 3),
+        "render_seconds": round(render_seconds, 3),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--channels", type=int, default=500_000)
+    parser.add_argument("--density", type=float, default=0.5, help="attribute density 0..1")
+    parser.add_argument("--compare", help="path of another m3u_utils.py to measure as baseline")
+    args = parser.parse_args()
+
+    content = generate_m3u_text(args.channels, args.density)
+    results = {"input_bytes": len(content.encode())}
+    if args.compare:
+        results["baseline"] = measure(load_module(args.compare), content)
+    results["current"] = measure(m3u_utils, content)
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""Single vs multi-core throughput of M3U parsing.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_parallel --channels 1000000 --workers 1,2,4,8
+"""
+import argparse
+import json
+import os
+import time
+
+import m3u_utils
+from benchmarks.m3u_gen import generate_m3u_text
+
+def timed(func, *args, repeat: int = 1):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--channels", type=int, default=1_000_000)
+    parser.add_argument("--density", type=float, default=0.5)
+    parser.add_argument("--workers", default=",".join(str(n) for n in (2, 4, os.cpu_count() or 1)))
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    content = generate_m3u_text(args.channels, args.density)
+    megabytes = len(content.encode()) / 1_000_000
+
+    reference, elapsed = timed(m3u_utils.parse_m3u, content, repeat=args.repeat)
+    runs = [{"mode": "single", "workers": 1, "seconds": round(elapsed, 3)}]
+
+    for workers in sorted({int(w) for w in args.workers.split(",") if int(w) > 1}):
+        m3u_utils.PARALLEL_PARSE_WORKERS = workers
+        m3u_utils._parse_pool = None
+        # Avvia il pool prima di misurare: il costo di startup è una tantum
+        m3u_utils._get_parse_pool().submit(len, "").result()
+        channels, elapsed = timed(m3u_utils.parse_m3u_parallel, content, workers, repeat=args.repeat)
+        assert len(channels) == len(reference) and channels[-1].position == reference[-1].position
+        runs.append({"mode": "parallel", "workers": workers, "seconds": round(elapsed, 3)})
+        m3u_utils._parse_pool.shutdown()
+
+    single = runs[0]["seconds"]
+    for run in runs:
+        run["channels_per_second"] = round(len(reference) / run["seconds"])
+        run["mb_per_second"] = round(megabytes / run["seconds"], 1)
+        run["speedup"] = round(single / run["seconds"], 2)
+
+    print(json.dumps({
+        "channels": len(reference),
+        "input_mb": round(megabytes, 1),
+        "cpu_count": os.cpu_count(),
+        "runs": runs
+    }, indent=2))
+
+if __name__ == "__main__":
+    main()
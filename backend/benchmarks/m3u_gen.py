@@ -0,0 +1,42 @@
+"""Synthetic M3U playlists for benchmarks"""
+from typing import Iterator
+import random
+
+GROUPS = [
+    "News", "Sports", "Movies", "Kids", "Music", "Documentary",
+    "Entertainment", "Religious", "Shopping", "Weather", "Regional", "Adult"
+]
+
+USER_AGENTS = [
+    "Mozilla/5.0 (SMART-TV; Linux; Tizen 6.0)",
+    "VLC/3.0.18 LibVLC/3.0.18",
+    "okhttp/4.9.3",
+]
+
+def iter_m3u_lines(channels: int, attribute_density: float = 0.5, seed: int = 42,
+                   epg_url: str = "http://epg.example.com/guide.xml") -> Iterator[str]:
+    """Yield the lines of a synthetic playlist.
+
+    `attribute_density` (0..1) controls how many optional attributes and extra
+    tags (tvg-logo, EXTVLCOPT, EXTGRP, extra EXTINF attributes) each entry carries.
+    """
+    rng = random.Random(seed)
+    yield f'#EXTM3U x-tvg-url="{epg_url}"'
+    for i in range(channels):
+        group = GROUPS[i % len(GROUPS)]
+        attributes = [f'tvg-id="ch{i}.example"', f'group-title="{group}"']
+        if rng.random() < attribute_density:
+            attributes.append(f'tvg-logo="http://logos.example.com/{i % 5000}.png"')
+        if rng.random() < attribute_density:
+            attributes.append(f'tvg-name="Channel {i}"')
+            attributes.append(f'tvg-chno="{i + 1}"')
+        if rng.random() < attribute_density / 2:
+            yield f'#EXTVLCOPT:http-user-agent={USER_AGENTS[i % len(USER_AGENTS)]}'
+        yield f'#EXTINF:-1 {" ".join(attributes)},Channel {i} {group}'
+        if rng.random() < attribute_density / 4:
+            yield f'#EXTGRP:{group}'
+        yield f'http://stream{i % 50}.example.com/live/{i}.m3u8'
+
+def generate_m3u_text(channels: int, attribute_density: float = 0.5, seed: int = 42) -> str:
+    """Return a synthetic playlist as a single string"""
+    return '\n'.join(iter_m3u_lines(channels, attribute_density, seed)) + '\n'
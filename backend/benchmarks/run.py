@@ -0,0 +1,350 @@
+"""Reproducible benchmark suite for the parser, renderer, sync, public endpoint and login.
+
+Run from the backend directory:
+
+    python -m benchmarks.run --scenarios parse,render --sizes 10000,100000,1000000
+    python -m benchmarks.run --scenarios sync,public --sizes 100000 --output after.json
+    python -m benchmarks.run --sizes 100000 --compare before.json
+    python -m benchmarks.run --scenarios login --concurrency 32 --requests 100
+
+Every run writes a JSON document with the environment (git revision, Python,
+CPU count) and one entry per scenario/parameter combination, so results from
+different revisions can be compared with --compare.
+"""
+from typing import Callable, Dict, List, Optional
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import aiohttp
+
+import m3u_utils
+from exporters import EXPORTERS
+from benchmarks.m3u_gen import generate_m3u_text
+from benchmarks.upstream import UpstreamServer, free_port
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+def best_of(repeat: int, func: Callable, *args):
+    """Run func `repeat` times, returning the last result and the fastest time"""
+    timings = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func(*args)
+        timings.append(time.perf_counter() - started)
+    return result, min(timings)
+
+def percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+# Scenari in-process
+
+def scenario_parse(size: int, density: float, repeat: int, **_) -> Dict:
+    content = generate_m3u_text(size, density)
+    megabytes = len(content.encode()) / 1_000_000
+    channels, sequential = best_of(repeat, m3u_utils.parse_m3u, content)
+    _, auto = best_of(repeat, m3u_utils.parse_m3u_auto, content)
+    return {
+        "input_mb": round(megabytes, 2),
+        "channels": len(channels),
+        "parse_seconds": round(sequential, 4),
+        "parse_auto_seconds": round(auto, 4),
+        "channels_per_second": round(len(channels) / sequential),
+        "mb_per_second": round(megabytes / sequential, 2),
+    }
+
+def scenario_render(size: int, density: float, repeat: int, **_) -> Dict:
+    channels = m3u_utils.parse_m3u(generate_m3u_text(size, density))
+    playlist = {"id": 0, "name": "bench", "epg_url": "http://epg.example.com/guide.xml"}
+    _, generate = best_of(repeat, m3u_utils.generate_m3u, channels, playlist["epg_url"])
+    metrics = {
+        "channels": len(channels),
+        "generate_m3u_seconds": round(generate, 4),
+    }
+    for name, exporter in EXPORTERS.items():
+        def render():
+            parts = [exporter.header(playlist)]
+            for start in range(0, len(channels), 1000):
+                parts.append(exporter.rows(channels[start:start + 1000]))
+            parts.append(exporter.footer(playlist))
+            return parts
+        _, elapsed = best_of(repeat, render)
+        metrics[f"export_{name}_seconds"] = round(elapsed, 4)
+    return metrics
+
+# Scenari end-to-end contro un'istanza reale dell'API
+
+class ApiServer:
+    """Run the API with uvicorn in a subprocess against a throwaway database"""
+
+    def __init__(self, workdir: Path):
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.workdir = workdir
+        self.process: Optional[subprocess.Popen] = None
+
+    async def __aenter__(self) -> "ApiServer":
+        env = dict(
+            os.environ, DATABASE_PATH=str(self.workdir / "bench.db"), LOG_LEVEL="WARNING",
+            # Tutti i client arrivano da 127.0.0.1: i limiti per IP e per token falserebbero le misure
+            PUBLIC_RATE_PER_IP="0", PUBLIC_RATE_PER_TOKEN="0"
+        )
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app",
+             "--host", "127.0.0.1", "--port", str(self.port), "--log-level", "warning"],
+            cwd=BACKEND_DIR, env=env
+        )
+        async with aiohttp.ClientSession() as session:
+            for _ in range(200):
+                try:
+                    async with session.get(self.url + "/") as response:
+                        if response.status == 200:
+                            return self
+                except aiohttp.ClientError:
+                    pass
+                await asyncio.sleep(0.05)
+        raise RuntimeError("API server did not start")
+
+    async def __aexit__(self, *exc):
+        self.process.terminate()
+        self.process.wait(timeout=30)
+
+async def _login(session: aiohttp.ClientSession, api: ApiServer) -> Dict[str, str]:
+    async with session.post(api.url + "/token", data={"username": "admin", "password": "admin"}) as response:
+        token = (await response.json())["access_token"]
+    return {"Authorization": f"Bearer {token}"}
+
+async def _timed_sync(session, api, headers, playlist_id) -> Dict:
+    started = time.perf_counter()
+    async with session.post(f"{api.url}/playlists/{playlist_id}/sync", headers=headers) as response:
+        result = await response.json()
+        if response.status != 200:
+            raise RuntimeError(f"sync failed: {result}")
+    return {"seconds": round(time.perf_counter() - started, 4), "changes": result.get("changes")}
+
+async def _create_synced_playlist(session, api, headers, upstream, size, density) -> int:
+    url = upstream.publish("bench", size, density)
+    async with session.post(api.url + "/playlists", json={"name": "bench", "url": url}, headers=headers) as response:
+        playlist_id = (await response.json())["id"]
+    await _timed_sync(session, api, headers, playlist_id)
+    return playlist_id
+
+async def scenario_sync(size: int, density: float, workdir: Path, **_) -> Dict:
+    timeout = aiohttp.ClientTimeout(total=None)
+    async with UpstreamServer() as upstream, ApiServer(workdir) as api, \
+            aiohttp.ClientSession(timeout=timeout) as session:
+        headers = await _login(session, api)
+        url = upstream.publish("bench", size, density)
+        async with session.post(api.url + "/playlists", json={"name": "bench", "url": url}, headers=headers) as response:
+            playlist_id = (await response.json())["id"]
+
+        initial = await _timed_sync(session, api, headers, playlist_id)
+        unchanged = await _timed_sync(session, api, headers, playlist_id)
+        # Stessi URL ma attributi diversi: la maggior parte dei canali va aggiornata
+        upstream.publish("bench", size, density, seed=7)
+        modified = await _timed_sync(session, api, headers, playlist_id)
+
+    return {
+        "initial_sync_seconds": initial["seconds"],
+        "unchanged_sync_seconds": unchanged["seconds"],
+        "modified_sync_seconds": modified["seconds"],
+        "modified_changes": modified["changes"],
+    }
+
+async def scenario_public(size: int, density: float, workdir: Path,
+                          concurrency: int, requests: int, **_) -> Dict:
+    timeout = aiohttp.ClientTimeout(total=None)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with UpstreamServer() as upstream, ApiServer(workdir) as api, \
+            aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        headers = await _login(session, api)
+        playlist_id = await _create_synced_playlist(session, api, headers, upstream, size, density)
+        async with session.post(f"{api.url}/playlists/{playlist_id}/generate-token", headers=headers) as response:
+            public_url = api.url + (await response.json())["public_url"]
+
+        async def fetch() -> int:
+            async with session.get(public_url) as response:
+                body = await response.read()
+                if response.status != 200:
+                    raise RuntimeError(f"public playlist returned HTTP {response.status}")
+                return len(body)
+
+        started = time.perf_counter()
+        body_bytes = await fetch()
+        cold = time.perf_counter() - started
+
+        latencies: List[float] = []
+        remaining = requests
+
+        async def client():
+            nonlocal remaining
+            while remaining > 0:
+                remaining -= 1
+                request_started = time.perf_counter()
+                await fetch()
+                latencies.append(time.perf_counter() - request_started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    return {
+        "body_bytes": body_bytes,
+        "cold_request_seconds": round(cold, 4),
+        "requests": len(latencies),
+        "requests_per_second": round(len(latencies) / elapsed, 1),
+        "latency_p50_seconds": round(statistics.median(latencies), 4),
+        "latency_p95_seconds": round(percentile(latencies, 95), 4),
+        "latency_p99_seconds": round(percentile(latencies, 99), 4),
+    }
+
+async def scenario_login(workdir: Path, concurrency: int, requests: int, **_) -> Dict:
+    """Login burst, with a health check polled meanwhile to show how long the event loop stalls"""
+    timeout = aiohttp.ClientTimeout(total=None)
+    connector = aiohttp.TCPConnector(limit=concurrency + 1)
+    async with ApiServer(workdir) as api, \
+            aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        await _login(session, api)
+
+        latencies: List[float] = []
+        probes: List[float] = []
+        remaining = requests
+
+        async def client():
+            nonlocal remaining
+            while remaining > 0:
+                remaining -= 1
+                request_started = time.perf_counter()
+                await _login(session, api)
+                latencies.append(time.perf_counter() - request_started)
+
+        async def probe():
+            while remaining > 0:
+                probe_started = time.perf_counter()
+                async with session.get(api.url + "/") as response:
+                    await response.read()
+                probes.append(time.perf_counter() - probe_started)
+                await asyncio.sleep(0.01)
+
+        started = time.perf_counter()
+        await asyncio.gather(probe(), *(client() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    return {
+        "requests": len(latencies),
+        "logins_per_second": round(len(latencies) / elapsed, 1),
+        "latency_p50_seconds": round(statistics.median(latencies), 4),
+        "latency_p95_seconds": round(percentile(latencies, 95), 4),
+        "latency_p99_seconds": round(percentile(latencies, 99), 4),
+        "health_p50_seconds": round(statistics.median(probes), 4),
+        "health_max_seconds": round(max(probes), 4),
+    }
+
+SCENARIOS = {
+    "parse": scenario_parse,
+    "render": scenario_render,
+    "sync": scenario_sync,
+    "public": scenario_public,
+    "login": scenario_login,
+}
+# Scenari che non dipendono dalla dimensione delle playlist
+SIZELESS = {"login"}
+
+def environment() -> Dict:
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "git_revision": revision,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+def result_key(entry: Dict) -> str:
+    return entry["scenario"] + " " + json.dumps(entry["params"], sort_keys=True)
+
+def compare(previous: Dict, current: Dict):
+    """Print the ratio current/previous for every timing shared by both runs"""
+    before = {result_key(entry): entry["metrics"] for entry in previous["results"]}
+    print(f"{'scenario':50} {'metric':32} {'before':>10} {'after':>10} {'ratio':>7}")
+    for entry in current["results"]:
+        old = before.get(result_key(entry))
+        if not old:
+            continue
+        for metric, value in entry["metrics"].items():
+            if not metric.endswith("_seconds") or not isinstance(old.get(metric), (int, float)):
+                continue
+            ratio = value / old[metric] if old[metric] else float("nan")
+            print(f"{result_key(entry)[:50]:50} {metric:32} {old[metric]:>10} {value:>10} {ratio:>7.2f}")
+
+async def run(args) -> Dict:
+    results = []
+    with tempfile.TemporaryDirectory(prefix="omg-bench-") as tmp:
+        for scenario in args.scenarios.split(","):
+            func = SCENARIOS[scenario]
+            if scenario in SIZELESS:
+                combinations = [{}]
+            else:
+                combinations = [
+                    {"size": int(size), "density": float(density)}
+                    for size in args.sizes.split(",") for density in args.densities.split(",")
+                ]
+            for params in combinations:
+                if scenario in ("public", "login"):
+                    params.update(concurrency=args.concurrency, requests=args.requests)
+                workdir = Path(tempfile.mkdtemp(dir=tmp))
+                kwargs = dict(params, repeat=args.repeat, workdir=workdir)
+                print(f"running {scenario} {params}", file=sys.stderr)
+                if asyncio.iscoroutinefunction(func):
+                    metrics = await func(**kwargs)
+                else:
+                    metrics = func(**kwargs)
+                results.append({"scenario": scenario, "params": params, "metrics": metrics})
+    return {"environment": environment(), "results": results}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", default="parse,render,sync,public")
+    parser.add_argument("--sizes", default="10000,100000", help="comma separated channel counts")
+    parser.add_argument("--densities", default="0.5", help="comma separated attribute densities (0..1)")
+    parser.add_argument("--repeat", type=int, default=3, help="repetitions of in-process scenarios (best is kept)")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent clients for the public and login scenarios")
+    parser.add_argument("--requests", type=int, default=200, help="total requests for the public and login scenarios")
+    parser.add_argument("--output", help="write the JSON results to this file")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare against")
+    args = parser.parse_args()
+
+    unknown = set(args.scenarios.split(",")) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    document = asyncio.run(run(args))
+    text = json.dumps(document, indent=2)
+    if args.output:
+        Path(args.output).write_text(text)
+    else:
+        print(text)
+
+    if args.compare:
+        compare(json.loads(Path(args.compare).read_text()), document)
+
+if __name__ == "__main__":
+    main()
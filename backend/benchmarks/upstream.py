@@ -0,0 +1,56 @@
+"""Local aiohttp stand-in for an upstream playlist provider"""
+from typing import Dict
+import socket
+
+from aiohttp import web
+
+from benchmarks.m3u_gen import generate_m3u_text
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+class UpstreamServer:
+    """Serve synthetic playlists at /{name}.m3u; contents can be swapped between requests.
+
+    Usage:
+        async with UpstreamServer() as upstream:
+            url = upstream.publish("big", channels=100_000)
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.host = host
+        self.port = port or free_port()
+        self.playlists: Dict[str, bytes] = {}
+        self.requests = 0
+        self._runner = None
+
+    def publish(self, name: str, channels: int, density: float = 0.5, seed: int = 42) -> str:
+        self.playlists[name] = generate_m3u_text(channels, density, seed).encode()
+        return self.url(name)
+
+    def publish_text(self, name: str, content: str) -> str:
+        self.playlists[name] = content.encode()
+        return self.url(name)
+
+    def url(self, name: str) -> str:
+        return f"http://{self.host}:{self.port}/{name}.m3u"
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        body = self.playlists.get(request.match_info["name"])
+        if body is None:
+            raise web.HTTPNotFound()
+        return web.Response(body=body, content_type="audio/x-mpegurl", charset="utf-8")
+
+    async def __aenter__(self) -> "UpstreamServer":
+        app = web.Application()
+        app.router.add_get("/{name}.m3u", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._runner.cleanup()
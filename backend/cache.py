@@ -0,0 +1,462 @@
+"""Two-tier cache shared by the API workers.
+
+Every worker keeps a size-bounded LRU in memory (L1). With CACHE_URL set, the
+entries are also stored in a Redis-compatible server (L2) reachable over TCP
+(redis://host:port/db) or a local socket (unix:///path/to/redis.sock?db=0), so
+N uvicorn workers render each playlist once between them.
+
+Invalidation is version based: keys embed the version of their scope (e.g. one
+user's playlists). Bumping a scope increments its counter in the shared store
+and broadcasts the new version over pub/sub; every worker drops its L1 entries
+of that scope and builds new keys from then on, so stale entries are simply
+never read again and expire with their TTL.
+"""
+from typing import AsyncIterator, Dict, Hashable, List, Optional, Set, Tuple
+from collections import OrderedDict
+from abc import ABC, abstractmethod
+from urllib.parse import urlparse, parse_qs, unquote
+import asyncio
+import logging
+import os
+import time
+
+from metrics import CACHE_LOOKUPS, CACHE_LOCAL_BYTES, CACHE_SHARED_ERRORS
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = "omg:invalidate"
+# Attesa prima di riaprire la sottoscrizione alle invalidazioni
+RECONNECT_SECONDS = 1.0
+
+class LocalCache:
+    """Size-bounded in-process LRU; entries carry a tag so a whole scope can be dropped"""
+
+    def __init__(self, max_bytes: int, max_entry_bytes: int):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.size = 0
+        self._entries: "OrderedDict[str, Tuple[Hashable, bytes, Optional[float]]]" = OrderedDict()
+        self._by_tag: Dict[Hashable, Set[str]] = {}
+
+    def get(self, key: str) -> Optional[bytes]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[2] is not None and entry[2] <= time.monotonic():
+            self._discard(key)
+            CACHE_LOCAL_BYTES.set(self.size)
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def set(self, key: str, data: bytes, tag: Hashable = None, ttl: Optional[float] = None):
+        if len(data) > self.max_entry_bytes:
+            return
+        self._discard(key)
+        self._entries[key] = (tag, data, time.monotonic() + ttl if ttl else None)
+        self._by_tag.setdefault(tag, set()).add(key)
+        self.size += len(data)
+        while self.size > self.max_bytes and self._entries:
+            self._discard(next(iter(self._entries)))
+        CACHE_LOCAL_BYTES.set(self.size)
+
+    def drop_tag(self, tag: Hashable):
+        for key in list(self._by_tag.pop(tag, ())):
+            self._discard(key)
+        CACHE_LOCAL_BYTES.set(self.size)
+
+    def clear(self):
+        self._entries.clear()
+        self._by_tag.clear()
+        self.size = 0
+        CACHE_LOCAL_BYTES.set(0)
+
+    def _discard(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            tag, data, _ = entry
+            self.size -= len(data)
+            keys = self._by_tag.get(tag)
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del self._by_tag[tag]
+
+class RespError(Exception):
+    """Error reply from the shared store"""
+
+# Errori del server condiviso: la cache degrada a solo L1 invece di far fallire la richiesta
+SHARED_ERRORS = (OSError, EOFError, RespError, asyncio.IncompleteReadError, asyncio.TimeoutError)
+
+class SharedStore(ABC):
+    """Operations the cache tier needs from the shared store"""
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None, only_new: bool = False) -> bool:
+        """Store a value (with a TTL in seconds); with only_new, fail if the key exists"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def delete(self, key: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def incr(self, key: str) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def publish(self, channel: str, message: bytes):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def subscribe(self, channel: str) -> "Subscription":
+        """Subscribe to a channel; returns once the subscription is active"""
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+class Subscription(ABC):
+    @abstractmethod
+    def messages(self) -> AsyncIterator[bytes]:
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+class MemoryStore(SharedStore):
+    """In-process stand-in for the shared server (CACHE_URL=memory://), for tests and single-worker runs"""
+
+    def __init__(self):
+        self._data: Dict[str, Tuple[bytes, Optional[float]]] = {}
+        self._channels: Dict[str, Set[asyncio.Queue]] = {}
+
+    def _live(self, key: str) -> Optional[bytes]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires is not None and expires <= time.monotonic():
+            del self._data[key]
+            return None
+        return value
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return self._live(key)
+
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None, only_new: bool = False) -> bool:
+        if only_new and self._live(key) is not None:
+            return False
+        self._data[key] = (value, time.monotonic() + ttl if ttl else None)
+        return True
+
+    async def delete(self, key: str):
+        self._data.pop(key, None)
+
+    async def incr(self, key: str) -> int:
+        value = int(self._live(key) or 0) + 1
+        self._data[key] = (str(value).encode(), None)
+        return value
+
+    async def publish(self, channel: str, message: bytes):
+        for queue in self._channels.get(channel, ()):
+            queue.put_nowait(message)
+
+    async def subscribe(self, channel: str) -> Subscription:
+        queue: asyncio.Queue = asyncio.Queue()
+        self._channels.setdefault(channel, set()).add(queue)
+        return MemorySubscription(self, channel, queue)
+
+class MemorySubscription(Subscription):
+    def __init__(self, store: MemoryStore, channel: str, queue: asyncio.Queue):
+        self.store = store
+        self.channel = channel
+        self.queue = queue
+
+    async def messages(self) -> AsyncIterator[bytes]:
+        while True:
+            yield await self.queue.get()
+
+    async def close(self):
+        self.store._channels.get(self.channel, set()).discard(self.queue)
+
+def _encode_command(args) -> bytes:
+    parts = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode()
+        elif not isinstance(arg, bytes):
+            arg = str(arg).encode()
+        parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+    return b''.join(parts)
+
+async def _read_reply(reader: asyncio.StreamReader):
+    line = await reader.readuntil(b'\r\n')
+    kind, payload = line[:1], line[1:-2]
+    if kind == b'+':
+        return payload
+    if kind == b'-':
+        raise RespError(payload.decode(errors='replace'))
+    if kind == b':':
+        return int(payload)
+    if kind == b'$':
+        length = int(payload)
+        if length < 0:
+            return None
+        return (await reader.readexactly(length + 2))[:-2]
+    if kind == b'*':
+        length = int(payload)
+        if length < 0:
+            return None
+        return [await _read_reply(reader) for _ in range(length)]
+    # Stream fuori sincrono: la connessione non è più utilizzabile
+    raise ConnectionError(f"Unexpected reply: {line!r}")
+
+class RespStore(SharedStore):
+    """Client for a Redis-compatible server speaking RESP, with a small connection pool"""
+
+    def __init__(self, url: str, pool_size: int = 8, timeout: float = 2.0):
+        parsed = urlparse(url)
+        query = parse_qs(parsed.query)
+        self.path = parsed.path if parsed.scheme == 'unix' else None
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or 6379
+        self.password = unquote(parsed.password) if parsed.password else None
+        if self.path is None and parsed.path.strip('/'):
+            self.db = int(parsed.path.strip('/'))
+        else:
+            self.db = int(query.get('db', ['0'])[0])
+        self.timeout = timeout
+        self._slots = asyncio.Semaphore(pool_size)
+        self._idle: List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+
+    async def _open(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        if self.path:
+            connection = asyncio.open_unix_connection(self.path)
+        else:
+            connection = asyncio.open_connection(self.host, self.port)
+        reader, writer = await asyncio.wait_for(connection, self.timeout)
+        try:
+            if self.password:
+                await self._call(reader, writer, ('AUTH', self.password))
+            if self.db:
+                await self._call(reader, writer, ('SELECT', self.db))
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+    async def _call(self, reader, writer, args):
+        writer.write(_encode_command(args))
+        await writer.drain()
+        return await asyncio.wait_for(_read_reply(reader), self.timeout)
+
+    async def execute(self, *args):
+        async with self._slots:
+            reader, writer = self._idle.pop() if self._idle else await self._open()
+            try:
+                reply = await self._call(reader, writer, args)
+            except RespError:
+                # Risposta di errore completa: la connessione resta utilizzabile
+                self._idle.append((reader, writer))
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            self._idle.append((reader, writer))
+            return reply
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self.execute('GET', key)
+
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None, only_new: bool = False) -> bool:
+        args = ['SET', key, value]
+        if ttl:
+            args += ['PX', int(ttl * 1000)]
+        if only_new:
+            args.append('NX')
+        return await self.execute(*args) is not None
+
+    async def delete(self, key: str):
+        await self.execute('DEL', key)
+
+    async def incr(self, key: str) -> int:
+        return await self.execute('INCR', key)
+
+    async def publish(self, channel: str, message: bytes):
+        await self.execute('PUBLISH', channel, message)
+
+    async def subscribe(self, channel: str) -> Subscription:
+        # Connessione dedicata: in modalità pub/sub accetta solo comandi di sottoscrizione
+        reader, writer = await self._open()
+        try:
+            await self._call(reader, writer, ('SUBSCRIBE', channel))
+        except BaseException:
+            writer.close()
+            raise
+        return RespSubscription(reader, writer)
+
+    async def close(self):
+        while self._idle:
+            _, writer = self._idle.pop()
+            writer.close()
+
+class RespSubscription(Subscription):
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    async def messages(self) -> AsyncIterator[bytes]:
+        while True:
+            reply = await _read_reply(self.reader)
+            if isinstance(reply, list) and len(reply) == 3 and reply[0] == b'message':
+                yield reply[2]
+
+    async def close(self):
+        self.writer.close()
+
+class CacheTier:
+    """L1 in-process LRU in front of an optional shared store, with versioned scopes"""
+
+    def __init__(self, local: LocalCache, shared: Optional[SharedStore] = None, ttl: float = 3600):
+        self.local = local
+        self.shared = shared
+        self.ttl = ttl
+        self._versions: Dict[str, int] = {}
+        # Le versioni in memoria sono affidabili solo mentre si ricevono le invalidazioni
+        self._subscribed = False
+        self._listener: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self.shared is not None and self._listener is None:
+            self._listener = asyncio.create_task(self._listen())
+
+    async def close(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+        if self.shared is not None:
+            await self.shared.close()
+
+    async def version(self, scope: str) -> int:
+        if self.shared is None:
+            return self._versions.get(scope, 0)
+        if not self._subscribed:
+            return await self._shared_version(scope)
+        if scope not in self._versions:
+            version = await self._shared_version(scope)
+            if version < 0:
+                return version
+            # Un'invalidazione può essere arrivata durante la lettura
+            self._versions[scope] = max(version, self._versions.get(scope, -1))
+        return self._versions[scope]
+
+    async def _shared_version(self, scope: str) -> int:
+        try:
+            return int(await self.shared.get(f"omg:version:{scope}") or 0)
+        except SHARED_ERRORS as e:
+            CACHE_SHARED_ERRORS.inc()
+            logger.warning("shared cache unavailable", extra={"error": str(e)})
+            # Versione negativa: chiavi mai scritte da nessun altro worker
+            return -1
+
+    async def key(self, scope: str, name: str) -> Optional[str]:
+        """Key of `name` at the current version of `scope`; None if the version is unknown"""
+        version = await self.version(scope)
+        if version < 0:
+            return None
+        return f"{name}:v{version}"
+
+    async def bump(self, scope: str):
+        """Invalidate everything cached under `scope`, in every worker"""
+        if self.shared is None:
+            self._apply(scope, self._versions.get(scope, 0) + 1)
+            return
+        try:
+            version = await self.shared.incr(f"omg:version:{scope}")
+            await self.shared.publish(INVALIDATION_CHANNEL, f"{scope} {version}".encode())
+        except SHARED_ERRORS as e:
+            CACHE_SHARED_ERRORS.inc()
+            logger.error("cache invalidation not broadcast", extra={"scope": scope, "error": str(e)})
+            self._versions.pop(scope, None)
+            self.local.drop_tag(scope)
+            return
+        self._apply(scope, version)
+
+    def _apply(self, scope: str, version: int):
+        if version > self._versions.get(scope, -1):
+            self._versions[scope] = version
+        self.local.drop_tag(scope)
+
+    async def _listen(self):
+        while True:
+            subscription = None
+            try:
+                subscription = await self.shared.subscribe(INVALIDATION_CHANNEL)
+                # Le invalidazioni perse mentre la sottoscrizione era giù vanno rilette
+                self._versions.clear()
+                self.local.clear()
+                self._subscribed = True
+                async for message in subscription.messages():
+                    scope, version = message.decode().rsplit(' ', 1)
+                    self._apply(scope, int(version))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                CACHE_SHARED_ERRORS.inc()
+                logger.warning("cache invalidation feed lost", extra={"error": str(e)})
+            finally:
+                self._subscribed = False
+                if subscription is not None:
+                    await subscription.close()
+            await asyncio.sleep(RECONNECT_SECONDS)
+
+    async def get(self, key: str, tag: Hashable = None) -> Optional[bytes]:
+        data = self.local.get(key)
+        if data is not None:
+            CACHE_LOOKUPS.inc(result="local_hit")
+            return data
+        if self.shared is not None:
+            try:
+                data = await self.shared.get(key)
+            except SHARED_ERRORS as e:
+                CACHE_SHARED_ERRORS.inc()
+                logger.warning("shared cache unavailable", extra={"error": str(e)})
+            if data is not None:
+                CACHE_LOOKUPS.inc(result="shared_hit")
+                self.local.set(key, data, tag, self.ttl)
+                return data
+        CACHE_LOOKUPS.inc(result="miss")
+        return None
+
+    async def set(self, key: str, data: bytes, tag: Hashable = None, ttl: Optional[float] = None):
+        self.local.set(key, data, tag, ttl or self.ttl)
+        if self.shared is not None and len(data) <= self.local.max_entry_bytes:
+            try:
+                await self.shared.set(key, data, ttl or self.ttl)
+            except SHARED_ERRORS as e:
+                CACHE_SHARED_ERRORS.inc()
+                logger.warning("shared cache unavailable", extra={"error": str(e)})
+
+def create_cache() -> CacheTier:
+    local = LocalCache(
+        max_bytes=int(os.getenv("CACHE_MAX_BYTES", os.getenv("PUBLIC_CACHE_MAX_BYTES", 256 * 1024 * 1024))),
+        max_entry_bytes=int(os.getenv("CACHE_MAX_ENTRY_BYTES", os.getenv("PUBLIC_CACHE_MAX_ENTRY_BYTES", 64 * 1024 * 1024)))
+    )
+    url = os.getenv("CACHE_URL", "")
+    shared: Optional[SharedStore] = None
+    if url.startswith("memory:"):
+        shared = MemoryStore()
+    elif url:
+        shared = RespStore(url, pool_size=int(os.getenv("CACHE_POOL_SIZE", 8)))
+    return CacheTier(local, shared, ttl=float(os.getenv("CACHE_TTL_SECONDS", 3600)))
+
+cache = create_cache()
@@ -0,0 +1,159 @@
+"""Change log of the playlists, so polling clients can fetch deltas.
+
+Every write that changes what a playlist renders bumps its `version` and logs
+which channels were added, updated, moved or removed. Entries hold channel ids
+only: the records sent to clients are read when a delta is asked for, and a
+channel changed several times since the client's version is sent once.
+Custom playlists get entries both when their membership changes and when one of
+their channels is edited in its source playlist.
+
+The log keeps at most CHANGE_LOG_MAX_ENTRIES entries per playlist: older ones
+are compacted away, as are writes touching more channels than that.
+`changes_since` is the oldest version a delta can start from; clients older
+than that get a full snapshot instead.
+"""
+from typing import Dict, Iterable, List, Optional, Tuple
+import os
+
+from m3u_utils import M3UChannel
+from sync import SyncDiff, chunked, load_tags
+
+ADDED = 'added'
+UPDATED = 'updated'
+MOVED = 'moved'
+REMOVED = 'removed'
+
+CHANGE_LOG_MAX_ENTRIES = int(os.getenv("CHANGE_LOG_MAX_ENTRIES", 10000))
+
+def sync_changes(existing_rows: List[Dict], diff: SyncDiff, added_ids: List[int]) -> List[Tuple[int, str]]:
+    """Log entries of a sync diff; `added_ids` are the ids given to diff.added"""
+    existing = {row['id']: row for row in existing_rows}
+    changes = [(channel_id, REMOVED) for channel_id in diff.removed]
+    for channel_id, position, channel, tvg_id, extra_tags in diff.updated:
+        row = existing[channel_id]
+        # Cambia solo la posizione: al client basta spostare il canale
+        moved_only = (
+            row['name'] == channel.name
+            and row['group_title'] == channel.group
+            and row['logo_url'] == channel.logo
+            and row['tvg_id'] == tvg_id
+            and load_tags(row['extra_tags']) == extra_tags
+            and load_tags(row['attributes']) == channel.attributes
+        )
+        changes.append((channel_id, MOVED if moved_only else UPDATED))
+    changes.extend((channel_id, ADDED) for channel_id in added_ids)
+    return changes
+
+def resolve_changes(entries: List[Dict], current: Dict[int, M3UChannel]) -> List[Dict]:
+    """Collapse log entries (oldest first) into one change per channel.
+
+    `current` holds the channels of `entries` that the playlist renders now.
+    A channel first logged as added is new to the client; one that is gone now
+    is removed (or skipped, if it was also added after the client's version).
+    """
+    first: Dict[int, str] = {}
+    edited = set()
+    for entry in entries:
+        first.setdefault(entry['channel_id'], entry['kind'])
+        if entry['kind'] != MOVED:
+            edited.add(entry['channel_id'])
+
+    removed, changed = [], []
+    for channel_id, kind in first.items():
+        channel = current.get(channel_id)
+        if channel is None:
+            if kind != ADDED:
+                removed.append({"op": REMOVED, "id": channel_id, "channel": None})
+            continue
+        if kind == ADDED:
+            op = ADDED
+        elif channel_id in edited:
+            op = UPDATED
+        else:
+            op = MOVED
+        changed.append({"op": op, "id": channel_id, "channel": channel})
+    changed.sort(key=lambda change: (change['channel'].position or 0, change['id']))
+    return removed + changed
+
+# Helper SQLite (PostgresRepository ha gli equivalenti)
+def record_changes(cursor, playlist_id: int, changes: Iterable[Tuple[int, str]]):
+    """Bump the playlist's version and log `changes` (channel id, kind) under it"""
+    changes = list(changes)
+    if not changes:
+        return
+    row = cursor.execute(
+        "UPDATE playlists SET version = version + 1 WHERE id = ? RETURNING version",
+        (playlist_id,)
+    ).fetchone()
+    if row is None:
+        return
+    version = row['version']
+
+    if len(changes) > CHANGE_LOG_MAX_ENTRIES:
+        # Troppe righe: i client ripartono da uno snapshot completo
+        cursor.execute("DELETE FROM playlist_changes WHERE playlist_id = ?", (playlist_id,))
+        cursor.execute("UPDATE playlists SET changes_since = ? WHERE id = ?", (version, playlist_id))
+        return
+
+    cursor.executemany(
+        "INSERT INTO playlist_changes (playlist_id, version, channel_id, kind) VALUES (?, ?, ?, ?)",
+        [(playlist_id, version, channel_id, kind) for channel_id, kind in changes]
+    )
+    cutoff = cursor.execute(
+        """
+        SELECT version FROM playlist_changes
+        WHERE playlist_id = ?
+        ORDER BY version DESC
+        LIMIT 1 OFFSET ?
+        """,
+        (playlist_id, CHANGE_LOG_MAX_ENTRIES)
+    ).fetchone()
+    if cutoff is not None:
+        cursor.execute(
+            "DELETE FROM playlist_changes WHERE playlist_id = ? AND version <= ?",
+            (playlist_id, cutoff['version'])
+        )
+        cursor.execute(
+            "UPDATE playlists SET changes_since = ? WHERE id = ?",
+            (cutoff['version'], playlist_id)
+        )
+
+def reset_changes(cursor, playlist_id: int):
+    """Bump the version dropping the log, e.g. after rewriting the whole playlist"""
+    cursor.execute("DELETE FROM playlist_changes WHERE playlist_id = ?", (playlist_id,))
+    cursor.execute(
+        "UPDATE playlists SET version = version + 1, changes_since = version + 1 WHERE id = ?",
+        (playlist_id,)
+    )
+
+def custom_memberships(cursor, channel_ids: Iterable[int]) -> Dict[int, List[int]]:
+    """Custom playlists containing the given channels: playlist id -> channel ids"""
+    memberships: Dict[int, List[int]] = {}
+    for ids in chunked(list(channel_ids)):
+        placeholders = ','.join('?' * len(ids))
+        for row in cursor.execute(
+            f"SELECT playlist_id, channel_id FROM custom_playlist_channels WHERE channel_id IN ({placeholders})",
+            ids
+        ).fetchall():
+            memberships.setdefault(row['playlist_id'], []).append(row['channel_id'])
+    return memberships
+
+def record_member_changes(cursor, memberships: Dict[int, List[int]], kind: str):
+    for playlist_id, channel_ids in memberships.items():
+        record_changes(cursor, playlist_id, [(channel_id, kind) for channel_id in channel_ids])
+
+def load_changes(cursor, playlist_id: int, since: int) -> List[Dict]:
+    return cursor.execute(
+        """
+        SELECT channel_id, kind FROM playlist_changes
+        WHERE playlist_id = ? AND version > ?
+        ORDER BY id
+        """,
+        (playlist_id, since)
+    ).fetchall()
+
+def read_version(cursor, playlist_id: int) -> Optional[Dict]:
+    return cursor.execute(
+        "SELECT version, changes_since FROM playlists WHERE id = ?",
+        (playlist_id,)
+    ).fetchone()
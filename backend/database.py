@@ -1,12 +1,28 @@
 import sqlite3
 from sqlite3 import Connection
 import json
-from typing import Optional
+import os
+import threading
+import time
+from typing import Dict, List, Optional
 from pathlib import Path
 from contextlib import contextmanager
-from passlib.hash import bcrypt
+from passwords import hash_password
 
-DATABASE_PATH = Path("data/playlists.db")
+try:
+    import fcntl
+except ImportError:  # Windows: un solo processo
+    fcntl = None
+
+from groups import GROUP_KEY, backfill_groups
+from metrics import DB_QUERIES, DB_QUERY_SECONDS, DB_FETCH_SECONDS
+import profiler
+
+DATABASE_PATH = Path(os.getenv("DATABASE_PATH", "data/playlists.db"))
+# "shared": tutto in DATABASE_PATH; "per_user": playlist e canali di ogni utente in un
+# file separato, così le scritture di utenti diversi non si contendono lo stesso lock
+STORAGE_MODE = os.getenv("STORAGE_MODE", "shared").lower()
+USER_DATA_DIR = Path(os.getenv("USER_DATA_DIR", str(DATABASE_PATH.parent / "users")))
 
 def dict_factory(cursor, row):
     fields = [column[0] for column in cursor.description]
@@ -22,107 +38,486 @@ def convert_dict(s):
 sqlite3.register_adapter(dict, adapt_dict)
 sqlite3.register_converter("JSON", convert_dict)
 
-@contextmanager
-def get_db() -> Connection:
-    """Create a database connection and return it"""
-    DATABASE_PATH.parent.mkdir(exist_ok=True)
+def _operation(sql: str) -> str:
+    words = sql.split(None, 1)
+    return words[0].upper() if words else ''
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor recording statement counts and durations in the metrics registry"""
+
+    _profile = None
+
+    def _observe(self, sql, parameters, seconds: float):
+        operation = _operation(sql)
+        DB_QUERIES.inc(operation=operation)
+        DB_QUERY_SECONDS.observe(seconds, operation=operation)
+        if profiler.ENABLED:
+            self._profile = profiler.record_statement(self, sql, parameters, seconds, max(self.rowcount, 0))
+
+    def _observe_fetch(self, seconds: float, rows: int):
+        DB_FETCH_SECONDS.inc(seconds)
+        if self._profile is not None:
+            self._profile.add_fetch(seconds, rows)
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._observe(sql, parameters, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._observe(sql, None, time.perf_counter() - started)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = None
+        try:
+            row = super().fetchone()
+            return row
+        finally:
+            self._observe_fetch(time.perf_counter() - started, row is not None)
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = ()
+        try:
+            rows = super().fetchmany(self.arraysize if size is None else size)
+            return rows
+        finally:
+            self._observe_fetch(time.perf_counter() - started, len(rows))
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = ()
+        try:
+            rows = super().fetchall()
+            return rows
+        finally:
+            self._observe_fetch(time.perf_counter() - started, len(rows))
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose cursors (including the execute() shortcut) are TimedCursor"""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+def _connect(path: Path) -> Connection:
+    path.parent.mkdir(parents=True, exist_ok=True)
     conn = sqlite3.connect(
-        str(DATABASE_PATH), 
+        str(path), 
         detect_types=sqlite3.PARSE_DECLTYPES,
         timeout=30.0,  # Aumenta il timeout a 30 secondi
-        isolation_level=None  # Abilita la modalità autocommit
+        isolation_level=None,  # Abilita la modalità autocommit
+        factory=TimedConnection
     )
     conn.row_factory = dict_factory
-    
+    # Identifica il database (cache dei tag set per file)
+    conn.path = str(path)
+    return conn
+
+@contextmanager
+def get_db() -> Connection:
+    """Create a connection to the main database (users and, in per_user mode, the catalog)"""
+    conn = _connect(DATABASE_PATH)
     try:
         yield conn
     finally:
         conn.close()
 
-def init_db():
-    """Initialize the database with required tables"""
-    with get_db() as conn:
-        cursor = conn.cursor()
+def sharded() -> bool:
+    return STORAGE_MODE == "per_user"
 
-        # Enable WAL mode for better concurrency
-        cursor.execute('PRAGMA journal_mode=WAL')
-        
-        # Create users table
+def user_db_path(user_id: int) -> Path:
+    return USER_DATA_DIR / f"user_{int(user_id)}.db"
+
+def database_files() -> List[Path]:
+    """The main database and, in per_user mode, every user shard"""
+    files = [DATABASE_PATH]
+    if sharded():
+        files.extend(sorted(USER_DATA_DIR.glob("user_*.db")))
+    return files
+
+@contextmanager
+def open_database(path: Path) -> Connection:
+    """Connection to one database file as it is, without schema setup (for maintenance)"""
+    conn = _connect(path)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+_ready_shards = set()
+_shards_lock = threading.Lock()
+
+@contextmanager
+def _schema_lock():
+    """Serialize schema creation and migrations across worker processes"""
+    if fcntl is None:
+        yield
+        return
+    DATABASE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    with open(DATABASE_PATH.with_name(DATABASE_PATH.name + ".lock"), "a") as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+
+@contextmanager
+def get_user_db(user_id: int) -> Connection:
+    """Create a connection to the database holding the playlists and channels of a user"""
+    if not sharded():
+        with get_db() as conn:
+            yield conn
+        return
+
+    path = user_db_path(user_id)
+    conn = _connect(path)
+    try:
+        if user_id not in _ready_shards:
+            with _shards_lock, _schema_lock():
+                if user_id not in _ready_shards:
+                    _init_user_shard(conn, user_id)
+                    _ready_shards.add(user_id)
+        yield conn
+    finally:
+        conn.close()
+
+def _ensure_column(cursor, table: str, column: str, definition: str):
+    """Add a column to an existing table if it is missing (lightweight migration)"""
+    columns = [row['name'] for row in cursor.execute(f"PRAGMA table_info({table})").fetchall()]
+    if column not in columns:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+def _create_playlist_tables(cursor):
+    """Create playlists, channels and custom_playlist_channels (main database or user shard)"""
+    # Create playlists table
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS playlists (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            url TEXT,
+            is_custom BOOLEAN DEFAULT FALSE,
+            public_token TEXT UNIQUE,
+            epg_url TEXT,
+            last_sync TIMESTAMP,
+            rules JSON,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    """)
+
+    # Migrazione per database esistenti
+    _ensure_column(cursor, "playlists", "rules", "JSON")
+    # Versione e log delle modifiche (vedi changes.py)
+    _ensure_column(cursor, "playlists", "version", "INTEGER NOT NULL DEFAULT 0")
+    _ensure_column(cursor, "playlists", "changes_since", "INTEGER NOT NULL DEFAULT 0")
+
+    # Create channels table
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS channels (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            playlist_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            url TEXT NOT NULL,
+            group_title TEXT,
+            logo_url TEXT,
+            tvg_id TEXT,
+            position INTEGER,
+            extra_tags JSON,
+            attributes JSON,
+            is_dead BOOLEAN DEFAULT FALSE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (playlist_id) REFERENCES playlists (id) ON DELETE CASCADE
+        )
+    """)
+
+    _ensure_column(cursor, "channels", "is_dead", "BOOLEAN DEFAULT FALSE")
+    _ensure_column(cursor, "channels", "attributes", "JSON")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_channels_playlist ON channels (playlist_id, position)"
+    )
+
+    # Tag set condivisi tra i canali (vedi tag_sets.py); il testo non ha tipo JSON
+    # così il converter non lo decodifica a ogni riga
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS tag_sets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tags TEXT NOT NULL UNIQUE
+        )
+    """)
+    _ensure_column(cursor, "channels", "tag_set_id", "INTEGER REFERENCES tag_sets (id)")
+    _intern_legacy_tags(cursor)
+
+    # Gruppi per playlist (vedi groups.py)
+    cursor.execute(
+        f"CREATE INDEX IF NOT EXISTS idx_channels_group ON channels (playlist_id, {GROUP_KEY}, position)"
+    )
+    fresh_groups = not cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'channel_groups'"
+    ).fetchone()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS channel_groups (
+            playlist_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            channel_count INTEGER NOT NULL DEFAULT 0,
+            first_position INTEGER,
+            hidden BOOLEAN NOT NULL DEFAULT FALSE,
+            PRIMARY KEY (playlist_id, name),
+            FOREIGN KEY (playlist_id) REFERENCES playlists (id) ON DELETE CASCADE
+        )
+    """)
+    if fresh_groups:
+        backfill_groups(cursor)
+
+    # Create custom_playlist_channels table
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS custom_playlist_channels (
+            playlist_id INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            position INTEGER,
+            PRIMARY KEY (playlist_id, channel_id),
+            FOREIGN KEY (playlist_id) REFERENCES playlists (id) ON DELETE CASCADE,
+            FOREIGN KEY (channel_id) REFERENCES channels (id) ON DELETE CASCADE
+        )
+    """)
+
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_custom_playlist_channels_channel "
+        "ON custom_playlist_channels (channel_id)"
+    )
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS playlist_changes (
+            id INTEGER PRIMARY KEY,
+            playlist_id INTEGER NOT NULL,
+            version INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            FOREIGN KEY (playlist_id) REFERENCES playlists (id) ON DELETE CASCADE
+        )
+    """)
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_playlist_changes_version "
+        "ON playlist_changes (playlist_id, version)"
+    )
+
+# PRAGMA user_version: ultima migrazione dei dati eseguita sul file
+TAGS_INTERNED_VERSION = 1
+
+def _intern_legacy_tags(cursor):
+    """Move extra_tags blobs written before tag_sets existed into the shared table"""
+    # Fatto una volta per file: dopo, la ricerca sarebbe una scansione completa di channels
+    if cursor.execute("PRAGMA user_version").fetchone()['user_version'] >= TAGS_INTERNED_VERSION:
+        return
+    if not cursor.execute(
+        "SELECT 1 FROM channels WHERE extra_tags IS NOT NULL LIMIT 1"
+    ).fetchone():
+        cursor.execute(f"PRAGMA user_version = {TAGS_INTERNED_VERSION}")
+        return
+
+    # I blob sono stati scritti con json.dumps: il testo è già quello canonico
+    cursor.execute("BEGIN TRANSACTION")
+    try:
         cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT NOT NULL UNIQUE,
-                password_hash TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
+            INSERT OR IGNORE INTO tag_sets (tags)
+            SELECT DISTINCT CAST(extra_tags AS TEXT) FROM channels
+            WHERE tag_set_id IS NULL AND extra_tags IS NOT NULL
+              AND CAST(extra_tags AS TEXT) NOT IN ('', '{}', 'null')
         """)
-        
-        # Create playlists table
         cursor.execute("""
-            CREATE TABLE IF NOT EXISTS playlists (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                name TEXT NOT NULL,
-                url TEXT,
-                is_custom BOOLEAN DEFAULT FALSE,
-                public_token TEXT UNIQUE,
-                epg_url TEXT,
-                last_sync TIMESTAMP,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
+            UPDATE channels
+            SET tag_set_id = (SELECT id FROM tag_sets WHERE tags = CAST(channels.extra_tags AS TEXT))
+            WHERE tag_set_id IS NULL AND extra_tags IS NOT NULL
         """)
+        # La colonna resta per compatibilità ma non viene più scritta
+        cursor.execute("UPDATE channels SET extra_tags = NULL WHERE extra_tags IS NOT NULL")
+        cursor.execute(f"PRAGMA user_version = {TAGS_INTERNED_VERSION}")
+        cursor.execute("COMMIT")
+    except Exception:
+        cursor.execute("ROLLBACK")
+        raise
 
-        # Create channels table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS channels (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                playlist_id INTEGER NOT NULL,
-                name TEXT NOT NULL,
-                url TEXT NOT NULL,
-                group_title TEXT,
-                logo_url TEXT,
-                tvg_id TEXT,
-                position INTEGER,
-                extra_tags JSON,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (playlist_id) REFERENCES playlists (id) ON DELETE CASCADE
-            )
-        """)
+def _table_columns(cursor, table: str, schema: str = "main"):
+    return [row['name'] for row in cursor.execute(f"PRAGMA {schema}.table_info({table})").fetchall()]
 
-        # Create custom_playlist_channels table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS custom_playlist_channels (
-                playlist_id INTEGER NOT NULL,
-                channel_id INTEGER NOT NULL,
-                position INTEGER,
-                PRIMARY KEY (playlist_id, channel_id),
-                FOREIGN KEY (playlist_id) REFERENCES playlists (id) ON DELETE CASCADE,
-                FOREIGN KEY (channel_id) REFERENCES channels (id) ON DELETE CASCADE
+def _init_user_shard(conn: Connection, user_id: int):
+    """Create the schema of a user shard and, the first time, copy the user's data from the main database"""
+    cursor = conn.cursor()
+    # Solo per i file nuovi: quelli esistenti passano a INCREMENTAL con un VACUUM (maintenance.py)
+    cursor.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    cursor.execute('PRAGMA journal_mode=WAL')
+    fresh = not cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'playlists'"
+    ).fetchone()
+    _create_playlist_tables(cursor)
+    if not fresh:
+        return
+
+    # Migrazione da modalità "shared": copia playlist, canali e selezioni mantenendo gli id
+    cursor.execute("ATTACH DATABASE ? AS legacy", (str(DATABASE_PATH),))
+    try:
+        if cursor.execute(
+            "SELECT 1 FROM legacy.sqlite_master WHERE type = 'table' AND name = 'playlists'"
+        ).fetchone():
+            cursor.execute("BEGIN TRANSACTION")
+            tables = [("playlists", "user_id = ?")]
+            if cursor.execute(
+                "SELECT 1 FROM legacy.sqlite_master WHERE type = 'table' AND name = 'tag_sets'"
+            ).fetchone():
+                tables.append((
+                    "tag_sets",
+                    "id IN (SELECT tag_set_id FROM legacy.channels WHERE playlist_id IN "
+                    "(SELECT id FROM legacy.playlists WHERE user_id = ?))"
+                ))
+            if cursor.execute(
+                "SELECT 1 FROM legacy.sqlite_master WHERE type = 'table' AND name = 'channel_groups'"
+            ).fetchone():
+                tables.append((
+                    "channel_groups",
+                    "playlist_id IN (SELECT id FROM legacy.playlists WHERE user_id = ?)"
+                ))
+            for table, condition in tables + [
+                ("channels", "playlist_id IN (SELECT id FROM legacy.playlists WHERE user_id = ?)"),
+                ("custom_playlist_channels", "playlist_id IN (SELECT id FROM legacy.playlists WHERE user_id = ?)"),
+            ]:
+                legacy_columns = set(_table_columns(cursor, table, "legacy"))
+                columns = ', '.join(c for c in _table_columns(cursor, table) if c in legacy_columns)
+                cursor.execute(
+                    f"INSERT INTO main.{table} ({columns}) SELECT {columns} FROM legacy.{table} WHERE {condition}",
+                    (user_id,)
+                )
+            cursor.execute("COMMIT")
+    finally:
+        cursor.execute("DETACH DATABASE legacy")
+    # Canali copiati da un database principale non ancora migrato
+    _intern_legacy_tags(cursor)
+    backfill_groups(cursor)
+    # Il log delle modifiche non viene copiato: i client ripartono da uno snapshot
+    cursor.execute("UPDATE playlists SET changes_since = version")
+
+    tokens = cursor.execute(
+        "SELECT id, public_token FROM playlists WHERE public_token IS NOT NULL"
+    ).fetchall()
+    if tokens:
+        with get_db() as catalog:
+            catalog.executemany(
+                "INSERT OR REPLACE INTO public_tokens (token, user_id, playlist_id) VALUES (?, ?, ?)",
+                [(row['public_token'], user_id, row['id']) for row in tokens]
             )
-        """)
 
-        # Insert default admin user if it doesn't exist
-        cursor.execute("SELECT * FROM users WHERE username = ?", ("admin",))
-        if not cursor.fetchone():
-            password_hash = bcrypt.hash("admin")
-            cursor.execute(
-                "INSERT INTO users (username, password_hash) VALUES (?, ?)",
-                ("admin", password_hash)
+def init_db():
+    """Initialize the database with required tables"""
+    with _schema_lock():
+        with get_db() as conn:
+            cursor = conn.cursor()
+
+            # Pagine libere restituite a poco a poco da maintenance.py (solo per i file nuovi)
+            cursor.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            # Enable WAL mode for better concurrency
+            cursor.execute('PRAGMA journal_mode=WAL')
+        
+            # Create users table
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS users (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    username TEXT NOT NULL UNIQUE,
+                    password_hash TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+
+            if sharded():
+                # Catalogo: da token pubblico a utente e playlist, senza aprire ogni shard
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS public_tokens (
+                        token TEXT PRIMARY KEY,
+                        user_id INTEGER NOT NULL,
+                        playlist_id INTEGER NOT NULL,
+                        FOREIGN KEY (user_id) REFERENCES users (id)
+                    )
+                """)
+                cursor.execute(
+                    "CREATE UNIQUE INDEX IF NOT EXISTS idx_public_tokens_playlist "
+                    "ON public_tokens (user_id, playlist_id)"
+                )
+            else:
+                _create_playlist_tables(cursor)
+
+            # Insert default admin user if it doesn't exist
+            cursor.execute("SELECT * FROM users WHERE username = ?", ("admin",))
+            if not cursor.fetchone():
+                password_hash = hash_password("admin")
+                cursor.execute(
+                    "INSERT INTO users (username, password_hash) VALUES (?, ?)",
+                    ("admin", password_hash)
+                )
+
+            user_ids = [row['id'] for row in cursor.execute("SELECT id FROM users").fetchall()]
+
+    if sharded():
+        # Crea subito gli shard (migrando i dati esistenti) così i link pubblici restano validi
+        for user_id in user_ids:
+            with get_user_db(user_id):
+                pass
+
+def set_public_token(user_id: int, playlist_id: int, token: Optional[str]):
+    """Keep the catalog index in sync after a playlist's public token changes (per_user mode)"""
+    if not sharded():
+        return
+    with get_db() as catalog:
+        catalog.execute(
+            "DELETE FROM public_tokens WHERE user_id = ? AND playlist_id = ?",
+            (user_id, playlist_id)
+        )
+        if token:
+            catalog.execute(
+                "INSERT INTO public_tokens (token, user_id, playlist_id) VALUES (?, ?, ?)",
+                (token, user_id, playlist_id)
             )
 
-def verify_password(username: str, password: str) -> bool:
-    """Verify user password"""
-    with get_db() as conn:
-        cursor = conn.cursor()
-        user = cursor.execute(
-            "SELECT * FROM users WHERE username = ?",
-            (username,)
+def find_public_playlist(token: str) -> Optional[Dict]:
+    """Return the playlist published under `token`, whichever database holds it"""
+    if not sharded():
+        with get_db() as db:
+            return db.execute(
+                "SELECT * FROM playlists WHERE public_token = ?",
+                (token,)
+            ).fetchone()
+
+    with get_db() as catalog:
+        entry = catalog.execute(
+            "SELECT user_id, playlist_id FROM public_tokens WHERE token = ?",
+            (token,)
         ).fetchone()
-        
-        if user and bcrypt.verify(password, user['password_hash']):
-            return True
-        return False
+    if not entry:
+        return None
+    with get_user_db(entry['user_id']) as db:
+        return db.execute(
+            "SELECT * FROM playlists WHERE id = ? AND public_token = ?",
+            (entry['playlist_id'], token)
+        ).fetchone()
+
+def public_playlist_owners() -> List[int]:
+    """Ids of the users with at least one public playlist, whichever database holds them"""
+    with get_db() as db:
+        if sharded():
+            rows = db.execute("SELECT DISTINCT user_id FROM public_tokens").fetchall()
+        else:
+            rows = db.execute("SELECT DISTINCT user_id FROM playlists WHERE public_token IS NOT NULL").fetchall()
+    return [row['user_id'] for row in rows]
 
 if __name__ == "__main__":
     init_db()
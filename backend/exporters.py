@@ -0,0 +1,172 @@
+from typing import Dict, List, AsyncIterator, Tuple
+from abc import ABC, abstractmethod
+import csv
+import io
+import json
+
+from m3u_utils import M3UChannel, format_m3u_header, format_m3u_entry
+from changes import MOVED, REMOVED
+from repository import repo
+from logos import logo_cache
+from playback import playback_index
+
+# Righe lette dal database per ogni blocco inviato al client
+EXPORT_BATCH_SIZE = 1000
+
+class Exporter(ABC):
+    """Base class for playlist export formats.
+
+    Subclasses render the header, each batch of channels and the footer as text;
+    stream_export glues them to the shared row iterator so no format ever needs
+    the whole playlist in memory.
+    """
+    name = ''
+    media_type = 'text/plain'
+    extension = 'txt'
+
+    def header(self, playlist: Dict) -> str:
+        return ''
+
+    @abstractmethod
+    def format(self, channel: M3UChannel) -> str:
+        raise NotImplementedError
+
+    def rows(self, channels: List[M3UChannel]) -> str:
+        return ''.join(self.format(channel) for channel in channels)
+
+    def footer(self, playlist: Dict) -> str:
+        return ''
+
+EXPORTERS: Dict[str, Exporter] = {}
+
+def register_exporter(cls):
+    """Class decorator adding an exporter to the registry under its `name`"""
+    EXPORTERS[cls.name] = cls()
+    return cls
+
+def get_exporter(name: str) -> Exporter:
+    try:
+        return EXPORTERS[name]
+    except KeyError:
+        raise KeyError(f"Unknown export format '{name}', available: {', '.join(sorted(EXPORTERS))}")
+
+@register_exporter
+class M3UExporter(Exporter):
+    name = 'm3u'
+    media_type = 'application/x-mpegurl'
+    extension = 'm3u'
+    plus = False
+
+    def header(self, playlist: Dict) -> str:
+        return format_m3u_header(playlist.get('epg_url')) + '\n'
+
+    def format(self, channel: M3UChannel) -> str:
+        return format_m3u_entry(channel, self.plus) + '\n'
+
+@register_exporter
+class M3UPlusExporter(M3UExporter):
+    """M3U with every original #EXTINF attribute preserved"""
+    name = 'm3u_plus'
+    plus = True
+
+def _channel_record(channel: M3UChannel) -> Dict:
+    return {
+        "position": channel.position,
+        "name": channel.name,
+        "url": channel.url,
+        "group_title": channel.group,
+        "logo_url": channel.logo,
+        "tvg_id": channel.tvg_id,
+        "attributes": channel.attributes,
+        "extra_tags": {k: v for k, v in channel.extra_tags.items() if k != 'epg_url'}
+    }
+
+@register_exporter
+class JSONLinesExporter(Exporter):
+    name = 'jsonl'
+    media_type = 'application/x-ndjson'
+    extension = 'jsonl'
+
+    def format(self, channel: M3UChannel) -> str:
+        return json.dumps(_channel_record(channel), ensure_ascii=False) + '\n'
+
+@register_exporter
+class CSVExporter(Exporter):
+    name = 'csv'
+    media_type = 'text/csv'
+    extension = 'csv'
+    columns = ['position', 'name', 'url', 'group_title', 'logo_url', 'tvg_id', 'attributes', 'extra_tags']
+
+    def header(self, playlist: Dict) -> str:
+        return self.rows_to_text([self.columns])
+
+    def format(self, channel: M3UChannel) -> str:
+        return self.rows([channel])
+
+    def rows(self, channels: List[M3UChannel]) -> str:
+        records = []
+        for channel in channels:
+            record = _channel_record(channel)
+            # I dizionari vanno in una singola colonna come JSON
+            record['attributes'] = json.dumps(record['attributes'], ensure_ascii=False) if record['attributes'] else ''
+            record['extra_tags'] = json.dumps(record['extra_tags'], ensure_ascii=False) if record['extra_tags'] else ''
+            records.append([record[column] for column in self.columns])
+        return self.rows_to_text(records)
+
+    @staticmethod
+    def rows_to_text(records: List[List]) -> str:
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(records)
+        return buffer.getvalue()
+
+def _rewrite_public(playlist: Dict, channels: List[Tuple[int, M3UChannel]]):
+    """Logos to the logo proxy and streams to the failover redirects, where configured"""
+    if logo_cache.enabled:
+        logo_cache.rewrite([channel for _, channel in channels])
+    if playback_index.enabled:
+        playback_index.rewrite(playlist['public_token'], channels)
+
+async def stream_export(playlist: Dict, exporter: Exporter, public: bool = False) -> AsyncIterator[bytes]:
+    """Render a playlist with `exporter`, yielding encoded chunks as rows are read.
+
+    The `public` rendition points logos to the logo proxy (LOGO_PROXY_URL) and
+    streams to the failover redirects (PLAY_REDIRECT_URL) when configured.
+    """
+    yield exporter.header(playlist).encode()
+    async for channels in repo.iter_export_channels(playlist, EXPORT_BATCH_SIZE):
+        if public:
+            _rewrite_public(playlist, channels)
+        yield exporter.rows([channel for _, channel in channels]).encode()
+    footer = exporter.footer(playlist)
+    if footer:
+        yield footer.encode()
+
+def render_changes(playlist: Dict, changes: Dict, public: bool = False) -> Dict:
+    """JSON body of the changes of a playlist (see Repository.playlist_changes).
+
+    Added and updated channels carry their full record and removed ones only
+    their id; moved ones carry id and new position.
+    """
+    body = {"version": changes['version'], "full": changes['full'], "epg_url": playlist.get('epg_url')}
+    if changes['full']:
+        if public:
+            _rewrite_public(playlist, changes['channels'])
+        body['channels'] = [
+            {"id": channel_id, **_channel_record(channel)}
+            for channel_id, channel in changes['channels']
+        ]
+        return body
+
+    if public:
+        _rewrite_public(playlist, [(change['id'], change['channel']) for change in changes['changes'] if change['channel']])
+    records = []
+    for change in changes['changes']:
+        record = {"op": change['op'], "id": change['id']}
+        if change['op'] == MOVED:
+            record['position'] = change['channel'].position
+        elif change['op'] != REMOVED:
+            record.update(_channel_record(change['channel']))
+        records.append(record)
+    body['changes'] = records
+    return body
+
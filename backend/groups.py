@@ -0,0 +1,204 @@
+"""Channel groups of the regular playlists.
+
+channel_groups keeps, for each group-title of a playlist, its channel count and
+first position, so listing groups does not scan every channel. Channels without
+a group-title belong to the group named ''. Rows are refreshed for the groups
+touched by each write; `hidden` is the only state of their own (it survives
+syncs) and keeps the group's channels out of the playlist's exports.
+Writes log the channels they change in the playlist's change log.
+"""
+from typing import Dict, Iterable, List, Optional, Set
+
+from changes import ADDED, MOVED, REMOVED, UPDATED, custom_memberships, record_changes, record_member_changes
+from sync import SyncDiff, chunked
+
+UNGROUPED = ''
+
+# Stessa espressione dell'indice idx_channels_group
+GROUP_KEY = "COALESCE(group_title, '')"
+
+def group_name(group_title: Optional[str]) -> str:
+    return group_title or UNGROUPED
+
+def group_names(group_titles: Iterable[Optional[str]]) -> Set[str]:
+    return {group_name(title) for title in group_titles}
+
+def diff_groups(existing_rows: List[Dict], diff: SyncDiff) -> Set[str]:
+    """Groups whose channels are added, removed, moved or edited by a sync diff"""
+    changed = set(diff.removed)
+    changed.update(row[0] for row in diff.updated)
+    names = group_names(row['group_title'] for row in existing_rows if row['id'] in changed)
+    names.update(group_names(channel.group for _, _, channel, _, _ in diff.updated))
+    names.update(group_names(channel.group for _, channel, _, _ in diff.added))
+    return names
+
+def upsert_groups_sql(condition: str) -> str:
+    """Insert or update the groups of the channels matching `condition`"""
+    return f"""
+        INSERT INTO channel_groups (playlist_id, name, channel_count, first_position)
+        SELECT playlist_id, {GROUP_KEY}, COUNT(*), MIN(position)
+        FROM channels
+        WHERE {condition}
+        GROUP BY playlist_id, {GROUP_KEY}
+        ON CONFLICT (playlist_id, name) DO UPDATE
+        SET channel_count = excluded.channel_count, first_position = excluded.first_position
+    """
+
+def backfill_groups(cursor):
+    """Create the groups of playlists that have channels but no group rows yet"""
+    cursor.execute(upsert_groups_sql(
+        "playlist_id NOT IN (SELECT playlist_id FROM channel_groups)"
+    ))
+
+def refresh_groups(cursor, playlist_id: int, names: Optional[Iterable[str]] = None):
+    """Recompute count and first position of the given groups (all of them when None)"""
+    if names is None:
+        cursor.execute(
+            f"""
+            DELETE FROM channel_groups
+            WHERE playlist_id = ? AND name NOT IN (
+                SELECT {GROUP_KEY} FROM channels WHERE playlist_id = ?
+            )
+            """,
+            (playlist_id, playlist_id)
+        )
+        cursor.execute(upsert_groups_sql("playlist_id = ?"), (playlist_id,))
+        return
+
+    for batch in chunked(sorted(names)):
+        placeholders = ','.join('?' * len(batch))
+        cursor.execute(
+            f"""
+            DELETE FROM channel_groups
+            WHERE playlist_id = ? AND name IN ({placeholders}) AND NOT EXISTS (
+                SELECT 1 FROM channels
+                WHERE playlist_id = channel_groups.playlist_id AND {GROUP_KEY} = channel_groups.name
+            )
+            """,
+            (playlist_id, *batch)
+        )
+        cursor.execute(
+            upsert_groups_sql(f"playlist_id = ? AND {GROUP_KEY} IN ({placeholders})"),
+            (playlist_id, *batch)
+        )
+
+def list_groups(cursor, playlist_id: int) -> List[Dict]:
+    return cursor.execute(
+        """
+        SELECT name, channel_count, first_position, hidden
+        FROM channel_groups
+        WHERE playlist_id = ?
+        ORDER BY first_position, name
+        """,
+        (playlist_id,)
+    ).fetchall()
+
+def get_group(cursor, playlist_id: int, name: str) -> Optional[Dict]:
+    return cursor.execute(
+        """
+        SELECT name, channel_count, first_position, hidden
+        FROM channel_groups
+        WHERE playlist_id = ? AND name = ?
+        """,
+        (playlist_id, name)
+    ).fetchone()
+
+def group_channels(cursor, playlist_id: int, name: str) -> List[Dict]:
+    return cursor.execute(
+        f"""
+        SELECT * FROM channels
+        WHERE playlist_id = ? AND {GROUP_KEY} = ?
+        ORDER BY position, id
+        """,
+        (playlist_id, name)
+    ).fetchall()
+
+def rename_groups(cursor, playlist_id: int, names: List[str], new_name: str) -> List[int]:
+    """Move the channels of `names` under `new_name` (merging if it exists); returns their ids"""
+    placeholders = ','.join('?' * len(names))
+    channel_ids = [
+        row['id'] for row in cursor.execute(
+            f"SELECT id FROM channels WHERE playlist_id = ? AND {GROUP_KEY} IN ({placeholders})",
+            (playlist_id, *names)
+        ).fetchall()
+    ]
+    cursor.execute(
+        f"""
+        UPDATE channels SET group_title = ?
+        WHERE playlist_id = ? AND {GROUP_KEY} IN ({placeholders})
+        """,
+        (new_name or None, playlist_id, *names)
+    )
+    record_changes(cursor, playlist_id, [(channel_id, UPDATED) for channel_id in channel_ids])
+    record_member_changes(cursor, custom_memberships(cursor, channel_ids), UPDATED)
+    # Un gruppo nuovo resta nascosto solo se lo erano tutti i gruppi rinominati
+    cursor.execute(
+        f"""
+        INSERT OR IGNORE INTO channel_groups (playlist_id, name, channel_count, first_position, hidden)
+        SELECT ?, ?, 0, 0, COALESCE(MIN(hidden), 0)
+        FROM channel_groups
+        WHERE playlist_id = ? AND name IN ({placeholders})
+        """,
+        (playlist_id, new_name, playlist_id, *names)
+    )
+    refresh_groups(cursor, playlist_id, set(names) | {new_name})
+    return channel_ids
+
+def set_groups_hidden(cursor, playlist_id: int, names: List[str], hidden: bool) -> int:
+    placeholders = ','.join('?' * len(names))
+    # Per il log: i canali dei gruppi che cambiano davvero stato escono o rientrano nell'export
+    toggled = [
+        row['id'] for row in cursor.execute(
+            f"""
+            SELECT c.id FROM channels c
+            JOIN channel_groups g ON g.playlist_id = c.playlist_id AND g.name = {GROUP_KEY}
+            WHERE g.playlist_id = ? AND g.name IN ({placeholders}) AND g.hidden != ?
+            """,
+            (playlist_id, *names, hidden)
+        ).fetchall()
+    ]
+    count = cursor.execute(
+        f"UPDATE channel_groups SET hidden = ? WHERE playlist_id = ? AND name IN ({placeholders})",
+        (hidden, playlist_id, *names)
+    ).rowcount
+    record_changes(cursor, playlist_id, [(channel_id, REMOVED if hidden else ADDED) for channel_id in toggled])
+    return count
+
+def move_groups(cursor, playlist_id: int, names: List[str], before: Optional[str]) -> int:
+    """Move the channels of `names` as a block before the group `before` (at the end when None).
+
+    Positions of the whole playlist are renumbered from 1, keeping the relative
+    order of both the moved channels and the others.
+    """
+    if before is None:
+        anchor = cursor.execute(
+            "SELECT COALESCE(MAX(position), 0) + 1 AS anchor FROM channels WHERE playlist_id = ?",
+            (playlist_id,)
+        ).fetchone()['anchor']
+    else:
+        anchor = get_group(cursor, playlist_id, before)['first_position']
+
+    placeholders = ','.join('?' * len(names))
+    moved = f"{GROUP_KEY} IN ({placeholders})"
+    cursor.execute(
+        f"""
+        WITH renumbered AS (
+            SELECT id, ROW_NUMBER() OVER (
+                ORDER BY CASE WHEN {moved} THEN ? ELSE position END,
+                         CASE WHEN {moved} THEN 0 ELSE 1 END,
+                         position, id
+            ) AS new_position
+            FROM channels
+            WHERE playlist_id = ?
+        )
+        UPDATE channels SET position = renumbered.new_position
+        FROM renumbered
+        WHERE channels.id = renumbered.id AND channels.position IS NOT renumbered.new_position
+        RETURNING channels.id
+        """,
+        (*names, anchor, *names, playlist_id)
+    )
+    changed = [row['id'] for row in cursor.fetchall()]
+    refresh_groups(cursor, playlist_id)
+    record_changes(cursor, playlist_id, [(channel_id, MOVED) for channel_id in changed])
+    return len(changed)
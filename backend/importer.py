@@ -0,0 +1,138 @@
+from typing import List, Optional, AsyncIterator
+import codecs
+
+from fastapi import Request
+from multipart.multipart import MultipartParser, parse_options_header
+
+from m3u_utils import M3UChannel, M3UStreamParser
+from logos import logo_cache
+
+# Canali scritti per transazione durante un import
+IMPORT_BATCH_SIZE = 5000
+
+class UploadStream:
+    """Iterate over the bytes of an uploaded M3U file as the request body streams in.
+
+    Accepts either a multipart/form-data body (the first part carrying a filename,
+    or the part named `file`) or a raw body (e.g. audio/x-mpegurl). Nothing is
+    spooled to memory or disk beyond the chunk being processed.
+    """
+
+    def __init__(self, request: Request):
+        self.request = request
+        self.filename: Optional[str] = None
+        self.bytes_received = 0
+
+        content_type, params = parse_options_header(request.headers.get('content-type', ''))
+        self._multipart = None
+        if content_type == b'multipart/form-data':
+            boundary = params.get(b'boundary')
+            if not boundary:
+                raise ValueError("Missing multipart boundary")
+            self._multipart = MultipartParser(boundary, {
+                'on_part_begin': self._on_part_begin,
+                'on_part_data': self._on_part_data,
+                'on_part_end': self._on_part_end,
+                'on_header_field': self._on_header_field,
+                'on_header_value': self._on_header_value,
+                'on_header_end': self._on_header_end,
+                'on_headers_finished': self._on_headers_finished,
+            })
+
+        self._chunks: List[bytes] = []
+        self._in_file = False
+        self._file_seen = False
+        self._header_field = b''
+        self._header_value = b''
+        self._headers = {}
+
+    # Callback del parser multipart
+    def _on_part_begin(self):
+        self._headers = {}
+
+    def _on_header_field(self, data: bytes, start: int, end: int):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b''
+        self._header_value = b''
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b'content-disposition', b''))
+        filename = options.get(b'filename')
+        is_file = options.get(b'name') == b'file' or filename is not None
+        # Si importa solo il primo file del form
+        self._in_file = is_file and not self._file_seen
+        if self._in_file:
+            self._file_seen = True
+            if filename:
+                self.filename = filename.decode('utf-8', 'replace')
+
+    def _on_part_data(self, data: bytes, start: int, end: int):
+        if self._in_file:
+            self._chunks.append(data[start:end])
+
+    def _on_part_end(self):
+        self._in_file = False
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self.request.stream():
+            if not chunk:
+                continue
+            self.bytes_received += len(chunk)
+            if self._multipart is None:
+                yield chunk
+                continue
+
+            self._multipart.write(chunk)
+            if self._chunks:
+                chunks, self._chunks = self._chunks, []
+                yield b''.join(chunks)
+
+        if self._multipart is not None:
+            self._multipart.finalize()
+            if not self._file_seen:
+                raise ValueError("No file found in the upload")
+
+class ChannelBatchWriter:
+    """Insert parsed channels into a playlist in bulk, one short transaction per batch.
+
+    Committing per batch keeps the SQLite write lock free between batches, so a
+    large import does not block other users' edits for its whole duration.
+    """
+
+    def __init__(self, repo, user_id: int, playlist_id: int, batch_size: int = IMPORT_BATCH_SIZE):
+        self.repo = repo
+        self.user_id = user_id
+        self.playlist_id = playlist_id
+        self.batch_size = batch_size
+        self.written = 0
+        self._batch: List[M3UChannel] = []
+
+    async def add(self, channels: List[M3UChannel]):
+        self._batch.extend(channels)
+        if len(self._batch) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        if not self._batch:
+            return
+        batch, self._batch = self._batch, []
+        await self.repo.insert_channels(self.user_id, self.playlist_id, batch)
+        self.written += len(batch)
+        logo_cache.prefetch(channel.logo for channel in batch)
+
+async def import_upload(upload: UploadStream, writer: ChannelBatchWriter) -> M3UStreamParser:
+    """Decode, parse and write an upload as it streams in; returns the finished parser"""
+    decoder = codecs.getincrementaldecoder('utf-8-sig')(errors='replace')
+    parser = M3UStreamParser()
+    async for chunk in upload:
+        await writer.add(parser.feed(decoder.decode(chunk)))
+    await writer.add(parser.feed(decoder.decode(b'', final=True)))
+    await writer.add(parser.close())
+    await writer.flush()
+    return parser
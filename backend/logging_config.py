@@ -0,0 +1,58 @@
+"""Structured logging setup.
+
+Fields passed with `extra={...}` are rendered as key=value pairs (or as JSON
+when LOG_FORMAT=json), e.g.:
+
+    logger.info("sync completed", extra={"playlist_id": 3, "channels": 1200})
+"""
+import json
+import logging
+import os
+
+# Attributi standard di LogRecord: tutto il resto arriva da `extra`
+_RESERVED = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+def _fields(record: logging.LogRecord) -> dict:
+    return {k: v for k, v in vars(record).items() if k not in _RESERVED}
+
+class KeyValueFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        parts = [
+            self.formatTime(record),
+            f"level={record.levelname}",
+            f"logger={record.name}",
+            f"msg={json.dumps(record.getMessage(), ensure_ascii=False)}",
+        ]
+        for key, value in _fields(record).items():
+            if isinstance(value, str) and (' ' in value or '"' in value or not value):
+                value = json.dumps(value, ensure_ascii=False)
+            parts.append(f"{key}={value}")
+        line = ' '.join(parts)
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        data.update(_fields(record))
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+def setup_logging():
+    """Configure the root logger from LOG_LEVEL (default INFO) and LOG_FORMAT (kv|json)"""
+    handler = logging.StreamHandler()
+    if os.getenv("LOG_FORMAT", "kv").lower() == "json":
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(KeyValueFormatter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
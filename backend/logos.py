@@ -0,0 +1,347 @@
+"""Logo proxy: channel logos fetched once, stored as thumbnails and served locally.
+
+Without it every client downloads each tvg-logo straight from the providers,
+thousands of requests per playlist load, many of them slow or dead. Logos are
+fetched in the background by a few concurrent workers, deduplicated by the hash
+of their URL, resized when Pillow is installed and kept on disk (LOGO_CACHE_DIR)
+up to LOGO_CACHE_MAX_BYTES, evicting the least recently served first.
+
+Each entry is the image plus a JSON sidecar (source URL, content type, fetch
+time), so any worker and a restarted process can serve it. Every worker keeps
+its own index of the entries it has seen: with several workers the size cap is
+enforced per worker, on the entries each one knows about.
+
+With LOGO_PROXY_URL set (the public base URL of the API), public playlists point
+their logos to LOGO_PROXY_URL/logos/{hash} and the logos of synced or imported
+playlists are prefetched.
+"""
+from typing import Dict, Iterable, List, Optional, Tuple
+from collections import OrderedDict
+from pathlib import Path
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import time
+
+import aiohttp
+
+try:
+    from PIL import Image
+except ImportError:  # Senza Pillow i logo vengono salvati così come arrivano
+    Image = None
+
+from database import DATABASE_PATH
+from m3u_utils import M3UChannel
+from metrics import LOGO_CACHE_BYTES, LOGO_FETCHES
+
+logger = logging.getLogger(__name__)
+
+LOGO_HASH = re.compile(r'^[0-9a-f]{32}$')
+
+# Un logo valido viene riscaricato dopo MAX_AGE, uno non raggiungibile dopo RETRY
+LOGO_MAX_AGE_SECONDS = 30 * 24 * 3600
+LOGO_RETRY_SECONDS = 24 * 3600
+# Frequenza massima di aggiornamento dell'mtime (orologio dell'LRU) per logo
+TOUCH_INTERVAL_SECONDS = 3600
+
+_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'\x00\x00\x01\x00', 'image/x-icon'),
+)
+
+# Solo immagini raster: un SVG servito dalla nostra origine può eseguire script
+SERVED_TYPES = frozenset([content_type for _, content_type in _SIGNATURES] + ['image/webp'])
+
+def logo_hash(url: str) -> str:
+    return hashlib.sha256(url.encode()).hexdigest()[:32]
+
+def sniff_image_type(data: bytes) -> Optional[str]:
+    """Content type from the first bytes (providers often send application/octet-stream)"""
+    for signature, content_type in _SIGNATURES:
+        if data.startswith(signature):
+            return content_type
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    head = data[:512].lstrip().lower()
+    if head.startswith(b'<svg') or (head.startswith(b'<?xml') and b'<svg' in head):
+        return 'image/svg+xml'
+    return None
+
+def make_thumbnail(data: bytes, size: int) -> Tuple[bytes, str]:
+    """Fit an image in size x size as PNG (without Pillow it is kept as it is); SVG is refused"""
+    content_type = sniff_image_type(data)
+    if content_type not in SERVED_TYPES:
+        raise ValueError("not a raster image" if content_type else "not an image")
+    if Image is None:
+        return data, content_type
+
+    with Image.open(io.BytesIO(data)) as image:
+        # JPEG: decodifica direttamente a una risoluzione ridotta
+        image.draft('RGB', (size, size))
+        image.thumbnail((size, size))
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA')
+        output = io.BytesIO()
+        image.save(output, 'PNG', optimize=True)
+    return output.getvalue(), 'image/png'
+
+class LogoEntry:
+    __slots__ = ('url', 'content_type', 'fetched_at', 'size', 'touched_at')
+
+    def __init__(self, url: str, content_type: Optional[str], fetched_at: float, size: int, touched_at: float):
+        self.url = url
+        self.content_type = content_type  # None: logo non raggiungibile
+        self.fetched_at = fetched_at
+        self.size = size
+        self.touched_at = touched_at
+
+    @property
+    def available(self) -> bool:
+        # Anche gli SVG salvati prima che venissero rifiutati restano fuori
+        return self.content_type in SERVED_TYPES
+
+    def stale(self, now: float) -> bool:
+        max_age = LOGO_MAX_AGE_SECONDS if self.available else LOGO_RETRY_SECONDS
+        return now - self.fetched_at > max_age
+
+class LogoCache:
+    def __init__(self, directory: Path, max_bytes: int, thumbnail_size: int,
+                 concurrency: int, timeout: float, max_source_bytes: int,
+                 queue_size: int, proxy_url: Optional[str] = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.thumbnail_size = thumbnail_size
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_source_bytes = max_source_bytes
+        self.proxy_url = proxy_url.rstrip('/') if proxy_url else None
+        self.size = 0
+        self._entries: "OrderedDict[str, LogoEntry]" = OrderedDict()
+        # Logo in coda o in download: hash -> URL di origine
+        self._pending: Dict[str, str] = {}
+        self._queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self._workers: List[asyncio.Task] = []
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.proxy_url is not None
+
+    def _paths(self, key: str) -> Tuple[Path, Path]:
+        folder = self.directory / key[:2]
+        return folder / key, folder / f"{key}.json"
+
+    def image_path(self, key: str) -> Path:
+        return self._paths(key)[0]
+
+    async def start(self):
+        if not self.enabled:
+            return
+        entries = await asyncio.to_thread(self._scan)
+        for key, entry in sorted(entries.items(), key=lambda item: item[1].touched_at):
+            self._entries[key] = entry
+            self.size += entry.size
+        LOGO_CACHE_BYTES.set(self.size)
+        self._session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            connector=aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=4)
+        )
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def close(self):
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    # Indice su disco
+    def _read_entry(self, key: str) -> Optional[LogoEntry]:
+        image_path, meta_path = self._paths(key)
+        try:
+            meta = json.loads(meta_path.read_text())
+            if meta['content_type'] is None:
+                return LogoEntry(meta['url'], None, meta['fetched_at'], meta_path.stat().st_size, meta['fetched_at'])
+            stat = image_path.stat()
+        except (OSError, ValueError, KeyError):
+            return None
+        return LogoEntry(meta['url'], meta['content_type'], meta['fetched_at'],
+                         stat.st_size + meta_path.stat().st_size, stat.st_mtime)
+
+    def _scan(self) -> Dict[str, LogoEntry]:
+        entries = {}
+        if self.directory.exists():
+            for meta_path in self.directory.glob('*/*.json'):
+                key = meta_path.stem
+                entry = self._read_entry(key) if LOGO_HASH.match(key) else None
+                if entry is not None:
+                    entries[key] = entry
+        return entries
+
+    def _write(self, key: str, url: str, data: Optional[bytes], content_type: Optional[str], fetched_at: float) -> int:
+        image_path, meta_path = self._paths(key)
+        image_path.parent.mkdir(parents=True, exist_ok=True)
+        size = 0
+        if data is not None:
+            # Scrittura atomica: gli altri worker non leggono mai un file a metà
+            tmp = image_path.with_name(f"{key}.{os.getpid()}.tmp")
+            tmp.write_bytes(data)
+            os.replace(tmp, image_path)
+            size += len(data)
+        meta = json.dumps({"url": url, "content_type": content_type, "fetched_at": fetched_at}).encode()
+        tmp = meta_path.with_name(f"{key}.json.{os.getpid()}.tmp")
+        tmp.write_bytes(meta)
+        os.replace(tmp, meta_path)
+        return size + len(meta)
+
+    def _delete(self, keys: List[str]):
+        for key in keys:
+            for path in self._paths(key):
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+
+    def _add(self, key: str, entry: LogoEntry) -> List[str]:
+        """Index an entry and return the keys evicted to stay under max_bytes"""
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.size -= previous.size
+        self._entries[key] = entry
+        self.size += entry.size
+        evicted = []
+        while self.size > self.max_bytes and len(self._entries) > 1:
+            old_key, old = self._entries.popitem(last=False)
+            self.size -= old.size
+            evicted.append(old_key)
+        LOGO_CACHE_BYTES.set(self.size)
+        return evicted
+
+    # Download
+    def schedule(self, url: str) -> Optional[str]:
+        """Queue a logo for download unless it is fresh or already queued.
+
+        Returns its hash when the proxy can serve it (cached, or queued and
+        redirected meanwhile), None when it is unreachable or the queue is full.
+        """
+        key = logo_hash(url)
+        if key in self._pending:
+            return key
+        entry = self._entries.get(key)
+        if entry is not None and not entry.stale(time.time()):
+            return key if entry.available else None
+        try:
+            self._queue.put_nowait((key, url))
+        except asyncio.QueueFull:
+            return key if entry is not None and entry.available else None
+        self._pending[key] = url
+        return key
+
+    def prefetch(self, urls: Iterable[Optional[str]]):
+        if not self.enabled:
+            return
+        for url in set(urls):
+            if url:
+                self.schedule(url)
+
+    def rewrite(self, channels: List[M3UChannel]) -> List[M3UChannel]:
+        """Point the logos of freshly loaded channels to the proxy (unreachable ones are left as they are)"""
+        for channel in channels:
+            if channel.logo:
+                key = self.schedule(channel.logo)
+                if key is not None:
+                    channel.logo = f"{self.proxy_url}/logos/{key}"
+        return channels
+
+    def pending_source(self, key: str) -> Optional[str]:
+        return self._pending.get(key)
+
+    async def _worker(self):
+        while True:
+            key, url = await self._queue.get()
+            try:
+                await self._fetch(key, url)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("logo store failed", extra={"url": url})
+            finally:
+                self._pending.pop(key, None)
+                self._queue.task_done()
+
+    async def _download(self, url: str) -> bytes:
+        async with self._session.get(url) as response:
+            if response.status != 200:
+                raise ValueError(f"HTTP {response.status}")
+            data = await response.content.read(self.max_source_bytes + 1)
+            if len(data) > self.max_source_bytes:
+                raise ValueError("logo too large")
+            return data
+
+    async def _fetch(self, key: str, url: str):
+        fetched_at = time.time()
+        try:
+            data = await self._download(url)
+            data, content_type = await asyncio.to_thread(make_thumbnail, data, self.thumbnail_size)
+            LOGO_FETCHES.inc(result="ok")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Anche il fallimento viene salvato: il logo non viene richiesto di nuovo fino al retry
+            logger.debug("logo fetch failed", extra={"url": url, "error": str(e)})
+            LOGO_FETCHES.inc(result="failed")
+            data, content_type = None, None
+
+        size = await asyncio.to_thread(self._write, key, url, data, content_type, fetched_at)
+        evicted = self._add(key, LogoEntry(url, content_type, fetched_at, size, fetched_at))
+        if evicted:
+            await asyncio.to_thread(self._delete, evicted)
+
+    # Lettura
+    async def lookup(self, key: str) -> Optional[LogoEntry]:
+        """Entry of a logo, also when it was stored by another worker; marks it as recently used"""
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = await asyncio.to_thread(self._read_entry, key)
+            if entry is None:
+                return None
+            evicted = self._add(key, entry)
+            if evicted:
+                await asyncio.to_thread(self._delete, evicted)
+        else:
+            self._entries.move_to_end(key)
+
+        now = time.time()
+        if entry.available and now - entry.touched_at > TOUCH_INTERVAL_SECONDS:
+            # L'mtime ordina l'LRU anche dopo un riavvio
+            entry.touched_at = now
+            try:
+                await asyncio.to_thread(os.utime, self.image_path(key))
+            except FileNotFoundError:
+                # Rimosso dall'LRU di un altro worker
+                self._entries.pop(key, None)
+                self.size -= entry.size
+                return None
+        if entry.stale(now):
+            self.schedule(entry.url)
+        return entry
+
+logo_cache = LogoCache(
+    directory=Path(os.getenv("LOGO_CACHE_DIR", str(DATABASE_PATH.parent / "logos"))),
+    max_bytes=int(os.getenv("LOGO_CACHE_MAX_BYTES", 256 * 1024 * 1024)),
+    thumbnail_size=int(os.getenv("LOGO_SIZE", 256)),
+    concurrency=int(os.getenv("LOGO_FETCH_CONCURRENCY", 8)),
+    timeout=float(os.getenv("LOGO_FETCH_TIMEOUT_SECONDS", 10)),
+    max_source_bytes=int(os.getenv("LOGO_MAX_SOURCE_BYTES", 2 * 1024 * 1024)),
+    queue_size=int(os.getenv("LOGO_QUEUE_SIZE", 20000)),
+    proxy_url=os.getenv("LOGO_PROXY_URL") or None
+)
@@ -1,16 +1,40 @@
 from typing import List, Dict, Optional
+from concurrent.futures import ProcessPoolExecutor
+import os
 import re
+import sys
+
+class _EmptyTags(dict):
+    """Read-only empty mapping shared by every channel without extra tags"""
+    __slots__ = ()
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("the shared empty tag map is read-only")
+
+    __setitem__ = __delitem__ = _readonly
+    update = setdefault = pop = popitem = clear = _readonly
+
+EMPTY_TAGS = _EmptyTags()
 
 class M3UChannel:
+    # Niente __dict__ per istanza: con playlist da centinaia di migliaia di canali fa la differenza
+    __slots__ = ('name', 'url', 'group', 'logo', 'tvg_id', 'extra_tags', 'position', 'attributes')
+
     def __init__(self, name: str, url: str, group: Optional[str] = None, 
                  logo: Optional[str] = None, tvg_id: Optional[str] = None,
-                 extra_tags: Optional[Dict[str, str]] = None):
+                 extra_tags: Optional[Dict[str, str]] = None,
+                 position: Optional[int] = None,
+                 attributes: Optional[Dict[str, str]] = None):
         self.name = name
         self.url = url
-        self.group = group
+        # I gruppi si ripetono su molti canali: condividi una sola stringa
+        self.group = sys.intern(group) if group else group
         self.logo = logo
         self.tvg_id = tvg_id
-        self.extra_tags = extra_tags or {}
+        self.extra_tags = extra_tags or EMPTY_TAGS
+        self.position = position
+        # Attributi #EXTINF non standard (tvg-name, tvg-chno, catchup, ...) conservati così come sono
+        self.attributes = attributes or EMPTY_TAGS
 
     def to_dict(self) -> Dict:
         return {
@@ -19,123 +43,276 @@ class M3UChannel:
             "group": self.group,
             "logo": self.logo,
             "tvg_id": self.tvg_id,
-            "extra_tags": self.extra_tags
+            "extra_tags": self.extra_tags,
+            "position": self.position,
+            "attributes": self.attributes
         }
 
-def parse_m3u(content: str) -> List[M3UChannel]:
-    """Parse M3U content and return a list of channels"""
+_EPG_URL_RE = re.compile(r'x-tvg-url="([^"]+)"')
+_DURATION_RE = re.compile(r'-?\d+')
+_ATTRIBUTE_RE = re.compile(r'([\w-]+)="([^"]*)"')
+_TAG_RE = re.compile(r'#([^:]+):(.+)')
+
+class _ParseState:
+    """Parser state carried between batches of lines (tra #EXTINF e la riga con l'URL)"""
+    __slots__ = ('in_channel', 'name', 'group', 'logo', 'tvg_id', 'attributes',
+                 'channel_tags', 'extra_tags', 'position')
+
+    def __init__(self):
+        self.in_channel = False
+        self.name = self.group = self.logo = self.tvg_id = self.attributes = None
+        self.channel_tags = EMPTY_TAGS
+        self.extra_tags = None
+        self.position = 0
+
+def _parse_lines(lines, state: _ParseState) -> List[M3UChannel]:
+    """Parse an iterable of lines, resuming from and updating `state`"""
     channels = []
-    current_channel = None
-    extra_tags = {}
-    
-    # Tieni traccia della posizione per l'ordinamento
-    position = 0
+    append = channels.append
+    intern = sys.intern
+
+    # Lo stato vive in variabili locali durante il ciclo: molto più veloce degli attributi
+    in_channel = state.in_channel
+    name, group, logo, tvg_id = state.name, state.group, state.logo, state.tvg_id
+    attributes = state.attributes
+    channel_tags = state.channel_tags
+    extra_tags = state.extra_tags
+    position = state.position
     
-    for line in content.splitlines():
+    for line in lines:
         line = line.strip()
         
         if not line:
             continue
 
-        if line.startswith('#EXTM3U'):
-            # Cerca l'URL dell'EPG se presente
-            epg_match = re.search(r'x-tvg-url="([^"]+)"', line)
-            if epg_match:
-                extra_tags['epg_url'] = epg_match.group(1)
+        if line[0] != '#':
+            if in_channel:
+                position += 1
+                append(M3UChannel(name, line, group, logo, tvg_id, channel_tags, position, attributes))
+            in_channel = False
+            extra_tags = None  # Reset for next channel
             continue
-            
+
         if line.startswith('#EXTINF:'):
-            position += 1  # Incrementa la posizione per ogni nuovo canale
             # Parse channel info
             info = line[8:]  # Remove '#EXTINF:'
             
             # Extract duration if present
-            duration_match = re.match(r'-?\d+', info)
+            duration_match = _DURATION_RE.match(info)
             if duration_match:
-                info = info[len(duration_match.group(0)):].strip(',').strip()
+                info = info[duration_match.end():].strip(',').strip()
             
             # Parse attributes
-            attributes = {}
-            if 'tvg-' in info or 'group-' in info:
-                attrs_pattern = r'([\w-]+)="([^"]*)"'
-                for match in re.finditer(attrs_pattern, info):
-                    key, value = match.groups()
-                    attributes[key] = value
+            group = logo = tvg_id = attributes = None
+            # Qualsiasi attributo, non solo tvg-*/group-*: catchup="..." o user-agent="..." da soli restano attributi
+            if '="' in info:
+                for key, value in _ATTRIBUTE_RE.findall(info):
+                    if key == 'group-title':
+                        group = value
+                    elif key == 'tvg-logo':
+                        logo = value
+                    elif key == 'tvg-id':
+                        tvg_id = value
+                    else:
+                        if attributes is None:
+                            attributes = {}
+                        attributes[intern(key)] = value
                 
                 # Remove attributes from info string
-                info = re.sub(r'[\w-]+="[^"]*"', '', info).strip()
+                info = _ATTRIBUTE_RE.sub('', info).strip()
             
             # The remaining info is the channel name
             name = info.strip()
             if name.startswith(','):
                 name = name[1:].strip()
-            
-            current_channel = {
-                'name': name,
-                'group': attributes.get('group-title'),
-                'logo': attributes.get('tvg-logo'),
-                'tvg_id': attributes.get('tvg-id'),
-                'position': position,
-                'extra_tags': extra_tags.copy()
-            }
-            extra_tags = {}  # Reset for next channel
+
+            # I tag raccolti prima di #EXTINF appartengono a questo canale
+            channel_tags = extra_tags or EMPTY_TAGS
+            extra_tags = None
+            in_channel = True
+
+        elif line.startswith('#EXTM3U'):
+            # Cerca l'URL dell'EPG se presente
+            epg_match = _EPG_URL_RE.search(line)
+            if epg_match:
+                if extra_tags is None:
+                    extra_tags = {}
+                extra_tags['epg_url'] = epg_match.group(1)
             
         elif line.startswith('#EXTGRP:'):
-            if current_channel:
-                current_channel['group'] = line[8:].strip()
+            if in_channel:
+                group = line[8:].strip()
         
         # Gestione tag aggiuntivi
-        elif line.startswith('#'):
-            tag_match = re.match(r'#([^:]+):(.+)', line)
+        else:
+            tag_match = _TAG_RE.match(line)
             if tag_match:
                 tag_name, tag_value = tag_match.groups()
-                extra_tags[tag_name] = tag_value.strip()
-                
-        elif not line.startswith('#') and line:
-            if current_channel:
-                channels.append(M3UChannel(
-                    name=current_channel['name'],
-                    url=line,
-                    group=current_channel['group'],
-                    logo=current_channel['logo'],
-                    tvg_id=current_channel['tvg_id'],
-                    extra_tags=current_channel['extra_tags']
-                ))
-            current_channel = None
-            extra_tags = {}  # Reset for next channel
+                if extra_tags is None:
+                    extra_tags = {}
+                extra_tags[intern(tag_name)] = intern(tag_value.strip())
 
+    state.in_channel = in_channel
+    state.name, state.group, state.logo, state.tvg_id = name, group, logo, tvg_id
+    state.attributes = attributes
+    state.channel_tags = channel_tags
+    state.extra_tags = extra_tags
+    state.position = position
     return channels
 
-def generate_m3u(channels: List[M3UChannel], epg_url: Optional[str] = None) -> str:
-    """Generate M3U content from a list of channels"""
-    content = []
-    
+def parse_m3u(content: str) -> List[M3UChannel]:
+    """Parse M3U content and return a list of channels"""
+    return _parse_lines(content.splitlines(), _ParseState())
+
+class M3UStreamParser:
+    """Incremental M3U parser: feed text chunks as they arrive and collect finished channels.
+
+    Only the trailing partial line is buffered between calls, so arbitrarily large
+    playlists can be parsed without holding the whole text in memory.
+    """
+
+    def __init__(self):
+        self._state = _ParseState()
+        self._pending = ''
+
+    @property
+    def count(self) -> int:
+        return self._state.position
+
+    def feed(self, text: str) -> List[M3UChannel]:
+        if self._pending:
+            text = self._pending + text
+        lines = text.splitlines(True)
+        # L'ultima riga potrebbe continuare nel prossimo chunk
+        if lines and lines[-1] == lines[-1].rstrip('\r\n'):
+            self._pending = lines.pop()
+        else:
+            self._pending = ''
+        return _parse_lines(lines, self._state)
+
+    def close(self) -> List[M3UChannel]:
+        lines = [self._pending] if self._pending else []
+        self._pending = ''
+        return _parse_lines(lines, self._state)
+
+# Oltre questa dimensione (in caratteri) il parsing viene distribuito su più processi
+PARALLEL_PARSE_THRESHOLD = int(os.getenv("M3U_PARALLEL_THRESHOLD", 8 * 1024 * 1024))
+PARALLEL_PARSE_WORKERS = int(os.getenv("M3U_PARALLEL_WORKERS", os.cpu_count() or 1))
+
+_parse_pool: Optional[ProcessPoolExecutor] = None
+
+def _get_parse_pool() -> ProcessPoolExecutor:
+    global _parse_pool
+    if _parse_pool is None:
+        _parse_pool = ProcessPoolExecutor(max_workers=PARALLEL_PARSE_WORKERS)
+    return _parse_pool
+
+def split_m3u(content: str, shards: int) -> List[str]:
+    """Split M3U content into roughly equal shards at #EXTINF record boundaries.
+
+    Each cut is placed right after a URL line, where the parser holds no pending
+    channel or tags, so parsing the shards independently gives the same result as
+    parsing the whole content. Tag lines preceding an #EXTINF stay with it.
+    """
+    if shards <= 1:
+        return [content]
+
+    target = len(content) // shards
+    pieces = []
+    start = 0
+    for k in range(1, shards):
+        probe = max(k * target, start)
+        extinf = content.find('\n#EXTINF', probe)
+        if extinf == -1:
+            break
+
+        # Risali oltre le righe di commento che precedono #EXTINF
+        cut = extinf + 1
+        while cut > start:
+            line_start = max(content.rfind('\n', start, cut - 1) + 1, start)
+            line = content[line_start:cut - 1].strip()
+            if line and line[0] != '#':
+                break
+            cut = line_start
+
+        if cut > start:
+            pieces.append(content[start:cut])
+            start = cut
+
+    pieces.append(content[start:])
+    return pieces
+
+def _parse_shard(content: str) -> List[tuple]:
+    """Worker entry point: parse a shard and return plain tuples, much cheaper to pickle than objects"""
+    return [
+        (c.name, c.url, c.group, c.logo, c.tvg_id, c.extra_tags or None, c.attributes or None)
+        for c in parse_m3u(content)
+    ]
+
+def parse_m3u_parallel(content: str, workers: Optional[int] = None) -> List[M3UChannel]:
+    """Parse M3U content split in shards across a process pool, preserving order and positions"""
+    workers = workers or PARALLEL_PARSE_WORKERS
+    # Più shard che worker: il processo principale ricostruisce i canali di uno shard
+    # mentre gli altri sono ancora in elaborazione
+    shards = split_m3u(content, workers * 4)
+    if len(shards) == 1:
+        return parse_m3u(content)
+
+    channels = []
+    append = channels.append
+    for rows in _get_parse_pool().map(_parse_shard, shards):
+        position = len(channels)
+        for name, url, group, logo, tvg_id, extra_tags, attributes in rows:
+            position += 1
+            append(M3UChannel(name, url, group, logo, tvg_id, extra_tags, position, attributes))
+    return channels
+
+def parse_m3u_auto(content: str) -> List[M3UChannel]:
+    """Parse M3U content, in parallel when it is larger than PARALLEL_PARSE_THRESHOLD"""
+    if PARALLEL_PARSE_WORKERS > 1 and len(content) >= PARALLEL_PARSE_THRESHOLD:
+        return parse_m3u_parallel(content)
+    return parse_m3u(content)
+
+def format_m3u_header(epg_url: Optional[str] = None) -> str:
+    """Return the #EXTM3U header line"""
     # Aggiungi header con EPG se presente
     if epg_url:
-        content.append(f'#EXTM3U x-tvg-url="{epg_url}"')
-    else:
-        content.append('#EXTM3U')
-    
-    for channel in channels:
-        # Add extra tags first
-        for tag_name, tag_value in channel.extra_tags.items():
+        return f'#EXTM3U x-tvg-url="{epg_url}"'
+    return '#EXTM3U'
+
+def format_m3u_entry(channel: M3UChannel, plus: bool = False) -> str:
+    """Return the lines of a single channel entry (without trailing newline).
+
+    With `plus` the non-standard #EXTINF attributes kept by the parser are written
+    back too, so the entry round-trips without losing information.
+    """
+    lines = []
+
+    # Add extra tags first
+    extra_tags = channel.extra_tags
+    if extra_tags:
+        for tag_name, tag_value in extra_tags.items():
             if tag_name != 'epg_url':  # Skip EPG URL as it's handled in the header
-                content.append(f'#{tag_name}:{tag_value}')
-            
-        # Add standard attributes
-        attributes = []
-        if channel.tvg_id:
-            attributes.append(f'tvg-id="{channel.tvg_id}"')
-        if channel.group:
-            attributes.append(f'group-title="{channel.group}"')
-        if channel.logo:
-            attributes.append(f'tvg-logo="{channel.logo}"')
-            
-        attrs_str = ' '.join(attributes)
-        if attrs_str:
-            attrs_str = ' ' + attrs_str
-            
-        content.append(f'#EXTINF:-1{attrs_str},{channel.name}')
-        content.append(channel.url)
-    
+                lines.append(f'#{tag_name}:{tag_value}')
+
+    # Add standard attributes
+    attrs_str = ''
+    if channel.tvg_id:
+        attrs_str += f' tvg-id="{channel.tvg_id}"'
+    if plus and channel.attributes:
+        for key, value in channel.attributes.items():
+            attrs_str += f' {key}="{value}"'
+    if channel.group:
+        attrs_str += f' group-title="{channel.group}"'
+    if channel.logo:
+        attrs_str += f' tvg-logo="{channel.logo}"'
+
+    lines.append(f'#EXTINF:-1{attrs_str},{channel.name}')
+    lines.append(channel.url)
+    return '\n'.join(lines)
+
+def generate_m3u(channels: List[M3UChannel], epg_url: Optional[str] = None, plus: bool = False) -> str:
+    """Generate M3U content from a list of channels"""
+    content = [format_m3u_header(epg_url)]
+    content.extend(format_m3u_entry(channel, plus) for channel in channels)
     return '\n'.join(content)
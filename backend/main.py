@@ -1,29 +1,44 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, Request, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import PlainTextResponse
+from fastapi.responses import StreamingResponse, Response, PlainTextResponse, FileResponse, RedirectResponse
 from fastapi.security import OAuth2PasswordRequestForm
-from typing import List, Dict
-import aiohttp
-import asyncio
+from typing import List, Dict, Optional
 from datetime import datetime, timedelta
+import asyncio
 import uuid
-import json
-import sqlite3
+import logging
+import time
 
-from database import get_db, init_db
+from repository import repo, DuplicateChannelError, CHANNEL_FIELDS
 from models import (
     Token, User, UserCreate,
     PlaylistCreate, PlaylistUpdate, Playlist,
     ChannelCreate, ChannelUpdate, Channel,
-    ChannelOrder, CustomPlaylistChannelAdd
+    ChannelOrder, CustomPlaylistChannelAdd, PlaylistRules,
+    ChannelGroup, GroupRename, GroupVisibility, GroupMove
 )
-from m3u_utils import parse_m3u, generate_m3u, M3UChannel
+from sync_jobs import SyncJob, SyncError, run_sync, sync_jobs
+from importer import UploadStream, ChannelBatchWriter, import_upload
+from exporters import EXPORTERS, get_exporter, stream_export, render_changes
+from render_cache import render_cache
+from cache import cache
+from logos import logo_cache, LOGO_HASH
+from playback import playback_index
+from admission import admit_public, admit_play, render_slots, SlotStreamingResponse
+from publisher import publisher
+from maintenance import maintenance
+from logging_config import setup_logging
+import profiler
+from metrics import render_metrics, REQUEST_SECONDS, LOGO_REQUESTS
 from auth import (
     authenticate_user, create_access_token, 
-    get_current_user, get_current_user_id,
+    get_current_user, get_current_user_id, get_stream_user_id, require_admin,
     ACCESS_TOKEN_EXPIRE_MINUTES
 )
 
+setup_logging()
+logger = logging.getLogger(__name__)
+
 app = FastAPI(title="OMG Playlist Manager")
 
 # CORS setup
@@ -35,6 +50,74 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+async def _profiled_body(body, profile):
+    try:
+        async for chunk in body:
+            yield chunk
+    finally:
+        profiler.report.add(profile)
+
+# Latenza delle richieste per route (il template, non il path: niente esplosione di label)
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    started = time.perf_counter()
+    status_code = 500
+    profile = profiler.start_request(request.scope) if profiler.ENABLED else None
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        if profile is not None:
+            # Le risposte in streaming eseguono query anche dopo il return
+            response.body_iterator = _profiled_body(response.body_iterator, profile)
+            profile = None
+        return response
+    finally:
+        if profile is not None:
+            profiler.report.add(profile)
+        route = request.scope.get("route")
+        REQUEST_SECONDS.observe(
+            time.perf_counter() - started,
+            method=request.method,
+            route=route.path if route else "unmatched",
+            status=status_code
+        )
+
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+# Profilo SQL per route (attivo solo con SQL_PROFILE=1)
+@app.get("/admin/sql-profile")
+async def get_sql_profile(
+    limit: int = 10,
+    route: Optional[str] = None,
+    admin: User = Depends(require_admin)
+):
+    return {
+        "enabled": profiler.ENABLED,
+        "slow_query_ms": profiler.SLOW_QUERY_SECONDS * 1000,
+        "routes": profiler.report.top(limit, route)
+    }
+
+@app.delete("/admin/sql-profile")
+async def reset_sql_profile(admin: User = Depends(require_admin)):
+    profiler.report.reset()
+    return {"message": "SQL profile reset"}
+
+# Manutenzione dei file SQLite: dimensioni, WAL e ultime operazioni
+@app.get("/admin/database")
+async def get_database_stats(admin: User = Depends(require_admin)):
+    return await asyncio.to_thread(maintenance.stats)
+
+@app.post("/admin/database/maintenance")
+async def run_database_maintenance(admin: User = Depends(require_admin)):
+    """Run a full maintenance pass now, without waiting for idle windows"""
+    if not maintenance.enabled:
+        raise HTTPException(status_code=400, detail="Database maintenance is not enabled")
+    if not await asyncio.to_thread(maintenance.run, True):
+        raise HTTPException(status_code=409, detail="A maintenance pass is already running")
+    return await asyncio.to_thread(maintenance.stats)
+
 # Health check endpoint
 @app.get("/")
 async def read_root():
@@ -43,12 +126,24 @@ async def read_root():
 # Initialize database on startup
 @app.on_event("startup")
 async def startup_event():
-    init_db()
+    await repo.init()
+    await cache.start()
+    await logo_cache.start()
+    await publisher.start()
+    await maintenance.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await maintenance.close()
+    await publisher.close()
+    await logo_cache.close()
+    await cache.close()
+    await repo.close()
 
 # Auth endpoints
 @app.post("/token", response_model=Token)
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
-    user = authenticate_user(form_data.username, form_data.password)
+    user = await authenticate_user(form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -68,79 +163,43 @@ async def read_users_me(current_user: User = Depends(get_current_user)):
 # Playlist routes
 @app.get("/playlists", response_model=List[Playlist])
 async def get_playlists(user_id: int = Depends(get_current_user_id)):
-    with get_db() as db:
-        cursor = db.cursor()
-        playlists = []
-        # Get only playlists for current user
-        for playlist in cursor.execute(
-            "SELECT * FROM playlists WHERE user_id = ? ORDER BY created_at",
-            (user_id,)
-        ).fetchall():
-            channels = cursor.execute("""
-                SELECT * FROM channels 
-                WHERE playlist_id = ? 
-                ORDER BY position, created_at
-            """, (playlist['id'],)).fetchall()
-            
-            playlist_dict = dict(playlist)
-            playlist_dict['channels'] = [dict(ch) for ch in channels]
-            playlists.append(playlist_dict)
-        
-        return playlists
+    return await repo.list_playlists(user_id)
 
 @app.post("/playlists", response_model=Playlist)
 async def create_playlist(
     playlist: PlaylistCreate,
     user_id: int = Depends(get_current_user_id)
 ):
-    with get_db() as db:
-        cursor = db.cursor()
-        cursor.execute(
-            """
-            INSERT INTO playlists 
-            (user_id, name, url, is_custom, public_token, epg_url)
-            VALUES (?, ?, ?, ?, ?, ?)
-            """,
-            (
-                user_id,
-                playlist.name,
-                playlist.url,
-                playlist.is_custom,
-                str(uuid.uuid4()) if playlist.is_custom else None,
-                playlist.epg_url
-            )
+    if playlist.rules is not None and not playlist.is_custom:
+        raise HTTPException(
+            status_code=400,
+            detail="Rules are only supported on custom playlists"
         )
-        
-        new_playlist = cursor.execute(
-            "SELECT * FROM playlists WHERE id = ?",
-            (cursor.lastrowid,)
-        ).fetchone()
-        
-        return dict(new_playlist)
+
+    return await repo.create_playlist(user_id, {
+        'name': playlist.name,
+        'url': playlist.url,
+        'is_custom': playlist.is_custom,
+        'public_token': str(uuid.uuid4()) if playlist.is_custom else None,
+        'epg_url': playlist.epg_url,
+        'rules': playlist.rules.model_dump() if playlist.rules else None
+    })
+
+async def _get_user_playlist(user_id: int, playlist_id: int, custom_only: bool = False) -> Dict:
+    playlist = await repo.get_playlist(user_id, playlist_id, custom_only=custom_only)
+    if not playlist:
+        detail = "Custom playlist not found" if custom_only else "Playlist not found"
+        raise HTTPException(status_code=404, detail=detail)
+    return playlist
 
 @app.get("/playlists/{playlist_id}", response_model=Playlist)
 async def get_playlist(
     playlist_id: int,
     user_id: int = Depends(get_current_user_id)
 ):
-    with get_db() as db:
-        playlist = db.execute(
-            "SELECT * FROM playlists WHERE id = ? AND user_id = ?",
-            (playlist_id, user_id)
-        ).fetchone()
-        
-        if not playlist:
-            raise HTTPException(status_code=404, detail="Playlist not found")
-        
-        channels = db.execute("""
-            SELECT * FROM channels 
-            WHERE playlist_id = ?
-            ORDER BY position, created_at
-        """, (playlist_id,)).fetchall()
-        
-        playlist_dict = dict(playlist)
-        playlist_dict['channels'] = [dict(ch) for ch in channels]
-        return playlist_dict
+    playlist_dict = dict(await _get_user_playlist(user_id, playlist_id))
+    playlist_dict['channels'] = await repo.get_playlist_channels(user_id, playlist_id)
+    return playlist_dict
 
 @app.put("/playlists/{playlist_id}", response_model=Playlist)
 async def update_playlist(
@@ -148,208 +207,139 @@ async def update_playlist(
     playlist: PlaylistUpdate,
     user_id: int = Depends(get_current_user_id)
 ):
-    with get_db() as db:
-        cursor = db.cursor()
-        
-        existing = cursor.execute(
-            "SELECT * FROM playlists WHERE id = ? AND user_id = ?",
-            (playlist_id, user_id)
-        ).fetchone()
-        
-        if not existing:
-            raise HTTPException(status_code=404, detail="Playlist not found")
-        
-        # Update only provided fields
-        update_fields = []
-        values = []
-        if playlist.name is not None:
-            update_fields.append("name = ?")
-            values.append(playlist.name)
-        if playlist.url is not None:
-            update_fields.append("url = ?")
-            values.append(playlist.url)
-        if playlist.epg_url is not None:
-            update_fields.append("epg_url = ?")
-            values.append(playlist.epg_url)
-        
-        if update_fields:
-            values.extend([playlist_id, user_id])
-            cursor.execute(
-                f"""
-                UPDATE playlists 
-                SET {', '.join(update_fields)}
-                WHERE id = ? AND user_id = ?
-                """,
-                tuple(values)
+    existing = await _get_user_playlist(user_id, playlist_id)
+
+    # Update only provided fields
+    fields = {}
+    if playlist.name is not None:
+        fields['name'] = playlist.name
+    if playlist.url is not None:
+        fields['url'] = playlist.url
+    if playlist.epg_url is not None:
+        fields['epg_url'] = playlist.epg_url
+    if playlist.rules is not None:
+        if not existing['is_custom']:
+            raise HTTPException(
+                status_code=400,
+                detail="Rules are only supported on custom playlists"
             )
-        
-        return await get_playlist(playlist_id, user_id)
+        fields['rules'] = playlist.rules.model_dump()
+
+    await repo.update_playlist(user_id, playlist_id, fields)
+    await render_cache.invalidate_user(user_id)
+    return await get_playlist(playlist_id, user_id)
 
 @app.delete("/playlists/{playlist_id}")
 async def delete_playlist(
     playlist_id: int,
     user_id: int = Depends(get_current_user_id)
 ):
-    with get_db() as db:
-        cursor = db.cursor()
-        
-        playlist = cursor.execute(
-            "SELECT * FROM playlists WHERE id = ? AND user_id = ?",
-            (playlist_id, user_id)
-        ).fetchone()
-        
-        if not playlist:
-            raise HTTPException(status_code=404, detail="Playlist not found")
-        
-        cursor.execute(
-            "DELETE FROM playlists WHERE id = ? AND user_id = ?",
-            (playlist_id, user_id)
-        )
-        return {"message": "Playlist deleted"}
+    playlist = await _get_user_playlist(user_id, playlist_id)
+    await repo.delete_playlist(user_id, playlist_id)
+    await publisher.unpublish(playlist['public_token'])
+    await render_cache.invalidate_user(user_id)
+    return {"message": "Playlist deleted"}
 
 # Playlist sync
+async def _get_syncable_playlist(playlist_id: int, user_id: int) -> Dict:
+    playlist = await _get_user_playlist(user_id, playlist_id)
+
+    if not playlist['url']:
+        raise HTTPException(status_code=400, detail="Playlist has no URL")
+
+    return playlist
+
 @app.post("/playlists/{playlist_id}/sync")
 async def sync_playlist(
     playlist_id: int,
     user_id: int = Depends(get_current_user_id)
 ):
-    print(f"Starting sync for playlist {playlist_id}")  # Debug log
-    
-    with get_db() as db:
-        cursor = db.cursor()
-        
-        playlist = cursor.execute(
-            "SELECT * FROM playlists WHERE id = ? AND user_id = ?",
-            (playlist_id, user_id)
-        ).fetchone()
-        
-        print(f"Found playlist: {playlist}")  # Debug log
-        
-        if not playlist:
-            raise HTTPException(status_code=404, detail="Playlist not found")
-        
-        if not playlist['url']:
-            raise HTTPException(status_code=400, detail="Playlist has no URL")
-        
-        try:
-            print(f"Fetching URL: {playlist['url']}")  # Debug log
-            async with aiohttp.ClientSession() as session:
-                async with session.get(playlist['url']) as response:
-                    if response.status != 200:
-                        raise HTTPException(
-                            status_code=400,
-                            detail=f"Failed to fetch playlist: HTTP {response.status}"
-                        )
-                        
-                    content = await response.text()
-                    print(f"Received content length: {len(content)}")  # Debug log
-                    print(f"First 200 chars: {content[:200]}")  # Debug log
-                    
-                    try:
-                        channels = parse_m3u(content)
-                        print(f"Parsed {len(channels)} channels")  # Debug log
-                    except Exception as e:
-                        print(f"Error parsing M3U: {str(e)}")  # Debug log
-                        raise HTTPException(
-                            status_code=400,
-                            detail=f"Failed to parse M3U content: {str(e)}"
-                        )
-                    
-                    try:
-                        print("Starting database transaction")  # Debug log
-                        cursor.execute("BEGIN TRANSACTION")
-                        
-                        # Mantieni i tvg_id e extra_tags esistenti
-                        existing_channels = {
-                            ch['url']: {
-                                'tvg_id': ch['tvg_id'],
-                                'extra_tags': ch['extra_tags']
-                            }
-                            for ch in cursor.execute(
-                                "SELECT url, tvg_id, extra_tags FROM channels WHERE playlist_id = ?",
-                                (playlist_id,)
-                            ).fetchall()
-                            if ch['tvg_id'] or ch['extra_tags']
-                        }
-                        
-                        # Clear existing channels
-                        cursor.execute(
-                            "DELETE FROM channels WHERE playlist_id = ?",
-                            (playlist_id,)
-                        )
-                        print("Deleted existing channels")  # Debug log
-                        
-                        # Insert new channels
-                        for i, channel in enumerate(channels):
-                            try:
-                                # Mantieni i dati esistenti se disponibili
-                                existing = existing_channels.get(channel.url, {})
-                                tvg_id = existing.get('tvg_id', channel.tvg_id)
-                                
-                                # Unisci gli extra_tags esistenti con quelli nuovi
-                                extra_tags = channel.extra_tags.copy()
-                                if 'extra_tags' in existing:
-                                    existing_extra = json.loads(existing['extra_tags'])
-                                    extra_tags.update(existing_extra)
-                                
-                                cursor.execute(
-                                    """
-                                    INSERT INTO channels 
-                                    (playlist_id, name, url, group_title, logo_url, 
-                                     tvg_id, position, extra_tags)
-                                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                                    """,
-                                    (
-                                        playlist_id, channel.name, channel.url,
-                                        channel.group, channel.logo, tvg_id,
-                                        i+1, json.dumps(extra_tags)
-                                    )
-                                )
-                            except Exception as e:
-                                print(f"Error inserting channel {i}: {str(e)}")  # Debug log
-                                print(f"Channel data: {channel.to_dict()}")  # Debug log
-                                raise
-                        
-                        print(f"Inserted {len(channels)} new channels")  # Debug log
-                        
-                        # Update last_sync
-                        cursor.execute(
-                            """
-                            UPDATE playlists 
-                            SET last_sync = CURRENT_TIMESTAMP
-                            WHERE id = ? AND user_id = ?
-                            """,
-                            (playlist_id, user_id)
-                        )
-                        
-                        cursor.execute("COMMIT")
-                        print("Transaction committed successfully")  # Debug log
-                        
-                    except Exception as e:
-                        print(f"Database error: {str(e)}")  # Debug log
-                        cursor.execute("ROLLBACK")
-                        raise HTTPException(
-                            status_code=500,
-                            detail=f"Database error during sync: {str(e)}"
-                        )
-                    
-            return {
-                "message": "Playlist synchronized successfully",
-                "channels_count": len(channels)
-            }
-            
-        except aiohttp.ClientError as e:
-            print(f"HTTP error: {str(e)}")  # Debug log
-            raise HTTPException(
-                status_code=400,
-                detail=f"Failed to fetch playlist: {str(e)}"
-            )
-        except Exception as e:
-            print(f"Unexpected error: {str(e)}")  # Debug log
-            raise HTTPException(
-                status_code=500,
-                detail=f"Error syncing playlist: {str(e)}"
-            )
+    playlist = await _get_syncable_playlist(playlist_id, user_id)
+
+    try:
+        return await run_sync(playlist, user_id, SyncJob(playlist_id, user_id))
+    except SyncError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+
+# Sync in background: risponde subito, il progresso arriva via SSE
+@app.post("/playlists/{playlist_id}/sync-jobs", status_code=202)
+async def start_sync_job(
+    playlist_id: int,
+    user_id: int = Depends(get_current_user_id)
+):
+    playlist = await _get_syncable_playlist(playlist_id, user_id)
+
+    job = await sync_jobs.start(playlist, user_id)
+    return job.snapshot()
+
+@app.get("/sync-jobs/{job_id}")
+async def get_sync_job(
+    job_id: str,
+    user_id: int = Depends(get_current_user_id)
+):
+    job = await sync_jobs.get(job_id, user_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Sync job not found")
+    return job.snapshot()
+
+@app.get("/sync-jobs/{job_id}/events")
+async def stream_sync_job_events(
+    job_id: str,
+    user_id: int = Depends(get_stream_user_id)
+):
+    job = await sync_jobs.get(job_id, user_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Sync job not found")
+    return StreamingResponse(
+        job.events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# Playlist import from file
+@app.post("/playlists/import")
+async def import_playlist(
+    request: Request,
+    name: Optional[str] = None,
+    epg_url: Optional[str] = None,
+    user_id: int = Depends(get_current_user_id)
+):
+    """Create a playlist from an uploaded M3U file, parsed and written while it streams in"""
+    try:
+        upload = UploadStream(request)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    playlist = await repo.create_playlist(user_id, {
+        'name': name or "Imported playlist",
+        'epg_url': epg_url
+    })
+    playlist_id = playlist['id']
+
+    writer = ChannelBatchWriter(repo, user_id, playlist_id)
+    try:
+        await import_upload(upload, writer)
+    except Exception as e:
+        logger.warning("playlist import failed", extra={"playlist_id": playlist_id, "error": str(e)})
+        # Rimuovi quanto scritto finora: l'import è tutto o niente
+        await repo.delete_playlist(user_id, playlist_id)
+        raise HTTPException(
+            status_code=400,
+            detail=f"Failed to import playlist: {str(e)}"
+        )
+
+    # Nome dal file caricato, se non indicato
+    if not name:
+        name = upload.filename.rsplit('.', 1)[0] if upload.filename else "Imported playlist"
+    await repo.finish_import(user_id, playlist_id, name, epg_url)
+    await render_cache.invalidate_user(user_id)
+
+    return {
+        "message": "Playlist imported successfully",
+        "playlist_id": playlist_id,
+        "channels_count": writer.written,
+        "bytes_received": upload.bytes_received
+    }
 
 # Channel management
 @app.post("/playlists/{playlist_id}/channels", response_model=Channel)
@@ -358,57 +348,27 @@ async def add_channel(
     channel: ChannelCreate,
     user_id: int = Depends(get_current_user_id)
 ):
-    with get_db() as db:
-        cursor = db.cursor()
-        
-        # Verifica che la playlist appartenga all'utente
-        playlist = cursor.execute(
-            "SELECT * FROM playlists WHERE id = ? AND user_id = ?",
-            (playlist_id, user_id)
-        ).fetchone()
-        
-        if not playlist:
-            raise HTTPException(status_code=404, detail="Playlist not found")
-            
-        try:
-            # Trova la posizione massima attuale
-            max_pos = cursor.execute(
-                """
-                SELECT MAX(position) as max_pos 
-                FROM channels 
-                WHERE playlist_id = ?
-                """,
-                (playlist_id,)
-            ).fetchone()
-            
-            next_pos = (max_pos['max_pos'] or 0) + 1 if max_pos else 1
-            
-            cursor.execute(
-                """
-                INSERT INTO channels 
-                (playlist_id, name, url, group_title, logo_url, position, tvg_id, extra_tags)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                """,
-                (
-                    playlist_id, channel.name, channel.url,
-                    channel.group_title, channel.logo_url, next_pos,
-                    channel.tvg_id, json.dumps(channel.extra_tags or {})
-                )
-            )
-            
-            new_channel = cursor.execute(
-                "SELECT * FROM channels WHERE id = ?",
-                (cursor.lastrowid,)
-            ).fetchone()
-            
-            return dict(new_channel)
-            
-        except Exception as e:
-            print(f"Error adding channel: {str(e)}")  # Debug log
-            raise HTTPException(
-                status_code=500,
-                detail=f"Failed to add channel: {str(e)}"
-            )
+    # Verifica che la playlist appartenga all'utente
+    await _get_user_playlist(user_id, playlist_id)
+
+    try:
+        new_channel = await repo.add_channel(user_id, playlist_id, channel.model_dump())
+    except Exception as e:
+        logger.exception("add channel failed", extra={"playlist_id": playlist_id})
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to add channel: {str(e)}"
+        )
+
+    await render_cache.invalidate_user(user_id)
+    return new_channel
+
+async def _get_user_channel(user_id: int, channel_id: int) -> Dict:
+    # Verifica che il canale appartenga a una playlist dell'utente
+    channel = await repo.get_channel(user_id, channel_id)
+    if not channel:
+        raise HTTPException(status_code=404, detail="Channel not found")
+    return channel
 
 @app.put("/channels/{channel_id}", response_model=Channel)
 async def update_channel(
@@ -416,83 +376,32 @@ async def update_channel(
     channel: ChannelUpdate,
     user_id: int = Depends(get_current_user_id)
 ):
-    with get_db() as db:
-        cursor = db.cursor()
-        
-        # Verifica che il canale appartenga a una playlist dell'utente
-        channel_data = cursor.execute("""
-            SELECT c.* 
-            FROM channels c
-            JOIN playlists p ON c.playlist_id = p.id
-            WHERE c.id = ? AND p.user_id = ?
-        """, (channel_id, user_id)).fetchone()
-        
-        if not channel_data:
-            raise HTTPException(status_code=404, detail="Channel not found")
-        
-        update_fields = []
-        values = []
-        
-        if channel.name is not None:
-            update_fields.append("name = ?")
-            values.append(channel.name)
-        if channel.url is not None:
-            update_fields.append("url = ?")
-            values.append(channel.url)
-        if channel.group_title is not None:
-            update_fields.append("group_title = ?")
-            values.append(channel.group_title)
-        if channel.logo_url is not None:
-            update_fields.append("logo_url = ?")
-            values.append(channel.logo_url)
-        if channel.tvg_id is not None:
-            update_fields.append("tvg_id = ?")
-            values.append(channel.tvg_id)
-        if channel.extra_tags is not None:
-            update_fields.append("extra_tags = ?")
-            values.append(json.dumps(channel.extra_tags))
-        
-        if update_fields:
-            values.append(channel_id)
-            cursor.execute(
-                f"""
-                UPDATE channels 
-                SET {', '.join(update_fields)}
-                WHERE id = ?
-                """,
-                tuple(values)
-            )
-            
-            updated_channel = cursor.execute(
-                "SELECT * FROM channels WHERE id = ?",
-                (channel_id,)
-            ).fetchone()
-            
-            return dict(updated_channel)
-        
-        return dict(channel_data)
+    channel_data = await _get_user_channel(user_id, channel_id)
+
+    fields = {
+        name: value
+        for name, value in channel.model_dump().items()
+        if name in CHANNEL_FIELDS and value is not None
+    }
+    if not fields:
+        return channel_data
+
+    updated_channel = await repo.update_channel(user_id, channel_id, fields)
+    if updated_channel is None:
+        # Cancellato nel frattempo
+        raise HTTPException(status_code=404, detail="Channel not found")
+    await render_cache.invalidate_user(user_id)
+    return updated_channel
 
 @app.delete("/channels/{channel_id}")
 async def delete_channel(
     channel_id: int,
     user_id: int = Depends(get_current_user_id)
 ):
-    with get_db() as db:
-        cursor = db.cursor()
-        
-        # Verifica che il canale appartenga a una playlist dell'utente
-        channel = cursor.execute("""
-            SELECT c.* 
-            FROM channels c
-            JOIN playlists p ON c.playlist_id = p.id
-            WHERE c.id = ? AND p.user_id = ?
-        """, (channel_id, user_id)).fetchone()
-        
-        if not channel:
-            raise HTTPException(status_code=404, detail="Channel not found")
-        
-        cursor.execute("DELETE FROM channels WHERE id = ?", (channel_id,))
-        return {"message": "Channel deleted"}
+    await _get_user_channel(user_id, channel_id)
+    await repo.delete_channel(user_id, channel_id)
+    await render_cache.invalidate_user(user_id)
+    return {"message": "Channel deleted"}
 
 # Channel ordering
 @app.put("/playlists/{playlist_id}/channels/reorder")
@@ -501,43 +410,91 @@ async def reorder_channels(
     channel_orders: List[ChannelOrder],
     user_id: int = Depends(get_current_user_id)
 ):
-    with get_db() as db:
-        cursor = db.cursor()
-        
-        playlist = cursor.execute(
-            "SELECT * FROM playlists WHERE id = ? AND user_id = ?",
-            (playlist_id, user_id)
-        ).fetchone()
-        
-        if not playlist:
-            raise HTTPException(status_code=404, detail="Playlist not found")
-        
-        try:
-            cursor.execute("BEGIN TRANSACTION")
-            
-            for order in channel_orders:
-                if playlist['is_custom']:
-                    cursor.execute("""
-                        UPDATE custom_playlist_channels 
-                        SET position = ? 
-                        WHERE playlist_id = ? AND channel_id = ?
-                    """, (order.position, playlist_id, order.id))
-                else:
-                    cursor.execute("""
-                        UPDATE channels 
-                        SET position = ? 
-                        WHERE id = ? AND playlist_id = ?
-                    """, (order.position, order.id, playlist_id))
-            
-            cursor.execute("COMMIT")
-            return {"message": "Channels reordered successfully"}
-            
-        except Exception as e:
-            cursor.execute("ROLLBACK")
-            raise HTTPException(
-                status_code=400,
-                detail=f"Error reordering channels: {str(e)}"
-            )
+    playlist = await _get_user_playlist(user_id, playlist_id)
+
+    try:
+        await repo.reorder_channels(
+            user_id, playlist,
+            [(order.id, order.position) for order in channel_orders]
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Error reordering channels: {str(e)}"
+        )
+
+    await render_cache.invalidate_user(user_id)
+    return {"message": "Channels reordered successfully"}
+
+# Channel groups
+async def _get_grouped_playlist(user_id: int, playlist_id: int) -> Dict:
+    playlist = await _get_user_playlist(user_id, playlist_id)
+    if playlist['is_custom']:
+        raise HTTPException(
+            status_code=400,
+            detail="Groups are only available for regular playlists"
+        )
+    return playlist
+
+async def _get_group(user_id: int, playlist_id: int, name: str) -> Dict:
+    group = await repo.get_group(user_id, playlist_id, name)
+    if not group:
+        raise HTTPException(status_code=404, detail=f"Group not found: {name!r}")
+    return group
+
+@app.get("/playlists/{playlist_id}/groups", response_model=List[ChannelGroup])
+async def get_playlist_groups(
+    playlist_id: int,
+    user_id: int = Depends(get_current_user_id)
+):
+    await _get_grouped_playlist(user_id, playlist_id)
+    return await repo.list_groups(user_id, playlist_id)
+
+# I nomi dei gruppi possono contenere "/"; "" indica i canali senza group-title
+@app.get("/playlists/{playlist_id}/groups/{group:path}/channels", response_model=List[Channel])
+async def get_group_channels(
+    playlist_id: int,
+    group: str,
+    user_id: int = Depends(get_current_user_id)
+):
+    await _get_grouped_playlist(user_id, playlist_id)
+    await _get_group(user_id, playlist_id, group)
+    return await repo.group_channels(user_id, playlist_id, group)
+
+@app.post("/playlists/{playlist_id}/groups/rename")
+async def rename_groups(
+    playlist_id: int,
+    rename: GroupRename,
+    user_id: int = Depends(get_current_user_id)
+):
+    await _get_grouped_playlist(user_id, playlist_id)
+    count = await repo.rename_groups(user_id, playlist_id, rename.groups, rename.name)
+    await render_cache.invalidate_user(user_id)
+    return {"message": "Groups renamed", "channels": count}
+
+@app.post("/playlists/{playlist_id}/groups/visibility")
+async def set_groups_visibility(
+    playlist_id: int,
+    visibility: GroupVisibility,
+    user_id: int = Depends(get_current_user_id)
+):
+    await _get_grouped_playlist(user_id, playlist_id)
+    count = await repo.set_groups_hidden(user_id, playlist_id, visibility.groups, visibility.hidden)
+    await render_cache.invalidate_user(user_id)
+    return {"message": "Groups hidden" if visibility.hidden else "Groups shown", "groups": count}
+
+@app.post("/playlists/{playlist_id}/groups/move")
+async def move_groups(
+    playlist_id: int,
+    move: GroupMove,
+    user_id: int = Depends(get_current_user_id)
+):
+    await _get_grouped_playlist(user_id, playlist_id)
+    if move.before is not None:
+        await _get_group(user_id, playlist_id, move.before)
+    count = await repo.move_groups(user_id, playlist_id, move.groups, move.before)
+    await render_cache.invalidate_user(user_id)
+    return {"message": "Groups moved", "channels": count}
 
 # Public playlist management
 @app.post("/playlists/{playlist_id}/generate-token")
@@ -545,150 +502,186 @@ async def generate_public_token(
     playlist_id: int,
     user_id: int = Depends(get_current_user_id)
 ):
-    with get_db() as db:
-        cursor = db.cursor()
-        
-        # Verifica che la playlist appartenga all'utente
-        playlist = cursor.execute(
-            "SELECT * FROM playlists WHERE id = ? AND user_id = ?",
-            (playlist_id, user_id)
-        ).fetchone()
-        
-        if not playlist:
-            raise HTTPException(status_code=404, detail="Playlist not found")
-        
-        token = str(uuid.uuid4())
-        cursor.execute(
-            "UPDATE playlists SET public_token = ? WHERE id = ?",
-            (token, playlist_id)
+    # Verifica che la playlist appartenga all'utente
+    playlist = await _get_user_playlist(user_id, playlist_id)
+
+    token = str(uuid.uuid4())
+    await repo.set_public_token(user_id, playlist_id, token)
+    # Il vecchio link smette subito di funzionare, anche dove nginx serve la copia su disco
+    await publisher.unpublish(playlist['public_token'])
+    await render_cache.invalidate_user(user_id)
+
+    base_url = "/public/playlist"
+    return {
+        "token": token,
+        "public_url": f"{base_url}/{token}/m3u",
+        "epg_url": playlist['epg_url']
+    }
+
+async def _export_response(playlist: Dict, fmt: str, cached: bool = False,
+                           published_prefix: Optional[str] = None) -> Response:
+    """Stream a playlist in the requested export format, optionally through the render cache.
+
+    `published_prefix` is the internal location of PUBLISH_DIR in the proxy in
+    front of the API, which then sends the published copy (see publisher.py).
+    """
+    try:
+        exporter = get_exporter(fmt)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e.args[0]))
+
+    headers = {
+        "Content-Disposition": f'attachment; filename="{playlist["name"]}.{exporter.extension}"',
+        # Da passare come ?since= a /changes
+        "X-Playlist-Version": str(playlist['version'])
+    }
+    # Le playlist pubbliche (le uniche in cache) usano proxy dei logo e redirect dei flussi
+    chunks = stream_export(playlist, exporter, public=cached)
+    if cached:
+        # Copia su disco aggiornata: il corpo lo invia nginx, gli header restano questi
+        accel_path = await publisher.accel_path(playlist, exporter.name, published_prefix)
+        if accel_path is not None:
+            return Response(media_type=exporter.media_type, headers={**headers, "X-Accel-Redirect": accel_path})
+        key = (playlist['id'], exporter.name)
+        data = await render_cache.get(playlist['user_id'], key)
+        if data is not None:
+            return Response(data, media_type=exporter.media_type, headers=headers)
+        chunks = render_cache.tee(playlist['user_id'], key, chunks)
+        # I render pubblici non in cache occupano uno slot finché la risposta non è inviata
+        if await render_slots.acquire():
+            # Chi era in coda trova spesso il render appena salvato da un altro
+            data = await render_cache.get(playlist['user_id'], key)
+            if data is not None:
+                render_slots.release()
+                return Response(data, media_type=exporter.media_type, headers=headers)
+        return SlotStreamingResponse(
+            chunks, media_type=exporter.media_type, headers=headers, release=render_slots.release
         )
-        
-        base_url = "/public/playlist"
-        return {
-            "token": token,
-            "public_url": f"{base_url}/{token}/m3u",
-            "epg_url": playlist['epg_url']
-        }
-
-@app.get("/public/playlist/{token}/m3u")
-async def get_public_playlist(token: str):
-    with get_db() as db:
-        # Trova la playlist dal token pubblico
-        playlist = db.execute(
-            "SELECT * FROM playlists WHERE public_token = ?",
-            (token,)
-        ).fetchone()
-        
-        if not playlist:
-            raise HTTPException(status_code=404, detail="Playlist not found")
-        
-        # Prendi i canali
-        channels = []
-        if playlist['is_custom']:
-            # Per playlist custom, usa la tabella di mapping
-            rows = db.execute("""
-                SELECT c.* 
-                FROM channels c
-                JOIN custom_playlist_channels cpc ON c.id = cpc.channel_id
-                WHERE cpc.playlist_id = ?
-                ORDER BY cpc.position, c.name
-            """, (playlist['id'],)).fetchall()
-        else:
-            # Per playlist normali
-            rows = db.execute("""
-                SELECT * FROM channels 
-                WHERE playlist_id = ?
-                ORDER BY position, created_at
-            """, (playlist['id'],)).fetchall()
-        
-        # Converti in oggetti M3UChannel
-        for row in rows:
-            extra_tags = json.loads(row['extra_tags']) if row['extra_tags'] else {}
-            channels.append(M3UChannel(
-                name=row['name'],
-                url=row['url'],
-                group=row['group_title'],
-                logo=row['logo_url'],
-                tvg_id=row['tvg_id'],
-                extra_tags=extra_tags
-            ))
-        
-        # Genera il contenuto M3U
-        content = generate_m3u(channels, playlist.get('epg_url'))
-        
-        return PlainTextResponse(
-            content,
-            media_type="application/x-mpegurl",
-            headers={
-                "Content-Disposition": f'attachment; filename="{playlist["name"]}.m3u"'
-            }
+
+    return StreamingResponse(chunks, media_type=exporter.media_type, headers=headers)
+
+async def _get_public_playlist(token: str) -> Dict:
+    # Trova la playlist dal token pubblico
+    playlist = await repo.find_public_playlist(token)
+
+    if not playlist:
+        raise HTTPException(status_code=404, detail="Playlist not found")
+    return playlist
+
+@app.get("/public/playlist/{token}/m3u", dependencies=[Depends(admit_public)])
+async def get_public_playlist(token: str, request: Request):
+    playlist = await _get_public_playlist(token)
+    return await _export_response(playlist, "m3u", cached=True, published_prefix=request.headers.get("x-published-prefix"))
+
+@app.get("/public/playlist/{token}/export/{fmt}", dependencies=[Depends(admit_public)])
+async def export_public_playlist(token: str, fmt: str, request: Request):
+    playlist = await _get_public_playlist(token)
+    return await _export_response(playlist, fmt, cached=True, published_prefix=request.headers.get("x-published-prefix"))
+
+@app.get("/public/playlist/{token}/changes", dependencies=[Depends(admit_public)])
+async def get_public_playlist_changes(token: str, since: Optional[int] = None):
+    """Channels changed after version `since`; a full snapshot without it or when the log was compacted"""
+    playlist = await _get_public_playlist(token)
+    await render_slots.acquire()
+    try:
+        changes = await repo.playlist_changes(playlist, since)
+        return render_changes(playlist, changes, public=True)
+    finally:
+        render_slots.release()
+
+@app.get("/play/{token}/{channel_id}", dependencies=[Depends(admit_play)])
+async def play_channel(token: str, channel_id: str):
+    """Redirect to the channel's source or, when it is dead, to a live equivalent one"""
+    url = await playback_index.resolve(token, channel_id)
+    if url is None:
+        raise HTTPException(status_code=404, detail="Channel not found")
+    # La scelta può cambiare a ogni modifica: i player non devono memorizzarla
+    return RedirectResponse(url, status_code=302, headers={"Cache-Control": "no-store"})
+
+# I logo condividono l'origine del frontend: niente script né sniffing del tipo
+LOGO_HEADERS = {
+    "Content-Security-Policy": "default-src 'none'; style-src 'unsafe-inline'; sandbox",
+    "X-Content-Type-Options": "nosniff"
+}
+
+@app.get("/logos/{logo_hash}")
+async def get_logo(logo_hash: str):
+    """Cached logo thumbnail; while it is being fetched, or when it is not cached, redirect to the original"""
+    if not LOGO_HASH.match(logo_hash):
+        raise HTTPException(status_code=404, detail="Logo not found")
+
+    entry = await logo_cache.lookup(logo_hash)
+    if entry is not None and entry.available:
+        LOGO_REQUESTS.inc(result="hit")
+        # Il contenuto di un hash cambia solo se cambia l'immagine di origine
+        return FileResponse(
+            logo_cache.image_path(logo_hash),
+            media_type=entry.content_type,
+            headers={"Cache-Control": "public, max-age=2592000", **LOGO_HEADERS}
         )
 
+    source = logo_cache.pending_source(logo_hash)
+    if source is not None:
+        LOGO_REQUESTS.inc(result="miss")
+        return RedirectResponse(source, status_code=307, headers={"Cache-Control": "no-store"})
+
+    if entry is not None:
+        # Non raggiungibile o rifiutato (SVG): le playlist già servite puntano ancora qui
+        LOGO_REQUESTS.inc(result="unavailable")
+        return RedirectResponse(entry.url, status_code=307, headers={"Cache-Control": "no-store"})
+
+    LOGO_REQUESTS.inc(result="unknown")
+    raise HTTPException(status_code=404, detail="Logo not found", headers={"Cache-Control": "no-store"})
+
+@app.get("/playlists/{playlist_id}/export/{fmt}")
+async def export_playlist(
+    playlist_id: int,
+    fmt: str,
+    user_id: int = Depends(get_current_user_id)
+):
+    playlist = await _get_user_playlist(user_id, playlist_id)
+    return await _export_response(playlist, fmt)
+
+@app.get("/export-formats")
+async def get_export_formats():
+    return [
+        {"name": name, "media_type": exporter.media_type, "extension": exporter.extension}
+        for name, exporter in EXPORTERS.items()
+    ]
+
 # Custom playlist channels management
+async def _get_manual_playlist(user_id: int, playlist_id: int) -> Dict:
+    # Verifica che sia una playlist custom dell'utente
+    playlist = await _get_user_playlist(user_id, playlist_id, custom_only=True)
+
+    if playlist['rules']:
+        raise HTTPException(
+            status_code=400,
+            detail="Rule-based playlists are managed automatically"
+        )
+    return playlist
+
 @app.post("/playlists/{playlist_id}/add-channel/{channel_id}")
 async def add_channel_to_custom_playlist(
     playlist_id: int,
     channel_id: int,
     user_id: int = Depends(get_current_user_id)
 ):
-    with get_db() as db:
-        cursor = db.cursor()
-        
-        # Verifica che sia una playlist custom dell'utente
-        playlist = cursor.execute(
-            """
-            SELECT * FROM playlists 
-            WHERE id = ? AND user_id = ? AND is_custom = 1
-            """,
-            (playlist_id, user_id)
-        ).fetchone()
-        
-        if not playlist:
-            raise HTTPException(
-                status_code=404,
-                detail="Custom playlist not found"
-            )
-        
-        # Verifica che il canale esista
-        channel = cursor.execute("""
-            SELECT c.* 
-            FROM channels c
-            JOIN playlists p ON c.playlist_id = p.id
-            WHERE c.id = ? AND p.user_id = ?
-        """, (channel_id, user_id)).fetchone()
-        
-        if not channel:
-            raise HTTPException(status_code=404, detail="Channel not found")
-        
-        try:
-            # Trova la posizione massima attuale
-            max_pos = cursor.execute(
-                """
-                SELECT MAX(position) as max_pos 
-                FROM custom_playlist_channels 
-                WHERE playlist_id = ?
-                """,
-                (playlist_id,)
-            ).fetchone()
-            
-            next_pos = (max_pos['max_pos'] or 0) + 1
-            
-            cursor.execute(
-                """
-                INSERT INTO custom_playlist_channels 
-                (playlist_id, channel_id, position)
-                VALUES (?, ?, ?)
-                """,
-                (playlist_id, channel_id, next_pos)
-            )
-            
-            return {"message": "Channel added to playlist"}
-            
-        except sqlite3.IntegrityError:
-            raise HTTPException(
-                status_code=400,
-                detail="Channel already in playlist"
-            )
+    await _get_manual_playlist(user_id, playlist_id)
+
+    # Verifica che il canale esista
+    await _get_user_channel(user_id, channel_id)
+
+    try:
+        await repo.add_custom_channel(user_id, playlist_id, channel_id)
+    except DuplicateChannelError:
+        raise HTTPException(
+            status_code=400,
+            detail="Channel already in playlist"
+        )
+
+    await render_cache.invalidate_user(user_id)
+    return {"message": "Channel added to playlist"}
 
 @app.delete("/playlists/{playlist_id}/channels/{channel_id}")
 async def remove_channel_from_custom_playlist(
@@ -696,69 +689,76 @@ async def remove_channel_from_custom_playlist(
     channel_id: int,
     user_id: int = Depends(get_current_user_id)
 ):
-    with get_db() as db:
-        cursor = db.cursor()
-        
-        # Verifica che sia una playlist custom dell'utente
-        playlist = cursor.execute(
-            """
-            SELECT * FROM playlists 
-            WHERE id = ? AND user_id = ? AND is_custom = 1
-            """,
-            (playlist_id, user_id)
-        ).fetchone()
-        
-        if not playlist:
-            raise HTTPException(
-                status_code=404,
-                detail="Custom playlist not found"
-            )
-        
-        cursor.execute(
-            """
-            DELETE FROM custom_playlist_channels 
-            WHERE playlist_id = ? AND channel_id = ?
-            """,
-            (playlist_id, channel_id)
+    await _get_manual_playlist(user_id, playlist_id)
+    await repo.remove_custom_channel(user_id, playlist_id, channel_id)
+    await render_cache.invalidate_user(user_id)
+    return {"message": "Channel removed from playlist"}
+
+# Rule-based custom playlists
+@app.put("/playlists/{playlist_id}/rules")
+async def set_playlist_rules(
+    playlist_id: int,
+    rules: PlaylistRules,
+    user_id: int = Depends(get_current_user_id)
+):
+    playlist = await _get_user_playlist(user_id, playlist_id, custom_only=True)
+
+    try:
+        changes = await repo.set_rules(user_id, playlist, rules.model_dump())
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error applying rules: {str(e)}"
+        )
+
+    await render_cache.invalidate_user(user_id)
+    return {"message": "Rules applied", "changes": changes}
+
+@app.post("/playlists/{playlist_id}/rules/refresh")
+async def refresh_playlist_rules(
+    playlist_id: int,
+    user_id: int = Depends(get_current_user_id)
+):
+    playlist = await repo.get_playlist(user_id, playlist_id, custom_only=True)
+
+    if not playlist or not playlist['rules']:
+        raise HTTPException(
+            status_code=404,
+            detail="Rule-based playlist not found"
+        )
+
+    try:
+        changes = await repo.refresh_rules(user_id, playlist)
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error applying rules: {str(e)}"
         )
-        
-        return {"message": "Channel removed from playlist"}
+
+    await render_cache.invalidate_user(user_id)
+    return {"message": "Rules re-evaluated", "changes": changes}
+
+@app.delete("/playlists/{playlist_id}/rules")
+async def delete_playlist_rules(
+    playlist_id: int,
+    user_id: int = Depends(get_current_user_id)
+):
+    playlist = await _get_user_playlist(user_id, playlist_id, custom_only=True)
+
+    # I canali già presenti restano nella playlist come selezione manuale
+    await repo.set_rules(user_id, playlist, None)
+    return {"message": "Rules removed"}
 
 @app.get("/playlists/{playlist_id}/channels-available")
 async def get_available_channels(
     playlist_id: int,
     user_id: int = Depends(get_current_user_id)
 ):
-    with get_db() as db:
-        # Verifica che sia una playlist custom dell'utente
-        playlist = db.execute(
-            """
-            SELECT * FROM playlists 
-            WHERE id = ? AND user_id = ? AND is_custom = 1
-            """,
-            (playlist_id, user_id)
-        ).fetchone()
-        
-        if not playlist:
-            raise HTTPException(
-                status_code=404,
-                detail="Custom playlist not found"
-            )
-        
-        # Prendi tutti i canali che non sono già nella playlist custom
-        channels = db.execute("""
-            SELECT c.*, p.name as source_playlist_name 
-            FROM channels c
-            JOIN playlists p ON c.playlist_id = p.id
-            WHERE p.user_id = ? AND c.id NOT IN (
-                SELECT channel_id 
-                FROM custom_playlist_channels 
-                WHERE playlist_id = ?
-            )
-            ORDER BY p.name, c.position, c.name
-        """, (user_id, playlist_id)).fetchall()
-        
-        return channels
+    # Verifica che sia una playlist custom dell'utente
+    await _get_user_playlist(user_id, playlist_id, custom_only=True)
+
+    # Prendi tutti i canali che non sono già nella playlist custom
+    return await repo.available_channels(user_id, playlist_id)
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,270 @@
+"""Background upkeep of the SQLite files.
+
+Syncs delete and insert many rows at a time, which leaves the WAL and the free
+pages of the database growing. Every MAINTENANCE_INTERVAL_SECONDS one worker
+process (a lock file next to the main database picks it) looks at each file:
+
+- when the WAL is above MAINTENANCE_WAL_BYTES it runs a PASSIVE checkpoint, and
+  a TRUNCATE one to shrink the WAL back to zero if the file is idle;
+- every MAINTENANCE_OPTIMIZE_SECONDS it runs PRAGMA optimize, with ANALYZE the
+  first time, so the query planner has current statistics;
+- when the file is idle (no writes for MAINTENANCE_IDLE_SECONDS) and has more
+  than MAINTENANCE_VACUUM_MIN_PAGES free pages, it gives up to
+  MAINTENANCE_VACUUM_MAX_PAGES of them back to the filesystem with an
+  incremental vacuum. Files created before auto_vacuum=INCREMENTAL was set are
+  converted by a full VACUUM, if smaller than MAINTENANCE_CONVERT_MAX_BYTES,
+  but only in a pass started from the admin endpoint: the VACUUM holds the
+  write lock for as long as it takes to copy the file;
+- on the same schedule as PRAGMA optimize, when the file is idle, it deletes
+  the tag sets (see tag_sets.py) no channel references any more.
+
+The time of the last run of each operation is kept in a state file, so the
+workers share one schedule and GET /admin/database shows it whichever worker
+answers. PostgreSQL does this on its own (autovacuum): there the task is off.
+"""
+from typing import Dict, List, Optional
+from pathlib import Path
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: un solo processo
+    fcntl = None
+
+from database import DATABASE_PATH, database_files, open_database
+from repository import repo
+from metrics import DB_MAINTENANCE_RUNS, DB_WAL_BYTES, DB_FREE_PAGES
+
+logger = logging.getLogger(__name__)
+
+AUTO_VACUUM_MODES = {0: "none", 1: "full", 2: "incremental"}
+
+def _size(path: Path) -> int:
+    try:
+        return path.stat().st_size
+    except OSError:
+        return 0
+
+def _modified(path: Path) -> float:
+    try:
+        return path.stat().st_mtime
+    except OSError:
+        return 0.0
+
+class DatabaseMaintenance:
+    def __init__(self, interval: float, wal_bytes: int, optimize_every: float, idle: float,
+                 vacuum_min_pages: int, vacuum_max_pages: int, convert_max_bytes: int,
+                 busy_timeout: float):
+        self.interval = interval
+        self.wal_bytes = wal_bytes
+        self.optimize_every = optimize_every
+        self.idle = idle
+        self.vacuum_min_pages = vacuum_min_pages
+        self.vacuum_max_pages = vacuum_max_pages
+        self.convert_max_bytes = convert_max_bytes
+        self.busy_timeout = busy_timeout
+        self.state_path = DATABASE_PATH.with_name(DATABASE_PATH.name + ".maintenance.json")
+        self.lock_path = DATABASE_PATH.with_name(DATABASE_PATH.name + ".maintenance.lock")
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.interval > 0 and repo.name == 'sqlite'
+
+    async def start(self):
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await asyncio.to_thread(self.run)
+            except Exception:
+                logger.exception("database maintenance failed")
+
+    def run(self, force: bool = False) -> bool:
+        """One maintenance pass over all the files; False if another worker is running one"""
+        handle = open(self.lock_path, 'a')
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return False
+            state = self._read_state()
+            wal_total = free_total = 0
+            for path in database_files():
+                if not path.exists():
+                    continue
+                entry = state.setdefault(path.name, {})
+                try:
+                    self._maintain(path, entry, force)
+                except Exception:
+                    DB_MAINTENANCE_RUNS.inc(operation="pass", result="error")
+                    logger.exception("database maintenance failed", extra={"path": str(path)})
+                wal_total += _size(self._wal(path))
+                free_total += entry.get('free_pages', 0)
+            self._write_state(state)
+            DB_WAL_BYTES.set(wal_total)
+            DB_FREE_PAGES.set(free_total)
+            return True
+        finally:
+            # Chiudere il file rilascia anche il lock
+            handle.close()
+
+    @staticmethod
+    def _wal(path: Path) -> Path:
+        return path.with_name(path.name + "-wal")
+
+    def _idle(self, path: Path) -> bool:
+        last_write = max(_modified(path), _modified(self._wal(path)))
+        return time.time() - last_write >= self.idle
+
+    def _maintain(self, path: Path, entry: Dict, force: bool):
+        now = time.time()
+        idle = force or self._idle(path)
+        with open_database(path) as db:
+            # Mai in attesa a lungo dietro una sync: si riprova al giro successivo
+            db.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout * 1000)}")
+            try:
+                self._maintain_file(db, path, entry, idle, force, now)
+            except sqlite3.OperationalError as e:
+                if 'locked' not in str(e) and 'busy' not in str(e):
+                    raise
+                DB_MAINTENANCE_RUNS.inc(operation="pass", result="busy")
+            entry['free_pages'] = db.execute("PRAGMA freelist_count").fetchone()['freelist_count']
+            entry['auto_vacuum'] = AUTO_VACUUM_MODES.get(
+                db.execute("PRAGMA auto_vacuum").fetchone()['auto_vacuum'], "unknown"
+            )
+        entry['checked_at'] = now
+
+    def _maintain_file(self, db, path: Path, entry: Dict, idle: bool, force: bool, now: float):
+        incremental = db.execute("PRAGMA auto_vacuum").fetchone()['auto_vacuum'] == 2
+        # Il vacuum passa dal WAL: il file si riduce solo col checkpoint che segue
+        shrink = False
+        # Il VACUUM blocca gli scrittori per tutta la copia: mai dal pass periodico
+        if force and not incremental and 0 < _size(path) <= self.convert_max_bytes:
+            self._convert(db, path, entry)
+            incremental = shrink = True
+
+        if idle and (force or now - entry.get('pruned_at', 0) >= self.optimize_every):
+            self._prune_tag_sets(db, entry)
+
+        free_pages = db.execute("PRAGMA freelist_count").fetchone()['freelist_count']
+        if incremental and idle and free_pages > self.vacuum_min_pages:
+            self._vacuum(db, entry, free_pages)
+            shrink = True
+
+        if force or now - entry.get('optimized_at', 0) >= self.optimize_every:
+            self._optimize(db, entry)
+
+        if force or shrink or _size(self._wal(path)) > self.wal_bytes:
+            # TRUNCATE aspetta lettori e scrittori: solo a file fermo
+            self._checkpoint(db, entry, "TRUNCATE" if idle else "PASSIVE")
+
+    def _convert(self, db, path: Path, entry: Dict):
+        started = time.perf_counter()
+        db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        db.execute("VACUUM")
+        DB_MAINTENANCE_RUNS.inc(operation="convert", result="ok")
+        entry['converted_at'] = time.time()
+        logger.info("database converted to incremental vacuum", extra={
+            "path": str(path), "seconds": round(time.perf_counter() - started, 3)
+        })
+
+    def _prune_tag_sets(self, db, entry: Dict):
+        if not db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'tag_sets'").fetchone():
+            return
+        # Id AUTOINCREMENT mai riusati: le cache dei worker restano valide (vedi TagSetWriter)
+        deleted = db.execute("""
+            DELETE FROM tag_sets
+            WHERE id NOT IN (SELECT tag_set_id FROM channels WHERE tag_set_id IS NOT NULL)
+        """).rowcount
+        DB_MAINTENANCE_RUNS.inc(operation="prune_tag_sets", result="ok")
+        entry['pruned_at'] = time.time()
+        entry['pruned_tag_sets'] = deleted
+
+    def _vacuum(self, db, entry: Dict, free_pages: int):
+        # executescript avanza lo statement fino in fondo: execute libererebbe una sola pagina
+        db.executescript(f"PRAGMA incremental_vacuum({min(free_pages, self.vacuum_max_pages)})")
+        freed = free_pages - db.execute("PRAGMA freelist_count").fetchone()['freelist_count']
+        DB_MAINTENANCE_RUNS.inc(operation="vacuum", result="ok")
+        entry['vacuumed_at'] = time.time()
+        entry['vacuumed_pages'] = freed
+
+    def _optimize(self, db, entry: Dict):
+        # Analisi a campione: tempi limitati anche su tabelle da milioni di righe
+        db.execute("PRAGMA analysis_limit = 1000")
+        if not db.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone():
+            db.execute("ANALYZE")
+        db.execute("PRAGMA optimize = 0x10002")
+        DB_MAINTENANCE_RUNS.inc(operation="optimize", result="ok")
+        entry['optimized_at'] = time.time()
+
+    def _checkpoint(self, db, entry: Dict, mode: str):
+        busy, log_frames, checkpointed = db.execute(f"PRAGMA wal_checkpoint({mode})").fetchone().values()
+        complete = not busy and checkpointed == log_frames
+        DB_MAINTENANCE_RUNS.inc(operation=f"checkpoint_{mode.lower()}", result="ok" if complete else "partial")
+        entry['checkpointed_at'] = time.time()
+        entry['checkpoint'] = {"mode": mode.lower(), "frames": log_frames, "checkpointed": checkpointed}
+
+    def _read_state(self) -> Dict[str, Dict]:
+        try:
+            return json.loads(self.state_path.read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def _write_state(self, state: Dict[str, Dict]):
+        tmp = self.state_path.with_name(f"{self.state_path.name}.{os.getpid()}.tmp")
+        tmp.write_text(json.dumps(state))
+        os.replace(tmp, self.state_path)
+
+    def stats(self) -> Dict:
+        """Current size of each file, with the last maintenance runs on it"""
+        if not self.enabled:
+            return {"enabled": False, "backend": repo.name, "files": []}
+        state = self._read_state()
+        files: List[Dict] = []
+        for path in database_files():
+            if not path.exists():
+                continue
+            files.append({
+                "file": path.name,
+                "bytes": _size(path),
+                "wal_bytes": _size(self._wal(path)),
+                "idle": self._idle(path),
+                **state.get(path.name, {})
+            })
+        return {
+            "enabled": True,
+            "backend": repo.name,
+            "interval_seconds": self.interval,
+            "wal_threshold_bytes": self.wal_bytes,
+            "files": files
+        }
+
+maintenance = DatabaseMaintenance(
+    interval=float(os.getenv("MAINTENANCE_INTERVAL_SECONDS", 60)),
+    wal_bytes=int(os.getenv("MAINTENANCE_WAL_BYTES", 64 * 1024 * 1024)),
+    optimize_every=float(os.getenv("MAINTENANCE_OPTIMIZE_SECONDS", 3600)),
+    idle=float(os.getenv("MAINTENANCE_IDLE_SECONDS", 30)),
+    vacuum_min_pages=int(os.getenv("MAINTENANCE_VACUUM_MIN_PAGES", 1024)),
+    vacuum_max_pages=int(os.getenv("MAINTENANCE_VACUUM_MAX_PAGES", 25600)),
+    convert_max_bytes=int(os.getenv("MAINTENANCE_CONVERT_MAX_BYTES", 64 * 1024 * 1024)),
+    busy_timeout=float(os.getenv("MAINTENANCE_BUSY_TIMEOUT_SECONDS", 1))
+)
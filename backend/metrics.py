@@ -0,0 +1,188 @@
+"""In-process metrics exposed in the Prometheus text format"""
+from typing import Dict, List, Optional, Sequence, Tuple
+from contextlib import contextmanager
+from bisect import bisect_left
+import threading
+import time
+
+_lock = threading.Lock()
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def _format_labels(self, key: Tuple, extra: Optional[Tuple[str, str]] = None) -> str:
+        pairs = list(zip(self.labelnames, key))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self._samples())
+        return lines
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self) -> List[str]:
+        with _lock:
+            values = sorted(self._values.items())
+        return [f'{self.name}{self._format_labels(k)} {v}' for k, v in values]
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        with _lock:
+            self._values[self._key(labels)] = value
+
+class Histogram(_Metric):
+    kind = 'histogram'
+    DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per ogni combinazione di label: conteggi per bucket (l'ultimo è +Inf), somma, totale
+        self._series: Dict[Tuple, List] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with _lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self) -> List[str]:
+        with _lock:
+            series = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._series.items())
+        lines = []
+        for key, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{self.name}_bucket{self._format_labels(key, ("le", le))} {cumulative}')
+            lines.append(f'{self.name}_sum{self._format_labels(key)} {total}')
+            lines.append(f'{self.name}_count{self._format_labels(key)} {count}')
+        return lines
+
+REGISTRY: List[_Metric] = []
+
+def render_metrics() -> str:
+    """Render every registered metric in the Prometheus text exposition format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+# HTTP
+REQUEST_SECONDS = Histogram(
+    'omg_http_request_duration_seconds', 'HTTP request latency by route',
+    ('method', 'route', 'status')
+)
+
+# Sincronizzazione playlist
+SYNC_STAGE_SECONDS = Histogram(
+    'omg_sync_stage_duration_seconds', 'Duration of each playlist sync stage',
+    ('stage',)
+)
+SYNC_BYTES = Counter('omg_sync_downloaded_bytes_total', 'Bytes downloaded from upstream playlists')
+SYNC_CHANNELS_PARSED = Counter('omg_sync_channels_parsed_total', 'Channels parsed from upstream playlists')
+SYNC_PARSE_RATE = Gauge('omg_sync_parse_channels_per_second', 'Parse throughput of the last sync')
+SYNC_RESULTS = Counter('omg_sync_total', 'Playlist syncs by outcome', ('result',))
+
+# Database
+DB_QUERIES = Counter('omg_db_queries_total', 'SQL statements executed', ('operation',))
+DB_QUERY_SECONDS = Histogram(
+    'omg_db_query_duration_seconds', 'Time spent executing SQL statements',
+    ('operation',),
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+)
+DB_FETCH_SECONDS = Counter('omg_db_fetch_seconds_total', 'Time spent fetching SQL result rows')
+
+# Cache delle playlist pubbliche
+PUBLIC_CACHE_REQUESTS = Counter(
+    'omg_public_playlist_cache_requests_total', 'Public playlist render cache lookups',
+    ('result',)
+)
+
+# Cache a due livelli (cache.py)
+CACHE_LOOKUPS = Counter('omg_cache_lookups_total', 'Cache lookups by outcome', ('result',))
+CACHE_LOCAL_BYTES = Gauge('omg_cache_local_bytes', 'Bytes held by the in-process cache of this worker')
+CACHE_SHARED_ERRORS = Counter('omg_cache_shared_errors_total', 'Failed operations on the shared cache server')
+
+# Proxy dei logo (logos.py)
+LOGO_FETCHES = Counter('omg_logo_fetches_total', 'Logo downloads by outcome', ('result',))
+LOGO_REQUESTS = Counter('omg_logo_requests_total', 'Logo proxy requests by outcome', ('result',))
+LOGO_CACHE_BYTES = Gauge('omg_logo_cache_bytes', 'Bytes of cached logos known to this worker')
+
+# Download condivisi delle playlist upstream (upstream.py)
+UPSTREAM_FETCHES = Counter(
+    'omg_upstream_fetches_total', 'Upstream playlist requests, downloaded or joined to a running download',
+    ('result',)
+)
+UPSTREAM_PARSES = Counter('omg_upstream_parses_total', 'Upstream playlist parses, done or reused', ('result',))
+
+# Copie statiche delle playlist pubbliche (publisher.py)
+PUBLISH_RUNS = Counter('omg_publish_runs_total', "Publishes of a user's public playlists by outcome", ('result',))
+PUBLISH_FILES = Counter('omg_publish_files_total', 'Published playlist files by outcome', ('result',))
+PUBLISH_SECONDS = Histogram('omg_publish_duration_seconds', "Time to publish a user's public playlists")
+
+# Redirect di failover dei flussi (playback.py)
+PLAY_REDIRECTS = Counter('omg_play_redirects_total', 'Stream redirects by chosen source', ('result',))
+PLAY_INDEX_CHANNELS = Gauge('omg_play_index_channels', 'Channels in the in-memory redirect index of this worker')
+
+# Controllo di ammissione delle route pubbliche (admission.py)
+ADMISSION_REJECTED = Counter('omg_admission_rejected_total', 'Public requests rejected by admission control', ('reason',))
+RENDERS_IN_FLIGHT = Gauge('omg_renders_in_flight', 'Playlist renders running in this worker')
+
+# Login (passwords.py)
+LOGINS = Counter('omg_logins_total', 'Login attempts by outcome', ('result',))
+PASSWORD_VERIFY_SECONDS = Histogram('omg_password_verify_duration_seconds', 'Time to check a password, in the hashing pool')
+
+# Manutenzione dei file SQLite (maintenance.py)
+DB_MAINTENANCE_RUNS = Counter(
+    'omg_db_maintenance_runs_total', 'Database maintenance operations by outcome', ('operation', 'result')
+)
+DB_WAL_BYTES = Gauge('omg_db_wal_bytes', 'Size of the SQLite WAL files at the last maintenance pass')
+DB_FREE_PAGES = Gauge('omg_db_free_pages', 'Free pages in the SQLite files at the last maintenance pass')
@@ -1,6 +1,7 @@
-from pydantic import BaseModel, HttpUrl, Field
+from pydantic import BaseModel, HttpUrl, Field, field_validator
 from typing import Optional, List, Dict
 from datetime import datetime
+import re
 
 # Auth models
 class Token(BaseModel):
@@ -22,12 +23,41 @@ class UserCreate(BaseModel):
 class UserInDB(User):
     password_hash: str
 
+# Rule-based custom playlist models
+def _check_regex(pattern: str):
+    try:
+        re.compile(pattern)
+    except re.error as e:
+        raise ValueError(f"Invalid regular expression {pattern!r}: {e}")
+
+class PlaylistRules(BaseModel):
+    include_groups: List[str] = Field(default_factory=list)  # regex sul group-title
+    name_regex: Optional[str] = None
+    require_tvg_id: bool = False
+    exclude_dead: bool = True
+    source_playlist_ids: List[int] = Field(default_factory=list)  # vuoto = tutte
+
+    @field_validator('include_groups')
+    @classmethod
+    def validate_group_patterns(cls, value: List[str]) -> List[str]:
+        for pattern in value:
+            _check_regex(pattern)
+        return value
+
+    @field_validator('name_regex')
+    @classmethod
+    def validate_name_regex(cls, value: Optional[str]) -> Optional[str]:
+        if value is not None:
+            _check_regex(value)
+        return value
+
 # Playlist models
 class PlaylistBase(BaseModel):
     name: str
     url: Optional[str] = None
     is_custom: bool = False
     epg_url: Optional[str] = None
+    rules: Optional[PlaylistRules] = None
 
 class PlaylistCreate(PlaylistBase):
     pass
@@ -36,6 +66,7 @@ class PlaylistUpdate(BaseModel):
     name: Optional[str] = None
     url: Optional[str] = None
     epg_url: Optional[str] = None
+    rules: Optional[PlaylistRules] = None
 
 # Channel models
 class ChannelBase(BaseModel):
@@ -46,6 +77,8 @@ class ChannelBase(BaseModel):
     tvg_id: Optional[str] = None
     position: Optional[int] = None
     extra_tags: Optional[Dict[str, str]] = Field(default_factory=dict)
+    attributes: Optional[Dict[str, str]] = Field(default_factory=dict)  # altri attributi #EXTINF
+    is_dead: bool = False
 
 class ChannelCreate(ChannelBase):
     pass
@@ -57,6 +90,8 @@ class ChannelUpdate(BaseModel):
     logo_url: Optional[str] = None
     tvg_id: Optional[str] = None
     extra_tags: Optional[Dict[str, str]] = None
+    attributes: Optional[Dict[str, str]] = None
+    is_dead: Optional[bool] = None
 
 class Channel(ChannelBase):
     id: int
@@ -83,6 +118,25 @@ class ChannelOrder(BaseModel):
     id: int
     position: int
 
+# Channel group models
+class ChannelGroup(BaseModel):
+    name: str  # '' = canali senza group-title
+    channel_count: int
+    first_position: Optional[int] = None
+    hidden: bool = False
+
+class GroupSelection(BaseModel):
+    groups: List[str] = Field(min_length=1)
+
+class GroupRename(GroupSelection):
+    name: str
+
+class GroupVisibility(GroupSelection):
+    hidden: bool
+
+class GroupMove(GroupSelection):
+    before: Optional[str] = None  # gruppo davanti al quale spostare; None = in fondo
+
 # Custom Playlist Channel Add
 class CustomPlaylistChannelAdd(BaseModel):
     channel_id: int
@@ -0,0 +1,46 @@
+"""Password hashing off the event loop.
+
+A bcrypt check takes a few hundred milliseconds of CPU by design; run inside an
+async route it stops every other request of the worker meanwhile. Logins check
+passwords in a small thread pool instead (bcrypt releases the GIL),
+PASSWORD_HASH_WORKERS threads per worker process (default up to 4), so a burst
+of logins queues there while the API keeps serving.
+
+New hashes use BCRYPT_ROUNDS (default 12). Stored hashes with another cost are
+replaced on the user's next successful login, so changing it needs no
+migration.
+"""
+from typing import Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import os
+
+from passlib.context import CryptContext
+
+from metrics import PASSWORD_VERIFY_SECONDS
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+
+# min = max = default: gli hash con un altro costo risultano da aggiornare
+_context = CryptContext(
+    schemes=["bcrypt"],
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS
+)
+_pool = ThreadPoolExecutor(
+    max_workers=int(os.getenv("PASSWORD_HASH_WORKERS", min(4, os.cpu_count() or 1))),
+    thread_name_prefix="password-hash"
+)
+
+def hash_password(password: str) -> str:
+    """Hash a password right away (for startup code, not for request handlers)"""
+    return _context.hash(password)
+
+def _verify(password: str, password_hash: str) -> Tuple[bool, Optional[str]]:
+    with PASSWORD_VERIFY_SECONDS.time():
+        return _context.verify_and_update(password, password_hash)
+
+async def verify_password(password: str, password_hash: str) -> Tuple[bool, Optional[str]]:
+    """Check a password; on success also returns a new hash when the stored one has another cost"""
+    return await asyncio.get_running_loop().run_in_executor(_pool, _verify, password, password_hash)
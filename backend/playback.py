@@ -0,0 +1,182 @@
+"""Failover redirects for the streams of public playlists.
+
+With PLAY_REDIRECT_URL set to the public base URL of the API, public playlists
+point each stream to PLAY_REDIRECT_URL/play/{token}/{channel id} instead of the
+provider. A redirect goes to that channel's own stream unless it is marked
+dead. Only then the channel's key comes into play: its tvg-id, or its
+normalized name when it has none, which equivalent channels share ("Rai 1 HD"
+and "Rai 1 SD", feeds with the same tvg-id). The redirect goes to a live
+channel with the same key, in the same playlist first and then in the other
+playlists of the same user.
+
+Redirects are resolved from memory. Each user's sources are loaded on their
+first redirect and checked against the render cache version, which every
+change to the user's data moves in all workers; when it moved, only the
+playlists whose version changed (see changes.py) are read again.
+"""
+from typing import Dict, List, Optional, Tuple
+from collections import OrderedDict
+import asyncio
+import hashlib
+import os
+import re
+import unicodedata
+
+from m3u_utils import M3UChannel
+from repository import repo
+from render_cache import render_cache
+from metrics import PLAY_REDIRECTS, PLAY_INDEX_CHANNELS
+
+# Indicazioni di qualità ignorate nel confronto dei nomi ("Rai 1 HD" = "Rai 1")
+QUALITY_WORDS = frozenset(('hd', 'fhd', 'uhd', 'sd', '4k', '8k', 'hevc', 'h265', '720p', '1080p', '2160p'))
+NON_WORD = re.compile(r'[\W_]+')
+CHANNEL_ID = re.compile(r'^[0-9]{1,18}$')
+
+def normalize_name(name: str) -> str:
+    text = unicodedata.normalize('NFKD', name).casefold()
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    words = NON_WORD.sub(' ', text).split()
+    return ' '.join(word for word in words if word not in QUALITY_WORDS) or ' '.join(words)
+
+def channel_key(name: str, tvg_id: Optional[str]) -> str:
+    """Key shared by equivalent channels: same tvg-id, or same normalized name without one"""
+    tvg_id = (tvg_id or '').strip()
+    identity = f"tvg:{tvg_id.casefold()}" if tvg_id else f"name:{normalize_name(name or '')}"
+    return hashlib.blake2b(identity.encode(), digest_size=8).hexdigest()
+
+class PlaylistSources:
+    """Stream URLs of one playlist by channel id and, in render order, by channel key"""
+    __slots__ = ('version', 'is_custom', 'channels', 'keys', 'count')
+
+    def __init__(self, version: int, is_custom: bool, rows: List[Dict]):
+        self.version = version
+        self.is_custom = is_custom
+        # id -> (URL, morto, chiave)
+        self.channels: Dict[int, Tuple[str, bool, str]] = {}
+        self.keys: Dict[str, List[Tuple[str, bool]]] = {}
+        for row in rows:
+            key = channel_key(row['name'], row['tvg_id'])
+            self.channels[row['id']] = (row['url'], bool(row['is_dead']), key)
+            self.keys.setdefault(key, []).append((row['url'], bool(row['is_dead'])))
+        self.count = len(rows)
+
+class UserSources:
+    def __init__(self, version: int):
+        self.version = version
+        self.playlists: Dict[int, PlaylistSources] = {}
+        self.tokens: Dict[str, int] = {}
+
+    @property
+    def count(self) -> int:
+        return sum(sources.count for sources in self.playlists.values())
+
+    def resolve(self, playlist_id: int, channel_id: int) -> Tuple[Optional[str], str]:
+        """URL to redirect to and how it was picked"""
+        playlist = self.playlists[playlist_id]
+        # Solo i canali della playlist: il token non dà accesso agli altri
+        own = playlist.channels.get(channel_id)
+        if own is None:
+            return None, "not_found"
+        url, dead, key = own
+        if not dead:
+            return url, "own"
+        # Prima gli equivalenti della stessa playlist, poi quelli delle altre
+        for sources in (playlist, *self.playlists.values()):
+            # I canali delle playlist custom sono già nelle playlist di origine
+            if sources.is_custom and sources is not playlist:
+                continue
+            for candidate, candidate_dead in sources.keys.get(key, ()):
+                if not candidate_dead:
+                    return candidate, "failover"
+        # Nessuna alternativa: meglio l'originale che un errore
+        return url, "dead"
+
+class PlaybackIndex:
+    def __init__(self, redirect_url: Optional[str], max_channels: int):
+        self.redirect_url = redirect_url.rstrip('/') if redirect_url else None
+        self.max_channels = max_channels
+        self.size = 0
+        self._users: "OrderedDict[int, UserSources]" = OrderedDict()
+        # token pubblico -> utente, per non interrogare il database a ogni redirect
+        self._owners: Dict[str, int] = {}
+        self._locks: Dict[int, asyncio.Lock] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.redirect_url is not None
+
+    def rewrite(self, token: str, channels: List[Tuple[int, M3UChannel]]):
+        """Point the streams of a public playlist's (id, channel) pairs to the redirect endpoint"""
+        for channel_id, channel in channels:
+            channel.url = f"{self.redirect_url}/play/{token}/{channel_id}"
+
+    async def resolve(self, token: str, channel_id: str) -> Optional[str]:
+        url, result = None, "not_found"
+        if CHANNEL_ID.match(channel_id):
+            url, result = await self._resolve(token, int(channel_id))
+        PLAY_REDIRECTS.inc(result=result)
+        return url
+
+    async def _resolve(self, token: str, channel_id: int) -> Tuple[Optional[str], str]:
+        user_id = self._owners.get(token)
+        if user_id is None:
+            playlist = await repo.find_public_playlist(token)
+            if playlist is None:
+                return None, "not_found"
+            user_id = self._owners[token] = playlist['user_id']
+
+        sources = await self._user(user_id)
+        playlist_id = sources.tokens.get(token)
+        if playlist_id is None:
+            # Token revocato
+            self._owners.pop(token, None)
+            return None, "not_found"
+        return sources.resolve(playlist_id, channel_id)
+
+    async def _user(self, user_id: int) -> UserSources:
+        version = await render_cache.version(user_id)
+        sources = self._users.get(user_id)
+        if sources is not None and sources.version == version and version >= 0:
+            self._users.move_to_end(user_id)
+            return sources
+
+        lock = self._locks.setdefault(user_id, asyncio.Lock())
+        async with lock:
+            sources = self._users.get(user_id)
+            if sources is None or sources.version != version or version < 0:
+                sources = await self._load(user_id, version, sources)
+            self._users[user_id] = sources
+            self._users.move_to_end(user_id)
+        self._evict(user_id)
+        return sources
+
+    async def _load(self, user_id: int, version: int, previous: Optional[UserSources]) -> UserSources:
+        """Read the user's sources again, reusing the playlists whose version did not move"""
+        sources = UserSources(version)
+        for playlist in await repo.playback_playlists(user_id):
+            known = previous.playlists.get(playlist['id']) if previous else None
+            if known is None or known.version != playlist['version']:
+                known = PlaylistSources(
+                    playlist['version'], bool(playlist['is_custom']),
+                    await repo.playback_sources(user_id, playlist)
+                )
+            sources.playlists[playlist['id']] = known
+            if playlist['public_token']:
+                sources.tokens[playlist['public_token']] = playlist['id']
+        return sources
+
+    def _evict(self, current: int):
+        self.size = sum(sources.count for sources in self._users.values())
+        while self.size > self.max_channels and len(self._users) > 1:
+            user_id = next(iter(self._users))
+            if user_id == current:
+                self._users.move_to_end(user_id)
+                continue
+            self.size -= self._users.pop(user_id).count
+            self._locks.pop(user_id, None)
+        PLAY_INDEX_CHANNELS.set(self.size)
+
+playback_index = PlaybackIndex(
+    redirect_url=os.getenv("PLAY_REDIRECT_URL") or None,
+    max_channels=int(os.getenv("PLAY_INDEX_MAX_CHANNELS", 2_000_000))
+)
@@ -0,0 +1,978 @@
+"""PostgreSQL storage backend for multi-replica deployments (requires asyncpg)"""
+from typing import AsyncIterator, Callable, Dict, List, Optional, Set, Tuple
+import json
+import os
+
+import asyncpg
+from passwords import hash_password
+
+from changes import (
+    ADDED, UPDATED, MOVED, REMOVED, CHANGE_LOG_MAX_ENTRIES, sync_changes, resolve_changes
+)
+from groups import GROUP_KEY, diff_groups, group_name, upsert_groups_sql
+from m3u_utils import M3UChannel
+from metrics import SYNC_STAGE_SECONDS
+from repository import Repository, DuplicateChannelError, PLAYLIST_EXPORT_FIELDS, channel_from_row
+from rules import RuleMatcher, membership_changes
+from sync import SyncDiff, WRITE_CHUNK_SIZE, chunked, diff_channels
+from tag_sets import encode_tags, tag_set_cache
+
+# Chiave dell'advisory lock che serializza la creazione dello schema tra repliche
+_SCHEMA_LOCK = 0x4F4D47
+
+# JSON e non JSONB: l'ordine degli attributi si riflette nelle playlist generate
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id BIGSERIAL PRIMARY KEY,
+    username TEXT NOT NULL UNIQUE,
+    password_hash TEXT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS playlists (
+    id BIGSERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL REFERENCES users (id),
+    name TEXT NOT NULL,
+    url TEXT,
+    is_custom BOOLEAN NOT NULL DEFAULT FALSE,
+    public_token TEXT UNIQUE,
+    epg_url TEXT,
+    last_sync TIMESTAMPTZ,
+    rules JSON,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS idx_playlists_user ON playlists (user_id);
+
+CREATE TABLE IF NOT EXISTS tag_sets (
+    id BIGSERIAL PRIMARY KEY,
+    tags TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS channels (
+    id BIGSERIAL PRIMARY KEY,
+    playlist_id BIGINT NOT NULL REFERENCES playlists (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    url TEXT NOT NULL,
+    group_title TEXT,
+    logo_url TEXT,
+    tvg_id TEXT,
+    position INTEGER,
+    extra_tags JSON,
+    tag_set_id BIGINT REFERENCES tag_sets (id),
+    attributes JSON,
+    is_dead BOOLEAN NOT NULL DEFAULT FALSE,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+ALTER TABLE channels ADD COLUMN IF NOT EXISTS tag_set_id BIGINT REFERENCES tag_sets (id);
+CREATE INDEX IF NOT EXISTS idx_channels_playlist ON channels (playlist_id, position);
+CREATE INDEX IF NOT EXISTS idx_channels_group ON channels (playlist_id, (COALESCE(group_title, '')), position);
+
+CREATE TABLE IF NOT EXISTS channel_groups (
+    playlist_id BIGINT NOT NULL REFERENCES playlists (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    channel_count INTEGER NOT NULL DEFAULT 0,
+    first_position INTEGER,
+    hidden BOOLEAN NOT NULL DEFAULT FALSE,
+    PRIMARY KEY (playlist_id, name)
+);
+
+CREATE TABLE IF NOT EXISTS custom_playlist_channels (
+    playlist_id BIGINT NOT NULL REFERENCES playlists (id) ON DELETE CASCADE,
+    channel_id BIGINT NOT NULL REFERENCES channels (id) ON DELETE CASCADE,
+    position INTEGER,
+    PRIMARY KEY (playlist_id, channel_id)
+);
+CREATE INDEX IF NOT EXISTS idx_custom_playlist_channels_channel ON custom_playlist_channels (channel_id);
+
+ALTER TABLE playlists ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE playlists ADD COLUMN IF NOT EXISTS changes_since INTEGER NOT NULL DEFAULT 0;
+CREATE TABLE IF NOT EXISTS playlist_changes (
+    id BIGSERIAL PRIMARY KEY,
+    playlist_id BIGINT NOT NULL REFERENCES playlists (id) ON DELETE CASCADE,
+    version INTEGER NOT NULL,
+    channel_id BIGINT NOT NULL,
+    kind TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_playlist_changes_version ON playlist_changes (playlist_id, version);
+"""
+
+# extra_tags scritti prima dei tag set condivisi (la colonna resta ma non viene più scritta)
+_MIGRATE_TAGS = """
+INSERT INTO tag_sets (tags)
+SELECT DISTINCT extra_tags::text FROM channels
+WHERE tag_set_id IS NULL AND extra_tags IS NOT NULL AND extra_tags::text NOT IN ('{}', 'null')
+ON CONFLICT DO NOTHING;
+
+UPDATE channels c SET tag_set_id = t.id
+FROM tag_sets t
+WHERE c.tag_set_id IS NULL AND c.extra_tags IS NOT NULL AND t.tags = c.extra_tags::text;
+
+UPDATE channels SET extra_tags = NULL WHERE extra_tags IS NOT NULL;
+"""
+
+_CANDIDATES_QUERY = """
+    SELECT c.id, c.playlist_id, c.name, c.group_title, c.tvg_id, c.is_dead
+    FROM channels c
+    JOIN playlists p ON c.playlist_id = p.id
+    WHERE p.user_id = $1 AND NOT p.is_custom
+"""
+
+_CHANNEL_COLUMNS = ('name', 'url', 'group_title', 'logo_url', 'tvg_id', 'position', 'tag_set_id', 'attributes')
+
+def _encode_json(value) -> bytes:
+    return json.dumps(value).encode()
+
+async def _init_connection(conn):
+    # JSON <-> dict, come il converter JSON registrato per SQLite; in binario perché
+    # copy_records_to_table usa il formato binario di COPY
+    await conn.set_type_codec(
+        'json', encoder=_encode_json, decoder=json.loads,
+        schema='pg_catalog', format='binary'
+    )
+
+def _dict(record) -> Optional[Dict]:
+    return dict(record) if record is not None else None
+
+def _channel_record(channel: M3UChannel, position: int, tvg_id: Optional[str], tag_set_id: Optional[int]) -> Tuple:
+    return (channel.name, channel.url, channel.group, channel.logo, tvg_id, position, tag_set_id, channel.attributes)
+
+_EXPORT_COLUMNS = "c.id, c.name, c.url, c.group_title, c.logo_url, c.tvg_id, c.tag_set_id, c.attributes"
+
+def _export_query(playlist: Dict, filtered: bool = False, columns: str = _EXPORT_COLUMNS) -> str:
+    """Channels a playlist renders, in order ($1 playlist id, $2 channel ids when `filtered`)"""
+    only = "AND c.id = ANY($2::bigint[])" if filtered else ""
+    if playlist['is_custom']:
+        return f"""
+            SELECT {columns}, cpc.position
+            FROM channels c
+            JOIN custom_playlist_channels cpc ON c.id = cpc.channel_id
+            WHERE cpc.playlist_id = $1 {only}
+            ORDER BY cpc.position, c.name
+        """
+    # I gruppi nascosti restano fuori dall'export
+    return f"""
+        SELECT {columns}, c.position
+        FROM channels c
+        WHERE c.playlist_id = $1 {only} AND NOT EXISTS (
+            SELECT 1 FROM channel_groups g
+            WHERE g.playlist_id = c.playlist_id AND g.name = {GROUP_KEY} AND g.hidden
+        )
+        ORDER BY c.position, c.created_at, c.id
+    """
+
+class PostgresRepository(Repository):
+    """Repository on a PostgreSQL connection pool; bulk loads use COPY"""
+    name = 'postgres'
+
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self.pool: Optional[asyncpg.Pool] = None
+        self.tag_sets = tag_set_cache(dsn)
+
+    async def init(self):
+        self.pool = await asyncpg.create_pool(
+            self.dsn,
+            min_size=int(os.getenv("PG_POOL_MIN_SIZE", 2)),
+            max_size=int(os.getenv("PG_POOL_MAX_SIZE", 10)),
+            init=_init_connection
+        )
+        async with self.pool.acquire() as conn, conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", _SCHEMA_LOCK)
+            fresh_groups = not await conn.fetchval("SELECT to_regclass('channel_groups') IS NOT NULL")
+            await conn.execute(SCHEMA)
+            await conn.execute(_MIGRATE_TAGS)
+            if fresh_groups:
+                await conn.execute(upsert_groups_sql("TRUE"))
+            if not await conn.fetchval("SELECT 1 FROM users WHERE username = 'admin'"):
+                await conn.execute(
+                    "INSERT INTO users (username, password_hash) VALUES ($1, $2)",
+                    "admin", hash_password("admin")
+                )
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+
+    # Tag set (vedi tag_sets.py)
+    async def _intern_tags(self, conn, sets: List[Optional[Dict[str, str]]],
+                           created: Dict[str, int]) -> List[Optional[int]]:
+        """Tag set ids for `sets`, inserting the missing ones through `conn`.
+
+        New entries are collected in `created` and cached by _remember_tags only
+        after the transaction commits: a rolled back id must not be reused.
+        """
+        texts = [encode_tags(tags) for tags in sets]
+        # Ordinati: due transazioni concorrenti prendono i lock nello stesso ordine
+        unknown = sorted({
+            text for text in texts
+            if text is not None and self.tag_sets.id_for(text) is None and text not in created
+        })
+        if unknown:
+            await conn.execute(
+                "INSERT INTO tag_sets (tags) SELECT unnest($1::text[]) ON CONFLICT DO NOTHING",
+                unknown
+            )
+            for row in await conn.fetch(
+                "SELECT id, tags FROM tag_sets WHERE tags = ANY($1::text[])", unknown
+            ):
+                created[row['tags']] = row['id']
+        return [
+            None if text is None else (self.tag_sets.id_for(text) or created[text])
+            for text in texts
+        ]
+
+    def _remember_tags(self, created: Dict[str, int]):
+        for text, tag_set_id in created.items():
+            self.tag_sets.remember(tag_set_id, text)
+
+    async def _load_tags(self, conn, rows) -> List[Dict]:
+        """Rows as dicts, with tag_set_id replaced by the decoded extra_tags"""
+        rows = [dict(row) for row in rows]
+        missing = self.tag_sets.missing(row['tag_set_id'] for row in rows)
+        if missing:
+            for row in await conn.fetch(
+                "SELECT id, tags FROM tag_sets WHERE id = ANY($1::bigint[])", missing
+            ):
+                self.tag_sets.load(row['id'], row['tags'])
+        return self.tag_sets.attach(rows)
+
+    # Utenti
+    async def get_user(self, username: str) -> Optional[Dict]:
+        return _dict(await self.pool.fetchrow("SELECT * FROM users WHERE username = $1", username))
+
+    async def set_password_hash(self, user_id: int, password_hash: str):
+        await self.pool.execute("UPDATE users SET password_hash = $1 WHERE id = $2", password_hash, user_id)
+
+    # Playlist
+    async def list_playlists(self, user_id: int) -> List[Dict]:
+        async with self.pool.acquire() as conn:
+            playlists = [dict(row) for row in await conn.fetch(
+                "SELECT * FROM playlists WHERE user_id = $1 ORDER BY created_at, id",
+                user_id
+            )]
+            channels: Dict[int, List[Dict]] = {playlist['id']: [] for playlist in playlists}
+            for row in await self._load_tags(conn, await conn.fetch(
+                """
+                SELECT c.* FROM channels c
+                JOIN playlists p ON c.playlist_id = p.id
+                WHERE p.user_id = $1
+                ORDER BY c.playlist_id, c.position, c.created_at, c.id
+                """,
+                user_id
+            )):
+                channels[row['playlist_id']].append(row)
+        for playlist in playlists:
+            playlist['channels'] = channels[playlist['id']]
+        return playlists
+
+    async def get_playlist(self, user_id: int, playlist_id: int, custom_only: bool = False) -> Optional[Dict]:
+        query = "SELECT * FROM playlists WHERE id = $1 AND user_id = $2"
+        if custom_only:
+            query += " AND is_custom"
+        return _dict(await self.pool.fetchrow(query, playlist_id, user_id))
+
+    async def get_playlist_channels(self, user_id: int, playlist_id: int) -> List[Dict]:
+        async with self.pool.acquire() as conn:
+            return await self._load_tags(conn, await conn.fetch(
+                "SELECT * FROM channels WHERE playlist_id = $1 ORDER BY position, created_at, id",
+                playlist_id
+            ))
+
+    async def create_playlist(self, user_id: int, data: Dict) -> Dict:
+        async with self.pool.acquire() as conn, conn.transaction():
+            playlist = dict(await conn.fetchrow(
+                """
+                INSERT INTO playlists (user_id, name, url, is_custom, public_token, epg_url, rules)
+                VALUES ($1, $2, $3, $4, $5, $6, $7)
+                RETURNING *
+                """,
+                user_id, data['name'], data.get('url'), data.get('is_custom', False),
+                data.get('public_token'), data.get('epg_url'), data.get('rules')
+            ))
+            if playlist['rules']:
+                await self._materialize(conn, playlist)
+        return playlist
+
+    async def update_playlist(self, user_id: int, playlist_id: int, fields: Dict):
+        if not fields:
+            return
+        columns = list(fields)
+        assignments = [f'{name} = ${i}' for i, name in enumerate(columns, start=3)]
+        # Nessun canale cambiato, ma l'export sì: le copie pubblicate vanno rifatte
+        if any(name in fields for name in PLAYLIST_EXPORT_FIELDS):
+            assignments.append('version = version + 1')
+        async with self.pool.acquire() as conn, conn.transaction():
+            await conn.execute(
+                f"UPDATE playlists SET {', '.join(assignments)} WHERE id = $1 AND user_id = $2",
+                playlist_id, user_id, *[fields[name] for name in columns]
+            )
+            if fields.get('rules') is not None:
+                await self._materialize(conn, {'id': playlist_id, 'user_id': user_id, 'rules': fields['rules']})
+
+    async def delete_playlist(self, user_id: int, playlist_id: int):
+        async with self.pool.acquire() as conn, conn.transaction():
+            members = await self._custom_memberships(
+                conn, [row['id'] for row in await conn.fetch(
+                    "SELECT id FROM channels WHERE playlist_id = $1", playlist_id
+                )]
+            )
+            members.pop(playlist_id, None)
+            # Canali, collegamenti e log vengono rimossi da ON DELETE CASCADE
+            await conn.execute("DELETE FROM playlists WHERE id = $1 AND user_id = $2", playlist_id, user_id)
+            await self._record_member_changes(conn, members, REMOVED)
+
+    async def set_public_token(self, user_id: int, playlist_id: int, token: Optional[str]):
+        await self.pool.execute(
+            "UPDATE playlists SET public_token = $3 WHERE id = $1 AND user_id = $2",
+            playlist_id, user_id, token
+        )
+
+    async def find_public_playlist(self, token: str) -> Optional[Dict]:
+        return _dict(await self.pool.fetchrow("SELECT * FROM playlists WHERE public_token = $1", token))
+
+    async def public_playlists(self, user_id: int) -> List[Dict]:
+        rows = await self.pool.fetch(
+            "SELECT * FROM playlists WHERE user_id = $1 AND public_token IS NOT NULL ORDER BY id", user_id
+        )
+        return [dict(row) for row in rows]
+
+    async def public_playlist_owners(self) -> List[int]:
+        rows = await self.pool.fetch("SELECT DISTINCT user_id FROM playlists WHERE public_token IS NOT NULL")
+        return [row['user_id'] for row in rows]
+
+    # Canali
+    async def add_channel(self, user_id: int, playlist_id: int, data: Dict) -> Dict:
+        created: Dict[str, int] = {}
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                tag_set_id, = await self._intern_tags(conn, [data.get('extra_tags')], created)
+                channel = await conn.fetchrow(
+                    """
+                    INSERT INTO channels
+                    (playlist_id, name, url, group_title, logo_url, position, tvg_id,
+                     tag_set_id, attributes, is_dead)
+                    SELECT $1, $2, $3, $4, $5,
+                           COALESCE(MAX(position), 0) + 1, $6, $7, $8, $9
+                    FROM channels WHERE playlist_id = $1
+                    RETURNING *
+                    """,
+                    playlist_id, data['name'], data['url'], data.get('group_title'),
+                    data.get('logo_url'), data.get('tvg_id'), tag_set_id,
+                    data.get('attributes') or {}, data.get('is_dead', False)
+                )
+                await self._refresh_groups(conn, playlist_id, {group_name(channel['group_title'])})
+                await self._record_changes(conn, playlist_id, [(channel['id'], ADDED)])
+                await self._refresh_rule_playlists(conn, user_id, [channel['id']])
+            self._remember_tags(created)
+            return (await self._load_tags(conn, [channel]))[0]
+
+    async def get_channel(self, user_id: int, channel_id: int) -> Optional[Dict]:
+        async with self.pool.acquire() as conn:
+            channel = await conn.fetchrow(
+                """
+                SELECT c.* FROM channels c
+                JOIN playlists p ON c.playlist_id = p.id
+                WHERE c.id = $1 AND p.user_id = $2
+                """,
+                channel_id, user_id
+            )
+            return (await self._load_tags(conn, [channel]))[0] if channel else None
+
+    async def update_channel(self, user_id: int, channel_id: int, fields: Dict) -> Optional[Dict]:
+        created: Dict[str, int] = {}
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                previous = await conn.fetchrow(
+                    "SELECT playlist_id, group_title FROM channels WHERE id = $1 FOR UPDATE", channel_id
+                )
+                if previous is None:
+                    return None
+                if fields:
+                    fields = dict(fields)
+                    if 'extra_tags' in fields:
+                        fields['tag_set_id'], = await self._intern_tags(conn, [fields.pop('extra_tags')], created)
+                    columns = list(fields)
+                    assignments = ', '.join(f'{name} = ${i}' for i, name in enumerate(columns, start=2))
+                    await conn.execute(
+                        f"UPDATE channels SET {assignments} WHERE id = $1",
+                        channel_id, *[fields[name] for name in columns]
+                    )
+                    if 'group_title' in fields:
+                        await self._refresh_groups(conn, previous['playlist_id'], {
+                            group_name(previous['group_title']), group_name(fields['group_title'])
+                        })
+                    await self._record_changes(conn, previous['playlist_id'], [(channel_id, UPDATED)])
+                    await self._record_member_changes(
+                        conn, await self._custom_memberships(conn, [channel_id]), UPDATED
+                    )
+                    await self._refresh_rule_playlists(conn, user_id, [channel_id])
+            self._remember_tags(created)
+            return (await self._load_tags(conn, await conn.fetch(
+                "SELECT * FROM channels WHERE id = $1", channel_id
+            )))[0]
+
+    async def delete_channel(self, user_id: int, channel_id: int):
+        async with self.pool.acquire() as conn, conn.transaction():
+            members = await self._custom_memberships(conn, [channel_id])
+            channel = await conn.fetchrow(
+                "DELETE FROM channels WHERE id = $1 RETURNING playlist_id, group_title", channel_id
+            )
+            if channel:
+                await self._refresh_groups(conn, channel['playlist_id'], {group_name(channel['group_title'])})
+                await self._record_changes(conn, channel['playlist_id'], [(channel_id, REMOVED)])
+                await self._record_member_changes(conn, members, REMOVED)
+
+    async def reorder_channels(self, user_id: int, playlist: Dict, orders: List[Tuple[int, int]]):
+        if playlist['is_custom']:
+            query = "UPDATE custom_playlist_channels SET position = $3 WHERE playlist_id = $1 AND channel_id = $2"
+        else:
+            query = "UPDATE channels SET position = $3 WHERE playlist_id = $1 AND id = $2"
+        async with self.pool.acquire() as conn, conn.transaction():
+            await conn.executemany(
+                query,
+                [(playlist['id'], channel_id, position) for channel_id, position in orders]
+            )
+            if not playlist['is_custom']:
+                await self._refresh_groups(conn, playlist['id'])
+            await self._record_changes(conn, playlist['id'], [(channel_id, MOVED) for channel_id, _ in orders])
+
+    async def available_channels(self, user_id: int, playlist_id: int) -> List[Dict]:
+        async with self.pool.acquire() as conn:
+            return await self._load_tags(conn, await conn.fetch(
+                """
+                SELECT c.*, p.name AS source_playlist_name
+                FROM channels c
+                JOIN playlists p ON c.playlist_id = p.id
+                WHERE p.user_id = $1 AND c.id NOT IN (
+                    SELECT channel_id FROM custom_playlist_channels WHERE playlist_id = $2
+                )
+                ORDER BY p.name, c.position, c.name
+                """,
+                user_id, playlist_id
+            ))
+
+    # Playlist custom
+    async def add_custom_channel(self, user_id: int, playlist_id: int, channel_id: int):
+        try:
+            async with self.pool.acquire() as conn, conn.transaction():
+                await conn.execute(
+                    """
+                    INSERT INTO custom_playlist_channels (playlist_id, channel_id, position)
+                    SELECT $1, $2, COALESCE(MAX(position), 0) + 1
+                    FROM custom_playlist_channels WHERE playlist_id = $1
+                    """,
+                    playlist_id, channel_id
+                )
+                await self._record_changes(conn, playlist_id, [(channel_id, ADDED)])
+        except asyncpg.UniqueViolationError:
+            raise DuplicateChannelError()
+
+    async def remove_custom_channel(self, user_id: int, playlist_id: int, channel_id: int):
+        async with self.pool.acquire() as conn, conn.transaction():
+            result = await conn.execute(
+                "DELETE FROM custom_playlist_channels WHERE playlist_id = $1 AND channel_id = $2",
+                playlist_id, channel_id
+            )
+            if int(result.split()[-1]):
+                await self._record_changes(conn, playlist_id, [(channel_id, REMOVED)])
+
+    async def set_rules(self, user_id: int, playlist: Dict, rules: Optional[Dict]) -> Dict[str, int]:
+        async with self.pool.acquire() as conn, conn.transaction():
+            await conn.execute("UPDATE playlists SET rules = $2 WHERE id = $1", playlist['id'], rules)
+            if rules is None:
+                return {}
+            return await self._materialize(conn, dict(playlist, rules=rules))
+
+    async def refresh_rules(self, user_id: int, playlist: Dict) -> Dict[str, int]:
+        async with self.pool.acquire() as conn, conn.transaction():
+            return await self._materialize(conn, playlist)
+
+    # Regole (stessa logica di rules.py, con array al posto dei blocchi di placeholder)
+    async def _apply_membership(self, conn, playlist_id: int, matching: List[int],
+                                evaluated: Optional[List[int]] = None) -> Dict[str, int]:
+        if evaluated is None:
+            rows = await conn.fetch(
+                "SELECT channel_id FROM custom_playlist_channels WHERE playlist_id = $1",
+                playlist_id
+            )
+        else:
+            rows = await conn.fetch(
+                """
+                SELECT channel_id FROM custom_playlist_channels
+                WHERE playlist_id = $1 AND channel_id = ANY($2::bigint[])
+                """,
+                playlist_id, list(evaluated)
+            )
+        to_add, to_remove = membership_changes({row['channel_id'] for row in rows}, matching)
+
+        if to_remove:
+            await conn.execute(
+                "DELETE FROM custom_playlist_channels WHERE playlist_id = $1 AND channel_id = ANY($2::bigint[])",
+                playlist_id, to_remove
+            )
+        if to_add:
+            await conn.execute(
+                """
+                INSERT INTO custom_playlist_channels (playlist_id, channel_id, position)
+                SELECT $1, added.channel_id,
+                       (SELECT COALESCE(MAX(position), 0) FROM custom_playlist_channels WHERE playlist_id = $1)
+                       + added.ordinality
+                FROM unnest($2::bigint[]) WITH ORDINALITY AS added (channel_id, ordinality)
+                ON CONFLICT DO NOTHING
+                """,
+                playlist_id, to_add
+            )
+        await self._record_changes(
+            conn, playlist_id,
+            [(channel_id, REMOVED) for channel_id in to_remove] + [(channel_id, ADDED) for channel_id in to_add]
+        )
+        return {"added": len(to_add), "removed": len(to_remove)}
+
+    async def _materialize(self, conn, playlist: Dict) -> Dict[str, int]:
+        matcher = RuleMatcher(playlist['rules'])
+        rows = await conn.fetch(
+            _CANDIDATES_QUERY + " ORDER BY c.playlist_id, c.position, c.id",
+            playlist['user_id']
+        )
+        matching = [row['id'] for row in rows if matcher.matches(row)]
+        return await self._apply_membership(conn, playlist['id'], matching)
+
+    async def _refresh_rule_playlists(self, conn, user_id: int, channel_ids: List[int]):
+        playlists = await conn.fetch(
+            "SELECT id, user_id, rules FROM playlists WHERE user_id = $1 AND is_custom AND rules IS NOT NULL",
+            user_id
+        )
+        if not playlists or not channel_ids:
+            return
+        rows = await conn.fetch(
+            _CANDIDATES_QUERY + " AND c.id = ANY($2::bigint[]) ORDER BY c.playlist_id, c.position, c.id",
+            user_id, list(channel_ids)
+        )
+        for playlist in playlists:
+            matcher = RuleMatcher(playlist['rules'])
+            matching = [row['id'] for row in rows if matcher.matches(row)]
+            await self._apply_membership(conn, playlist['id'], matching, channel_ids)
+
+    # Log delle modifiche (stessa logica di changes.py)
+    async def _record_changes(self, conn, playlist_id: int, changes: List[Tuple[int, str]]):
+        if not changes:
+            return
+        version = await conn.fetchval(
+            "UPDATE playlists SET version = version + 1 WHERE id = $1 RETURNING version", playlist_id
+        )
+        if version is None:
+            return
+
+        if len(changes) > CHANGE_LOG_MAX_ENTRIES:
+            # Troppe righe: i client ripartono da uno snapshot completo
+            await conn.execute("DELETE FROM playlist_changes WHERE playlist_id = $1", playlist_id)
+            await conn.execute("UPDATE playlists SET changes_since = $2 WHERE id = $1", playlist_id, version)
+            return
+
+        await conn.execute(
+            """
+            INSERT INTO playlist_changes (playlist_id, version, channel_id, kind)
+            SELECT $1, $2, entry.channel_id, entry.kind
+            FROM unnest($3::bigint[], $4::text[]) AS entry (channel_id, kind)
+            """,
+            playlist_id, version, [channel_id for channel_id, _ in changes], [kind for _, kind in changes]
+        )
+        cutoff = await conn.fetchval(
+            """
+            SELECT version FROM playlist_changes
+            WHERE playlist_id = $1
+            ORDER BY version DESC
+            LIMIT 1 OFFSET $2
+            """,
+            playlist_id, CHANGE_LOG_MAX_ENTRIES
+        )
+        if cutoff is not None:
+            await conn.execute(
+                "DELETE FROM playlist_changes WHERE playlist_id = $1 AND version <= $2", playlist_id, cutoff
+            )
+            await conn.execute("UPDATE playlists SET changes_since = $2 WHERE id = $1", playlist_id, cutoff)
+
+    async def _custom_memberships(self, conn, channel_ids: List[int]) -> Dict[int, List[int]]:
+        memberships: Dict[int, List[int]] = {}
+        if channel_ids:
+            for row in await conn.fetch(
+                "SELECT playlist_id, channel_id FROM custom_playlist_channels WHERE channel_id = ANY($1::bigint[])",
+                channel_ids
+            ):
+                memberships.setdefault(row['playlist_id'], []).append(row['channel_id'])
+        return memberships
+
+    async def _record_member_changes(self, conn, memberships: Dict[int, List[int]], kind: str):
+        for playlist_id, channel_ids in memberships.items():
+            await self._record_changes(conn, playlist_id, [(channel_id, kind) for channel_id in channel_ids])
+
+    # Gruppi (stessa logica di groups.py)
+    async def _refresh_groups(self, conn, playlist_id: int, names: Optional[Set[str]] = None):
+        if names is None:
+            await conn.execute(
+                f"""
+                DELETE FROM channel_groups
+                WHERE playlist_id = $1 AND name NOT IN (
+                    SELECT {GROUP_KEY} FROM channels WHERE playlist_id = $1
+                )
+                """,
+                playlist_id
+            )
+            await conn.execute(upsert_groups_sql("playlist_id = $1"), playlist_id)
+            return
+
+        names = sorted(names)
+        await conn.execute(
+            f"""
+            DELETE FROM channel_groups g
+            WHERE g.playlist_id = $1 AND g.name = ANY($2::text[]) AND NOT EXISTS (
+                SELECT 1 FROM channels
+                WHERE playlist_id = g.playlist_id AND {GROUP_KEY} = g.name
+            )
+            """,
+            playlist_id, names
+        )
+        await conn.execute(
+            upsert_groups_sql(f"playlist_id = $1 AND {GROUP_KEY} = ANY($2::text[])"),
+            playlist_id, names
+        )
+
+    async def list_groups(self, user_id: int, playlist_id: int) -> List[Dict]:
+        return [dict(row) for row in await self.pool.fetch(
+            """
+            SELECT name, channel_count, first_position, hidden
+            FROM channel_groups
+            WHERE playlist_id = $1
+            ORDER BY first_position, name
+            """,
+            playlist_id
+        )]
+
+    async def get_group(self, user_id: int, playlist_id: int, name: str) -> Optional[Dict]:
+        return _dict(await self.pool.fetchrow(
+            """
+            SELECT name, channel_count, first_position, hidden
+            FROM channel_groups
+            WHERE playlist_id = $1 AND name = $2
+            """,
+            playlist_id, name
+        ))
+
+    async def group_channels(self, user_id: int, playlist_id: int, name: str) -> List[Dict]:
+        async with self.pool.acquire() as conn:
+            return await self._load_tags(conn, await conn.fetch(
+                f"""
+                SELECT * FROM channels
+                WHERE playlist_id = $1 AND {GROUP_KEY} = $2
+                ORDER BY position, id
+                """,
+                playlist_id, name
+            ))
+
+    async def rename_groups(self, user_id: int, playlist_id: int, names: List[str], new_name: str) -> int:
+        async with self.pool.acquire() as conn, conn.transaction():
+            rows = await conn.fetch(
+                f"""
+                UPDATE channels SET group_title = $3
+                WHERE playlist_id = $1 AND {GROUP_KEY} = ANY($2::text[])
+                RETURNING id
+                """,
+                playlist_id, names, new_name or None
+            )
+            # Un gruppo nuovo resta nascosto solo se lo erano tutti i gruppi rinominati
+            await conn.execute(
+                """
+                INSERT INTO channel_groups (playlist_id, name, channel_count, first_position, hidden)
+                SELECT $1, $3, 0, 0, COALESCE(bool_and(hidden), FALSE)
+                FROM channel_groups
+                WHERE playlist_id = $1 AND name = ANY($2::text[])
+                ON CONFLICT DO NOTHING
+                """,
+                playlist_id, names, new_name
+            )
+            await self._refresh_groups(conn, playlist_id, set(names) | {new_name})
+            channel_ids = [row['id'] for row in rows]
+            await self._record_changes(conn, playlist_id, [(channel_id, UPDATED) for channel_id in channel_ids])
+            await self._record_member_changes(conn, await self._custom_memberships(conn, channel_ids), UPDATED)
+            # Le regole possono filtrare per group-title
+            await self._refresh_rule_playlists(conn, user_id, channel_ids)
+        return len(rows)
+
+    async def set_groups_hidden(self, user_id: int, playlist_id: int, names: List[str], hidden: bool) -> int:
+        async with self.pool.acquire() as conn, conn.transaction():
+            # Per il log: i canali dei gruppi che cambiano davvero stato escono o rientrano nell'export
+            toggled = await conn.fetch(
+                f"""
+                SELECT c.id FROM channels c
+                JOIN channel_groups g ON g.playlist_id = c.playlist_id AND g.name = {GROUP_KEY}
+                WHERE g.playlist_id = $1 AND g.name = ANY($2::text[]) AND g.hidden != $3
+                """,
+                playlist_id, names, hidden
+            )
+            result = await conn.execute(
+                "UPDATE channel_groups SET hidden = $3 WHERE playlist_id = $1 AND name = ANY($2::text[])",
+                playlist_id, names, hidden
+            )
+            await self._record_changes(
+                conn, playlist_id, [(row['id'], REMOVED if hidden else ADDED) for row in toggled]
+            )
+        return int(result.split()[-1])
+
+    async def move_groups(self, user_id: int, playlist_id: int, names: List[str], before: Optional[str]) -> int:
+        async with self.pool.acquire() as conn, conn.transaction():
+            if before is None:
+                anchor = await conn.fetchval(
+                    "SELECT COALESCE(MAX(position), 0) + 1 FROM channels WHERE playlist_id = $1",
+                    playlist_id
+                )
+            else:
+                anchor = await conn.fetchval(
+                    "SELECT first_position FROM channel_groups WHERE playlist_id = $1 AND name = $2",
+                    playlist_id, before
+                )
+            moved = f"{GROUP_KEY} = ANY($2::text[])"
+            rows = await conn.fetch(
+                f"""
+                WITH renumbered AS (
+                    SELECT id, ROW_NUMBER() OVER (
+                        ORDER BY CASE WHEN {moved} THEN $3::integer ELSE position END,
+                                 CASE WHEN {moved} THEN 0 ELSE 1 END,
+                                 position, id
+                    ) AS new_position
+                    FROM channels
+                    WHERE playlist_id = $1
+                )
+                UPDATE channels c SET position = r.new_position
+                FROM renumbered r
+                WHERE c.id = r.id AND c.position IS DISTINCT FROM r.new_position
+                RETURNING c.id
+                """,
+                playlist_id, names, anchor
+            )
+            await self._refresh_groups(conn, playlist_id)
+            await self._record_changes(conn, playlist_id, [(row['id'], MOVED) for row in rows])
+        return len(rows)
+
+    # Sync e import
+    async def sync_channels(self, user_id: int, playlist_id: int, channels: List[M3UChannel],
+                            progress: Optional[Callable[..., None]] = None) -> SyncDiff:
+        progress = progress or (lambda **fields: None)
+        created: Dict[str, int] = {}
+        async with self.pool.acquire() as conn, conn.transaction():
+            # Due repliche che sincronizzano la stessa playlist si mettono in coda qui
+            await conn.execute("SELECT id FROM playlists WHERE id = $1 FOR UPDATE", playlist_id)
+
+            progress(stage="diff")
+            with SYNC_STAGE_SECONDS.time(stage="diff"):
+                existing = await conn.fetch(
+                    """
+                    SELECT id, url, name, group_title, logo_url, tvg_id, position,
+                           tag_set_id, attributes
+                    FROM channels
+                    WHERE playlist_id = $1
+                    ORDER BY position, id
+                    """,
+                    playlist_id
+                )
+                existing = await self._load_tags(conn, existing)
+                diff = diff_channels(existing, channels)
+
+            progress(
+                stage="write",
+                rows_total=len(diff.added) + len(diff.updated) + len(diff.removed)
+            )
+            with SYNC_STAGE_SECONDS.time(stage="write"):
+                # Playlist custom che contengono i canali modificati, prima che quelli rimossi spariscano
+                members = await self._custom_memberships(conn, diff.removed + [row[0] for row in diff.updated])
+                touched = await self._apply_diff(conn, playlist_id, diff, progress, created)
+                if diff.changed:
+                    await self._refresh_groups(conn, playlist_id, diff_groups(existing, diff))
+                    changes = sync_changes(existing, diff, touched[len(diff.updated):])
+                    await self._record_changes(conn, playlist_id, changes)
+                    # Le playlist custom hanno un ordine proprio: gli spostamenti non le riguardano
+                    kinds = dict(changes)
+                    for custom_id, channel_ids in members.items():
+                        await self._record_changes(conn, custom_id, [
+                            (channel_id, kinds[channel_id]) for channel_id in channel_ids if kinds[channel_id] != MOVED
+                        ])
+                    await self._refresh_rule_playlists(conn, user_id, touched + diff.removed)
+                await conn.execute(
+                    "UPDATE playlists SET last_sync = now() WHERE id = $1 AND user_id = $2",
+                    playlist_id, user_id
+                )
+        self._remember_tags(created)
+        return diff
+
+    async def _apply_diff(self, conn, playlist_id: int, diff: SyncDiff, progress: Callable[..., None],
+                          created: Dict[str, int]) -> List[int]:
+        touched = [row[0] for row in diff.updated]
+        written = 0
+
+        if diff.removed:
+            # I collegamenti alle playlist custom vengono rimossi in cascata
+            await conn.execute("DELETE FROM channels WHERE id = ANY($1::bigint[])", diff.removed)
+            written += len(diff.removed)
+            progress(rows_written=written)
+
+        if diff.updated:
+            # COPY in una tabella temporanea, poi un solo UPDATE ... FROM
+            await conn.execute(
+                """
+                CREATE TEMP TABLE sync_updates (
+                    id BIGINT, name TEXT, url TEXT, group_title TEXT, logo_url TEXT,
+                    tvg_id TEXT, position INTEGER, tag_set_id BIGINT, attributes JSON
+                ) ON COMMIT DROP
+                """
+            )
+            for batch in chunked(diff.updated, WRITE_CHUNK_SIZE):
+                tag_ids = await self._intern_tags(conn, [row[4] for row in batch], created)
+                await conn.copy_records_to_table(
+                    'sync_updates',
+                    records=[
+                        (channel_id, *_channel_record(channel, position, tvg_id, tag_set_id))
+                        for (channel_id, position, channel, tvg_id, _), tag_set_id in zip(batch, tag_ids)
+                    ],
+                    columns=('id',) + _CHANNEL_COLUMNS
+                )
+                written += len(batch)
+                progress(rows_written=written)
+            await conn.execute(
+                """
+                UPDATE channels c
+                SET name = u.name, group_title = u.group_title, logo_url = u.logo_url,
+                    tvg_id = u.tvg_id, position = u.position, tag_set_id = u.tag_set_id,
+                    attributes = u.attributes
+                FROM sync_updates u
+                WHERE c.id = u.id
+                """
+            )
+
+        if diff.added:
+            await conn.execute(
+                """
+                CREATE TEMP TABLE sync_inserts (
+                    name TEXT, url TEXT, group_title TEXT, logo_url TEXT,
+                    tvg_id TEXT, position INTEGER, tag_set_id BIGINT, attributes JSON
+                ) ON COMMIT DROP
+                """
+            )
+            for batch in chunked(diff.added, WRITE_CHUNK_SIZE):
+                tag_ids = await self._intern_tags(conn, [row[3] for row in batch], created)
+                await conn.copy_records_to_table(
+                    'sync_inserts',
+                    records=[
+                        _channel_record(channel, position, tvg_id, tag_set_id)
+                        for (position, channel, tvg_id, _), tag_set_id in zip(batch, tag_ids)
+                    ],
+                    columns=_CHANNEL_COLUMNS
+                )
+                written += len(batch)
+                progress(rows_written=written)
+            rows = await conn.fetch(
+                f"""
+                INSERT INTO channels (playlist_id, {', '.join(_CHANNEL_COLUMNS)})
+                SELECT $1, {', '.join(_CHANNEL_COLUMNS)} FROM sync_inserts ORDER BY position
+                RETURNING id
+                """,
+                playlist_id
+            )
+            touched.extend(row['id'] for row in rows)
+
+        return touched
+
+    async def insert_channels(self, user_id: int, playlist_id: int, channels: List[M3UChannel]):
+        created: Dict[str, int] = {}
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                tag_ids = await self._intern_tags(conn, [channel.extra_tags for channel in channels], created)
+                await conn.copy_records_to_table(
+                    'channels',
+                    records=[
+                        (playlist_id, *_channel_record(channel, channel.position, channel.tvg_id, tag_set_id))
+                        for channel, tag_set_id in zip(channels, tag_ids)
+                    ],
+                    columns=('playlist_id',) + _CHANNEL_COLUMNS
+                )
+            self._remember_tags(created)
+
+    async def finish_import(self, user_id: int, playlist_id: int, name: str, epg_url: Optional[str]):
+        async with self.pool.acquire() as conn, conn.transaction():
+            # EPG dall'header #EXTM3U, se non indicato
+            if not epg_url:
+                first = await self._load_tags(conn, await conn.fetch(
+                    "SELECT tag_set_id FROM channels WHERE playlist_id = $1 ORDER BY position LIMIT 1",
+                    playlist_id
+                ))
+                epg_url = first[0]['extra_tags'].get('epg_url') if first else None
+            await conn.execute(
+                "UPDATE playlists SET name = $2, epg_url = $3 WHERE id = $1",
+                playlist_id, name, epg_url
+            )
+            await self._refresh_groups(conn, playlist_id)
+            # Canali scritti a blocchi senza log: chi ha una versione precedente riparte da uno snapshot
+            await conn.execute("DELETE FROM playlist_changes WHERE playlist_id = $1", playlist_id)
+            await conn.execute(
+                "UPDATE playlists SET version = version + 1, changes_since = version + 1 WHERE id = $1",
+                playlist_id
+            )
+            new_ids = [row['id'] for row in await conn.fetch(
+                "SELECT id FROM channels WHERE playlist_id = $1", playlist_id
+            )]
+            await self._refresh_rule_playlists(conn, user_id, new_ids)
+
+    # Export
+    async def iter_export_channels(self, playlist: Dict, batch_size: int) -> AsyncIterator[List[Tuple[int, M3UChannel]]]:
+        # Cursore lato server: le righe arrivano a blocchi, non tutte in memoria
+        async with self.pool.acquire() as conn, conn.transaction():
+            cursor = await conn.cursor(_export_query(playlist), playlist['id'])
+            while True:
+                rows = await cursor.fetch(batch_size)
+                if not rows:
+                    break
+                yield [(row['id'], channel_from_row(row)) for row in await self._load_tags(conn, rows)]
+
+    async def _export_channels(self, conn, playlist: Dict,
+                               channel_ids: Optional[List[int]] = None) -> List[Tuple[int, M3UChannel]]:
+        if channel_ids is None:
+            rows = await conn.fetch(_export_query(playlist), playlist['id'])
+        else:
+            rows = await conn.fetch(_export_query(playlist, filtered=True), playlist['id'], channel_ids)
+        return [(row['id'], channel_from_row(row)) for row in await self._load_tags(conn, rows)]
+
+    async def playback_playlists(self, user_id: int) -> List[Dict]:
+        rows = await self.pool.fetch(
+            "SELECT id, is_custom, version, public_token FROM playlists WHERE user_id = $1", user_id
+        )
+        return [dict(row) for row in rows]
+
+    async def playback_sources(self, user_id: int, playlist: Dict) -> List[Dict]:
+        rows = await self.pool.fetch(
+            _export_query(playlist, columns="c.id, c.name, c.tvg_id, c.url, c.is_dead"), playlist['id']
+        )
+        return [dict(row) for row in rows]
+
+    async def playlist_changes(self, playlist: Dict, since: Optional[int]) -> Dict:
+        # Versione, log e canali letti dallo stesso snapshot
+        async with self.pool.acquire() as conn, conn.transaction(isolation='repeatable_read', readonly=True):
+            state = await conn.fetchrow(
+                "SELECT version, changes_since FROM playlists WHERE id = $1", playlist['id']
+            )
+            if since is None or not state['changes_since'] <= since <= state['version']:
+                return {
+                    "version": state['version'],
+                    "full": True,
+                    "channels": await self._export_channels(conn, playlist)
+                }
+            entries = await conn.fetch(
+                "SELECT channel_id, kind FROM playlist_changes WHERE playlist_id = $1 AND version > $2 ORDER BY id",
+                playlist['id'], since
+            )
+            current = await self._export_channels(
+                conn, playlist, list({entry['channel_id'] for entry in entries})
+            )
+            return {
+                "version": state['version'],
+                "full": False,
+                "changes": resolve_changes(entries, dict(current))
+            }
+
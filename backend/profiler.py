@@ -0,0 +1,192 @@
+"""Opt-in per-request SQL profiler.
+
+Enabled with SQL_PROFILE=1. Every statement run through a TimedCursor is
+recorded under its normalized text (literals replaced by `?`) together with
+duration (execution plus fetching) and row count, grouped by the route template of the request that
+issued it. Statements slower than SQL_SLOW_QUERY_MS are logged with their
+EXPLAIN QUERY PLAN.
+"""
+from typing import Dict, List, Optional, Tuple
+from contextvars import ContextVar
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+logger = logging.getLogger("omg.sql")
+
+ENABLED = os.getenv("SQL_PROFILE", "").lower() in ("1", "true", "yes")
+SLOW_QUERY_SECONDS = float(os.getenv("SQL_SLOW_QUERY_MS", "200")) / 1000
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_SPACES = re.compile(r"\s+")
+_EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "WITH")
+
+def normalize_sql(sql: str) -> str:
+    """Collapse whitespace and literals so that equivalent statements share one entry"""
+    sql = _STRING.sub("?", sql)
+    sql = _NUMBER.sub("?", sql)
+    sql = _IN_LIST.sub("(...)", sql)
+    return _SPACES.sub(" ", sql).strip()
+
+class StatementStats:
+    __slots__ = ('count', 'seconds', 'max_seconds', 'rows')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.rows = 0
+
+    def add(self, seconds: float, rows: int = 0):
+        self.count += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.rows += rows
+
+    def add_fetch(self, seconds: float, rows: int):
+        self.seconds += seconds
+        self.rows += rows
+
+    def merge(self, other: "StatementStats"):
+        self.count += other.count
+        self.seconds += other.seconds
+        self.max_seconds = max(self.max_seconds, other.max_seconds)
+        self.rows += other.rows
+
+    def as_dict(self) -> Dict:
+        return {
+            "count": self.count,
+            "total_ms": round(self.seconds * 1000, 3),
+            "avg_ms": round(self.seconds * 1000 / self.count, 3) if self.count else 0,
+            "max_ms": round(self.max_seconds * 1000, 3),
+            "rows": self.rows,
+        }
+
+class RequestProfile:
+    """Statements executed while serving a single request"""
+
+    def __init__(self, scope: Optional[dict] = None):
+        # Lo scope ASGI viene completato dal router: la route si risolve a posteriori
+        self.scope = scope if scope is not None else {}
+        self.statements: Dict[str, StatementStats] = {}
+        # Le query arrivano anche dai thread di asyncio.to_thread
+        self._lock = threading.Lock()
+        self._closed = False
+
+    @property
+    def route(self) -> str:
+        route = self.scope.get("route")
+        return route.path if route else "unmatched"
+
+    def stats(self, sql: str) -> Optional[StatementStats]:
+        """Entry of a statement; None once the profile has been reported"""
+        key = normalize_sql(sql)
+        with self._lock:
+            if self._closed:
+                return None
+            stats = self.statements.get(key)
+            if stats is None:
+                stats = self.statements[key] = StatementStats()
+            return stats
+
+    def close(self) -> List[Tuple[str, StatementStats]]:
+        """Stop recording and return the statements collected"""
+        with self._lock:
+            self._closed = True
+            return list(self.statements.items())
+
+_current: ContextVar[Optional[RequestProfile]] = ContextVar("sql_profile", default=None)
+
+def start_request(scope: dict) -> RequestProfile:
+    profile = RequestProfile(scope)
+    _current.set(profile)
+    return profile
+
+def detach():
+    """Stop attributing the current task's statements to the request that started it.
+
+    Tasks created with asyncio.create_task copy the request's context; call this
+    first thing in those that outlive the request (sync jobs, publishes, ...).
+    """
+    _current.set(None)
+
+def _query_plan(cursor: sqlite3.Cursor, sql: str, parameters) -> List[str]:
+    words = sql.split(None, 1)
+    if not words or words[0].upper() not in _EXPLAINABLE:
+        return []
+    try:
+        # Cursor base: non passa dal TimedCursor e non finisce nel profilo
+        plan = sqlite3.Cursor(cursor.connection).execute("EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+    except sqlite3.Error:
+        return []
+    return [row['detail'] if isinstance(row, dict) else row[-1] for row in plan]
+
+def record_statement(cursor: sqlite3.Cursor, sql: str, parameters, seconds: float,
+                     rows: int = 0) -> Optional[StatementStats]:
+    """Record one statement; returns the stats entry so fetched rows can be added later"""
+    profile = _current.get()
+    if seconds >= SLOW_QUERY_SECONDS:
+        logger.warning("slow query", extra={
+            "sql": normalize_sql(sql),
+            "duration_ms": round(seconds * 1000, 1),
+            "route": profile.route if profile else None,
+            "plan": _query_plan(cursor, sql, parameters) if parameters is not None else [],
+        })
+    if profile is None:
+        return None
+    stats = profile.stats(sql)
+    if stats is not None:
+        stats.add(seconds, rows)
+    return stats
+
+class ProfileReport:
+    """Statement statistics aggregated per route across requests"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests: Dict[str, int] = {}
+        self._routes: Dict[str, Dict[str, StatementStats]] = {}
+
+    def add(self, profile: RequestProfile):
+        route = profile.route
+        collected = profile.close()
+        with self._lock:
+            self._requests[route] = self._requests.get(route, 0) + 1
+            statements = self._routes.setdefault(route, {})
+            for sql, stats in collected:
+                statements.setdefault(sql, StatementStats()).merge(stats)
+
+    def reset(self):
+        with self._lock:
+            self._requests.clear()
+            self._routes.clear()
+
+    def top(self, limit: int = 10, route: Optional[str] = None) -> List[Dict]:
+        """Routes ordered by total SQL time, each with its `limit` most expensive statements"""
+        with self._lock:
+            routes = [
+                (name, self._requests[name], list(statements.items()))
+                for name, statements in self._routes.items()
+                if route is None or name == route
+            ]
+        report = []
+        for name, requests, statements in routes:
+            total = sum(stats.seconds for _, stats in statements)
+            queries = sum(stats.count for _, stats in statements)
+            statements.sort(key=lambda item: item[1].seconds, reverse=True)
+            report.append({
+                "route": name,
+                "requests": requests,
+                "queries_per_request": round(queries / requests, 2),
+                "sql_ms_per_request": round(total * 1000 / requests, 3),
+                "total_ms": round(total * 1000, 3),
+                "statements": [dict(sql=sql, **stats.as_dict()) for sql, stats in statements[:limit]],
+            })
+        report.sort(key=lambda entry: entry["total_ms"], reverse=True)
+        return report
+
+report = ProfileReport()
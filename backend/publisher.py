@@ -0,0 +1,264 @@
+"""Static copies of the public playlists, for the web server to send from disk.
+
+With PUBLISH_DIR set, the public playlists of a user are rendered again after
+every change to that user's data (the same events that invalidate the render
+cache) and written to PUBLISH_DIR/{token}/{format}.{extension}, each with a gzip
+copy next to it for nginx's gzip_static. Files are swapped in atomically, so a
+reader never gets a partial playlist, and the folders of playlists that are no
+longer public (or got a new token) are removed.
+
+Requests still reach the API, which checks the token, applies admission control
+and sets the headers (Content-Disposition, X-Playlist-Version). When the proxy
+says where it mounts PUBLISH_DIR (X-Published-Prefix request header) and the
+files on disk are at the playlist's current version (PUBLISH_DIR/{token}/version),
+the answer is an X-Accel-Redirect there: nginx sends the body from disk and the
+API renders nothing. Otherwise the API renders the playlist as usual.
+
+Each user has an index of what was published under PUBLISH_DIR/.owners, and a
+lock file there so that one worker process at a time publishes a user; changes
+arriving meanwhile trigger a single publish afterwards.
+"""
+from typing import Dict, List, Optional, Set
+from pathlib import Path
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: un solo processo
+    fcntl = None
+
+from repository import repo
+from exporters import get_exporter, stream_export
+from render_cache import render_cache
+from metrics import PUBLISH_RUNS, PUBLISH_FILES, PUBLISH_SECONDS
+import profiler
+
+logger = logging.getLogger(__name__)
+
+# I token pubblici sono UUID: nient'altro finisce nei percorsi
+PUBLIC_TOKEN = re.compile(r'^[0-9a-f-]{1,64}$')
+
+class PlaylistPublisher:
+    def __init__(self, directory: Optional[Path], formats: List[str], gzip_level: int):
+        self.directory = directory
+        self.formats = formats
+        self.gzip_level = gzip_level
+        self._tasks: Dict[int, asyncio.Task] = {}
+        # Utenti cambiati durante la loro pubblicazione: da ripubblicare subito dopo
+        self._dirty: Set[int] = set()
+        self._rebuild: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None
+
+    async def start(self):
+        if not self.enabled:
+            return
+        for fmt in self.formats:
+            get_exporter(fmt)
+        await asyncio.to_thread((self.directory / ".owners").mkdir, parents=True, exist_ok=True)
+        render_cache.listeners.append(self.schedule)
+        # Il database può essere cambiato mentre il servizio era fermo
+        self._rebuild = asyncio.create_task(self._publish_all())
+
+    async def close(self):
+        if self.schedule in render_cache.listeners:
+            render_cache.listeners.remove(self.schedule)
+        tasks = [task for task in (self._rebuild, *self._tasks.values()) if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._rebuild = None
+
+    def schedule(self, user_id: int):
+        """Publish the user's public playlists again in the background"""
+        if user_id in self._tasks:
+            self._dirty.add(user_id)
+            return
+        self._tasks[user_id] = asyncio.create_task(self._run(user_id))
+
+    async def accel_path(self, playlist: Dict, fmt: str, prefix: Optional[str]) -> Optional[str]:
+        """Path under `prefix` of a published file, if it is at the playlist's version"""
+        token = playlist['public_token']
+        if not (self.enabled and prefix and fmt in self.formats and PUBLIC_TOKEN.match(token)):
+            return None
+        if await asyncio.to_thread(self._read_version, token) != playlist['version']:
+            return None
+        return f"{prefix.rstrip('/')}/{token}/{fmt}.{get_exporter(fmt).extension}"
+
+    async def unpublish(self, token: Optional[str]):
+        """Remove a playlist's files right away, e.g. when its token is revoked"""
+        if self.enabled and token and PUBLIC_TOKEN.match(token):
+            await asyncio.to_thread(shutil.rmtree, self.directory / token, True)
+
+    async def _run(self, user_id: int):
+        # Avviato dalla richiesta che ha cambiato i dati, ma non fa parte della sua risposta
+        profiler.detach()
+        try:
+            while True:
+                self._dirty.discard(user_id)
+                try:
+                    await self.publish_user(user_id)
+                except Exception:
+                    PUBLISH_RUNS.inc(result="error")
+                    logger.exception("playlist publish failed", extra={"user_id": user_id})
+                if user_id not in self._dirty:
+                    break
+        finally:
+            del self._tasks[user_id]
+
+    async def _publish_all(self):
+        lock = await asyncio.to_thread(self._lock, self.directory / ".owners" / "rebuild.lock", False)
+        if lock is False:
+            # Un altro worker sta già ripubblicando tutto
+            return
+        try:
+            owners = set(await repo.public_playlist_owners())
+            owners.update(await asyncio.to_thread(self._indexed_users))
+            for user_id in sorted(owners):
+                try:
+                    await self.publish_user(user_id)
+                except Exception:
+                    PUBLISH_RUNS.inc(result="error")
+                    logger.exception("playlist publish failed", extra={"user_id": user_id})
+        finally:
+            self._unlock(lock)
+
+    async def publish_user(self, user_id: int):
+        """Write the user's public playlists and drop the ones no longer public"""
+        started = time.perf_counter()
+        owners = self.directory / ".owners"
+        lock = await asyncio.to_thread(self._lock, owners / f"{user_id}.lock")
+        try:
+            # Letti dopo aver preso il lock: chi arriva per ultimo pubblica lo stato più recente
+            published = await asyncio.to_thread(self._read_index, user_id)
+            index = {}
+            for playlist in await repo.public_playlists(user_id):
+                token = playlist['public_token']
+                if not PUBLIC_TOKEN.match(token):
+                    continue
+                previous = published.get(token, {})
+                index[token] = {
+                    fmt: await self._write(playlist, fmt, previous.get(fmt))
+                    for fmt in self.formats
+                }
+                # Dopo i file: la versione dichiarata non è mai più nuova del contenuto
+                await asyncio.to_thread(self._write_version, token, playlist['version'])
+            stale = [token for token in published if token not in index]
+            await asyncio.to_thread(self._finish, user_id, index, stale)
+        finally:
+            await asyncio.to_thread(self._unlock, lock)
+        PUBLISH_RUNS.inc(result="published")
+        PUBLISH_SECONDS.observe(time.perf_counter() - started)
+
+    async def _write(self, playlist: Dict, fmt: str, previous_hash: Optional[str]) -> str:
+        """Render one format of a playlist; returns the hash of the content"""
+        exporter = get_exporter(fmt)
+        folder = self.directory / playlist['public_token']
+        path = folder / f"{fmt}.{exporter.extension}"
+        packed = path.with_name(path.name + ".gz")
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        await asyncio.to_thread(folder.mkdir, exist_ok=True)
+
+        digest = hashlib.sha256()
+        # Stesso contenuto delle route pubbliche, logo e redirect compresi
+        try:
+            out = await asyncio.to_thread(open, tmp, 'wb')
+            try:
+                async for chunk in stream_export(playlist, exporter, public=True):
+                    digest.update(chunk)
+                    await asyncio.to_thread(out.write, chunk)
+            finally:
+                await asyncio.to_thread(out.close)
+        except BaseException:
+            await asyncio.to_thread(tmp.unlink, missing_ok=True)
+            raise
+        content_hash = digest.hexdigest()
+
+        if content_hash == previous_hash and await asyncio.to_thread(self._unchanged, tmp, path, packed):
+            PUBLISH_FILES.inc(result="unchanged")
+            return content_hash
+        await asyncio.to_thread(self._swap, tmp, path, packed)
+        PUBLISH_FILES.inc(result="written")
+        return content_hash
+
+    @staticmethod
+    def _unchanged(tmp: Path, path: Path, packed: Path) -> bool:
+        """Drop the new render if both files on disk already have its content"""
+        if not (path.exists() and packed.exists()):
+            return False
+        tmp.unlink()
+        return True
+
+    def _swap(self, tmp: Path, path: Path, packed: Path):
+        packed_tmp = packed.with_name(f"{packed.name}.{os.getpid()}.tmp")
+        with open(tmp, 'rb') as source, gzip.open(packed_tmp, 'wb', compresslevel=self.gzip_level) as target:
+            shutil.copyfileobj(source, target, 1024 * 1024)
+        # Copia compressa e normale sono ciascuna una versione completa
+        os.replace(packed_tmp, packed)
+        os.replace(tmp, path)
+
+    def _read_version(self, token: str) -> Optional[int]:
+        try:
+            return int((self.directory / token / "version").read_text())
+        except (OSError, ValueError):
+            return None
+
+    def _write_version(self, token: str, version: int):
+        path = self.directory / token / "version"
+        tmp = path.with_name(f"version.{os.getpid()}.tmp")
+        tmp.write_text(str(version))
+        os.replace(tmp, path)
+
+    def _finish(self, user_id: int, index: Dict[str, Dict[str, str]], stale: List[str]):
+        for token in stale:
+            shutil.rmtree(self.directory / token, ignore_errors=True)
+            PUBLISH_FILES.inc(result="removed")
+        index_path = self.directory / ".owners" / f"{user_id}.json"
+        if not index:
+            index_path.unlink(missing_ok=True)
+            return
+        tmp = index_path.with_name(f"{user_id}.json.{os.getpid()}.tmp")
+        tmp.write_text(json.dumps(index))
+        os.replace(tmp, index_path)
+
+    def _read_index(self, user_id: int) -> Dict[str, Dict[str, str]]:
+        try:
+            return json.loads((self.directory / ".owners" / f"{user_id}.json").read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def _indexed_users(self) -> List[int]:
+        return [int(path.stem) for path in (self.directory / ".owners").glob("*.json") if path.stem.isdigit()]
+
+    @staticmethod
+    def _lock(path: Path, blocking: bool = True):
+        """Open and lock `path`; False if not blocking and someone else holds it"""
+        handle = open(path, 'a')
+        if fcntl is not None:
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                handle.close()
+                return False
+        return handle
+
+    @staticmethod
+    def _unlock(handle):
+        # Chiudere il file rilascia anche il lock
+        handle.close()
+
+publisher = PlaylistPublisher(
+    directory=Path(os.environ["PUBLISH_DIR"]) if os.getenv("PUBLISH_DIR") else None,
+    formats=[fmt.strip() for fmt in os.getenv("PUBLISH_FORMATS", "m3u").split(",") if fmt.strip()],
+    gzip_level=int(os.getenv("PUBLISH_GZIP_LEVEL", 6))
+)
@@ -0,0 +1,65 @@
+from typing import AsyncIterator, Callable, Hashable, List, Optional
+import os
+
+from cache import CacheTier, cache
+from metrics import PUBLIC_CACHE_REQUESTS
+
+class RenderCache:
+    """Rendered public playlists, kept in the cache tier shared by the workers.
+
+    Entries are grouped by owner: any change to a user's playlists or channels
+    drops all of that user's entries (custom playlists reference channels of
+    other playlists, so per-playlist invalidation would not be enough).
+    """
+
+    def __init__(self, cache: CacheTier, max_entry_bytes: int):
+        self.cache = cache
+        self.max_entry_bytes = max_entry_bytes
+        # Avvisati a ogni invalidazione con l'id dell'utente (es. publisher.py)
+        self.listeners: List[Callable[[int], None]] = []
+
+    @staticmethod
+    def _scope(user_id: int) -> str:
+        return f"user:{user_id}"
+
+    async def _key(self, user_id: int, key: Hashable) -> Optional[str]:
+        name = "render:" + ":".join(str(part) for part in key)
+        return await self.cache.key(self._scope(user_id), name)
+
+    async def get(self, user_id: int, key: Hashable) -> Optional[bytes]:
+        cache_key = await self._key(user_id, key)
+        data = await self.cache.get(cache_key, self._scope(user_id)) if cache_key else None
+        PUBLIC_CACHE_REQUESTS.inc(result='hit' if data is not None else 'miss')
+        return data
+
+    async def version(self, user_id: int) -> int:
+        """Current version of the user's data, moved by every invalidation (negative if unknown)"""
+        return await self.cache.version(self._scope(user_id))
+
+    async def invalidate_user(self, user_id: int):
+        await self.cache.bump(self._scope(user_id))
+        for listener in self.listeners:
+            listener(user_id)
+
+    async def tee(self, user_id: int, key: Hashable, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        """Pass a rendered stream through, storing it once complete if it fits"""
+        # La chiave è presa prima del render: se nel frattempo la playlist cambia,
+        # il risultato finisce sotto la versione vecchia e non viene più letto
+        cache_key = await self._key(user_id, key)
+        parts = [] if cache_key else None
+        size = 0
+        async for chunk in chunks:
+            if parts is not None:
+                size += len(chunk)
+                if size > self.max_entry_bytes:
+                    parts = None
+                else:
+                    parts.append(chunk)
+            yield chunk
+        if parts is not None:
+            await self.cache.set(cache_key, b''.join(parts), self._scope(user_id))
+
+render_cache = RenderCache(
+    cache,
+    max_entry_bytes=int(os.getenv("PUBLIC_CACHE_MAX_ENTRY_BYTES", 64 * 1024 * 1024))
+)
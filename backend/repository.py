@@ -0,0 +1,244 @@
+"""Storage layer used by the API routes.
+
+Every read and write of users, playlists, channels and custom playlist links
+goes through a Repository, so the API can run on the bundled SQLite storage
+(single node) or on PostgreSQL (several replicas behind a load balancer).
+The backend is chosen with STORAGE_BACKEND=sqlite|postgres.
+"""
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+from abc import ABC, abstractmethod
+import os
+
+from m3u_utils import M3UChannel
+from sync import SyncDiff, load_tags
+
+# Campi modificabili con update_playlist / update_channel
+PLAYLIST_FIELDS = ('name', 'url', 'epg_url', 'rules')
+# Campi della playlist che compaiono negli export (header EPG, nome del file scaricato)
+PLAYLIST_EXPORT_FIELDS = ('name', 'epg_url')
+CHANNEL_FIELDS = ('name', 'url', 'group_title', 'logo_url', 'tvg_id', 'extra_tags', 'attributes', 'is_dead')
+
+class DuplicateChannelError(Exception):
+    """The channel is already part of the custom playlist"""
+
+def channel_from_row(row: Dict) -> M3UChannel:
+    """Build the render record of a channel from a database row"""
+    return M3UChannel(
+        name=row['name'],
+        url=row['url'],
+        group=row['group_title'],
+        logo=row['logo_url'],
+        tvg_id=row['tvg_id'],
+        extra_tags=load_tags(row['extra_tags']),
+        position=row['position'],
+        attributes=load_tags(row['attributes'])
+    )
+
+class Repository(ABC):
+    """Contract shared by the storage backends.
+
+    Methods scoped by `user_id` only ever see that user's rows. Operations that
+    change channels keep rule-based playlists up to date themselves.
+    """
+    name = ''
+
+    @abstractmethod
+    async def init(self):
+        """Create the schema if needed and the default admin user"""
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+    # Utenti
+    @abstractmethod
+    async def get_user(self, username: str) -> Optional[Dict]:
+        raise NotImplementedError
+
+    # Gli utenti risolti dai token sono in cache: dopo ogni modifica, auth.invalidate_cached_users
+    @abstractmethod
+    async def set_password_hash(self, user_id: int, password_hash: str):
+        raise NotImplementedError
+
+    # Playlist
+    @abstractmethod
+    async def list_playlists(self, user_id: int) -> List[Dict]:
+        """All the user's playlists, each with its `channels`"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_playlist(self, user_id: int, playlist_id: int, custom_only: bool = False) -> Optional[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_playlist_channels(self, user_id: int, playlist_id: int) -> List[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def create_playlist(self, user_id: int, data: Dict) -> Dict:
+        """Insert a playlist (name, url, is_custom, public_token, epg_url, rules) and materialize its rules"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def update_playlist(self, user_id: int, playlist_id: int, fields: Dict):
+        """Update PLAYLIST_FIELDS; rules passed here are materialized right away"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def delete_playlist(self, user_id: int, playlist_id: int):
+        """Delete a playlist with its channels and custom playlist links"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def set_public_token(self, user_id: int, playlist_id: int, token: Optional[str]):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def find_public_playlist(self, token: str) -> Optional[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def public_playlists(self, user_id: int) -> List[Dict]:
+        """The user's playlists that have a public token"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def public_playlist_owners(self) -> List[int]:
+        """Ids of the users with at least one public playlist"""
+        raise NotImplementedError
+
+    # Canali
+    @abstractmethod
+    async def add_channel(self, user_id: int, playlist_id: int, data: Dict) -> Dict:
+        """Append a channel at the end of a playlist"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_channel(self, user_id: int, channel_id: int) -> Optional[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def update_channel(self, user_id: int, channel_id: int, fields: Dict) -> Optional[Dict]:
+        """Update CHANNEL_FIELDS; None if the channel does not exist"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def delete_channel(self, user_id: int, channel_id: int):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def reorder_channels(self, user_id: int, playlist: Dict, orders: List[Tuple[int, int]]):
+        """Apply (channel_id, position) pairs in one transaction"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def available_channels(self, user_id: int, playlist_id: int) -> List[Dict]:
+        """Channels of the user not yet in the custom playlist, with source_playlist_name"""
+        raise NotImplementedError
+
+    # Playlist custom
+    @abstractmethod
+    async def add_custom_channel(self, user_id: int, playlist_id: int, channel_id: int):
+        """Append a channel to a custom playlist; raises DuplicateChannelError"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def remove_custom_channel(self, user_id: int, playlist_id: int, channel_id: int):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def set_rules(self, user_id: int, playlist: Dict, rules: Optional[Dict]) -> Dict[str, int]:
+        """Store and materialize rules; None removes them, leaving the current channels in place"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def refresh_rules(self, user_id: int, playlist: Dict) -> Dict[str, int]:
+        raise NotImplementedError
+
+    # Gruppi (solo playlist non custom, vedi groups.py)
+    @abstractmethod
+    async def list_groups(self, user_id: int, playlist_id: int) -> List[Dict]:
+        """Groups of a playlist in channel order (name, channel_count, first_position, hidden)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_group(self, user_id: int, playlist_id: int, name: str) -> Optional[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def group_channels(self, user_id: int, playlist_id: int, name: str) -> List[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def rename_groups(self, user_id: int, playlist_id: int, names: List[str], new_name: str) -> int:
+        """Move the channels of the groups under `new_name`; returns the number of channels"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def set_groups_hidden(self, user_id: int, playlist_id: int, names: List[str], hidden: bool) -> int:
+        """Hide or show groups in the exports; returns the number of groups"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def move_groups(self, user_id: int, playlist_id: int, names: List[str], before: Optional[str]) -> int:
+        """Move the channels of the groups before the group `before` (at the end when None)"""
+        raise NotImplementedError
+
+    # Sync e import
+    @abstractmethod
+    async def sync_channels(self, user_id: int, playlist_id: int, channels: List[M3UChannel],
+                            progress: Optional[Callable[..., None]] = None) -> SyncDiff:
+        """Diff the parsed channels against the stored ones and apply the changes atomically.
+
+        `progress` receives keyword updates (stage, rows_total, rows_written).
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    async def insert_channels(self, user_id: int, playlist_id: int, channels: List[M3UChannel]):
+        """Bulk-insert one batch of an import in its own transaction"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def finish_import(self, user_id: int, playlist_id: int, name: str, epg_url: Optional[str]):
+        """Set name and EPG (from the #EXTM3U header when None) and update rule playlists"""
+        raise NotImplementedError
+
+    # Export
+    @abstractmethod
+    def iter_export_channels(self, playlist: Dict, batch_size: int) -> AsyncIterator[List[Tuple[int, M3UChannel]]]:
+        """(id, channel) pairs of a playlist in render order, one batch at a time"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def playback_playlists(self, user_id: int) -> List[Dict]:
+        """id, is_custom, version and public_token of each of the user's playlists"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def playback_sources(self, user_id: int, playlist: Dict) -> List[Dict]:
+        """name, tvg_id, url and is_dead of the channels a playlist renders, in order"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def playlist_changes(self, playlist: Dict, since: Optional[int]) -> Dict:
+        """Changes of a playlist after version `since` (see changes.py).
+
+        Returns {"version", "full": False, "changes": [{"op", "id", "channel"}]}, or
+        a snapshot {"version", "full": True, "channels": [(id, channel)]} when
+        `since` is None or outside the log.
+        """
+        raise NotImplementedError
+
+def create_repository() -> Repository:
+    backend = os.getenv("STORAGE_BACKEND", "sqlite").lower()
+    if backend == "postgres":
+        # asyncpg è richiesto solo con questo backend
+        from postgres_repository import PostgresRepository
+        return PostgresRepository(os.environ["DATABASE_URL"])
+    if backend == "sqlite":
+        from sqlite_repository import SQLiteRepository
+        return SQLiteRepository()
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
+
+repo = create_repository()
@@ -0,0 +1,158 @@
+from typing import List, Dict, Optional, Iterable, Set, Tuple
+import re
+
+from changes import ADDED, REMOVED, record_changes
+from sync import chunked
+
+class RuleMatcher:
+    """Compiled form of a playlist's rules, evaluated against channel rows"""
+
+    def __init__(self, rules: Dict):
+        self.include_groups = [re.compile(p, re.IGNORECASE) for p in rules.get('include_groups') or []]
+        name_regex = rules.get('name_regex')
+        self.name_regex = re.compile(name_regex, re.IGNORECASE) if name_regex else None
+        self.require_tvg_id = bool(rules.get('require_tvg_id'))
+        self.exclude_dead = rules.get('exclude_dead', True)
+        self.source_playlist_ids = set(rules.get('source_playlist_ids') or [])
+
+    def matches(self, channel: Dict) -> bool:
+        if self.source_playlist_ids and channel['playlist_id'] not in self.source_playlist_ids:
+            return False
+        if self.exclude_dead and channel['is_dead']:
+            return False
+        if self.require_tvg_id and not channel['tvg_id']:
+            return False
+        if self.include_groups:
+            group = channel['group_title'] or ''
+            if not any(p.search(group) for p in self.include_groups):
+                return False
+        if self.name_regex and not self.name_regex.search(channel['name']):
+            return False
+        return True
+
+# Canali candidati: tutti i canali delle playlist non custom dell'utente
+_CANDIDATES_QUERY = """
+    SELECT c.id, c.playlist_id, c.name, c.group_title, c.tvg_id, c.is_dead
+    FROM channels c
+    JOIN playlists p ON c.playlist_id = p.id
+    WHERE p.user_id = ? AND p.is_custom = 0
+"""
+
+def membership_changes(members: Set[int], matching: List[int]) -> Tuple[List[int], List[int]]:
+    """Return (to_add, to_remove) turning the current members into the matching channels"""
+    matching_set = set(matching)
+    to_remove = [channel_id for channel_id in members if channel_id not in matching_set]
+    to_add = [channel_id for channel_id in matching if channel_id not in members]
+    return to_add, to_remove
+
+def _apply_membership(cursor, playlist_id: int, matching: List[int], evaluated: Optional[Iterable[int]] = None) -> Dict[str, int]:
+    """Bring the materialized membership of a rule playlist in line with an evaluation.
+
+    Only channels in `evaluated` are considered (all current members when None):
+    members among them that no longer match are removed, matching ones that are
+    not yet members are appended.
+    """
+    if evaluated is None:
+        members = {
+            row['channel_id'] for row in cursor.execute(
+                "SELECT channel_id FROM custom_playlist_channels WHERE playlist_id = ?",
+                (playlist_id,)
+            ).fetchall()
+        }
+    else:
+        members = set()
+        for ids in chunked(list(evaluated)):
+            placeholders = ','.join('?' * len(ids))
+            members.update(
+                row['channel_id'] for row in cursor.execute(
+                    f"""
+                    SELECT channel_id FROM custom_playlist_channels
+                    WHERE playlist_id = ? AND channel_id IN ({placeholders})
+                    """,
+                    (playlist_id, *ids)
+                ).fetchall()
+            )
+
+    to_add, to_remove = membership_changes(members, matching)
+
+    for ids in chunked(to_remove):
+        placeholders = ','.join('?' * len(ids))
+        cursor.execute(
+            f"""
+            DELETE FROM custom_playlist_channels
+            WHERE playlist_id = ? AND channel_id IN ({placeholders})
+            """,
+            (playlist_id, *ids)
+        )
+
+    if to_add:
+        max_pos = cursor.execute(
+            "SELECT MAX(position) AS max_pos FROM custom_playlist_channels WHERE playlist_id = ?",
+            (playlist_id,)
+        ).fetchone()['max_pos'] or 0
+        cursor.executemany(
+            """
+            INSERT OR IGNORE INTO custom_playlist_channels
+            (playlist_id, channel_id, position)
+            VALUES (?, ?, ?)
+            """,
+            [(playlist_id, channel_id, max_pos + i + 1) for i, channel_id in enumerate(to_add)]
+        )
+
+    record_changes(
+        cursor, playlist_id,
+        [(channel_id, REMOVED) for channel_id in to_remove] + [(channel_id, ADDED) for channel_id in to_add]
+    )
+    return {"added": len(to_add), "removed": len(to_remove)}
+
+def materialize_playlist(cursor, playlist: Dict) -> Dict[str, int]:
+    """Fully re-evaluate the rules of a single playlist against all the user's channels"""
+    matcher = RuleMatcher(playlist['rules'])
+    rows = cursor.execute(
+        _CANDIDATES_QUERY + " ORDER BY c.playlist_id, c.position, c.id",
+        (playlist['user_id'],)
+    ).fetchall()
+    matching = [row['id'] for row in rows if matcher.matches(row)]
+    return _apply_membership(cursor, playlist['id'], matching)
+
+def rule_playlists(cursor, user_id: int) -> List[Dict]:
+    """Return the user's custom playlists that have rules"""
+    return cursor.execute(
+        """
+        SELECT id, user_id, rules FROM playlists
+        WHERE user_id = ? AND is_custom = 1 AND rules IS NOT NULL
+        """,
+        (user_id,)
+    ).fetchall()
+
+def refresh_rule_playlists(cursor, user_id: int, channel_ids: Optional[List[int]] = None) -> Dict[int, Dict[str, int]]:
+    """Re-evaluate the user's rule playlists.
+
+    With `channel_ids` only those channels are evaluated (e.g. the ones touched by a
+    sync diff or an edit); otherwise every playlist is fully recomputed.
+    """
+    playlists = rule_playlists(cursor, user_id)
+    if not playlists:
+        return {}
+
+    if channel_ids is None:
+        return {playlist['id']: materialize_playlist(cursor, playlist) for playlist in playlists}
+
+    if not channel_ids:
+        return {}
+
+    rows = []
+    for ids in chunked(list(channel_ids)):
+        placeholders = ','.join('?' * len(ids))
+        rows.extend(cursor.execute(
+            _CANDIDATES_QUERY + f" AND c.id IN ({placeholders}) ORDER BY c.playlist_id, c.position, c.id",
+            (user_id, *ids)
+        ).fetchall())
+
+    results = {}
+    for playlist in playlists:
+        matcher = RuleMatcher(playlist['rules'])
+        matching = [row['id'] for row in rows if matcher.matches(row)]
+        # I canali non più candidati (es. eliminati) vengono valutati come non corrispondenti
+        results[playlist['id']] = _apply_membership(cursor, playlist['id'], matching, channel_ids)
+    return results
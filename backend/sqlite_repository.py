@@ -0,0 +1,734 @@
+"""SQLite storage backend (default); honours STORAGE_MODE=per_user sharding"""
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+import asyncio
+import json
+import sqlite3
+
+from database import get_db, get_user_db, init_db, set_public_token, find_public_playlist, public_playlist_owners
+import groups
+from changes import (
+    ADDED, UPDATED, MOVED, REMOVED, sync_changes, resolve_changes, record_changes, reset_changes,
+    custom_memberships, record_member_changes, load_changes, read_version
+)
+from groups import GROUP_KEY, diff_groups, group_name, refresh_groups
+from m3u_utils import M3UChannel
+from metrics import SYNC_STAGE_SECONDS
+from repository import Repository, DuplicateChannelError, PLAYLIST_EXPORT_FIELDS, channel_from_row
+from rules import refresh_rule_playlists, materialize_playlist
+from sync import SyncDiff, chunked, diff_channels, apply_diff, load_existing_channels
+from tag_sets import TagSetWriter, load_tag_sets
+
+EXPORT_COLUMNS = "c.id, c.name, c.url, c.group_title, c.logo_url, c.tvg_id, c.tag_set_id, c.attributes"
+
+def export_query(playlist: Dict, channel_ids: int = 0, columns: str = EXPORT_COLUMNS) -> str:
+    """Query of the channels a playlist renders, in order, with their position.
+
+    Parameters: the playlist id, then `channel_ids` ids restricting the result.
+    """
+    only = f"AND c.id IN ({','.join('?' * channel_ids)})" if channel_ids else ""
+    if playlist['is_custom']:
+        # Per playlist custom, usa la tabella di mapping
+        return f"""
+            SELECT {columns}, cpc.position
+            FROM channels c
+            JOIN custom_playlist_channels cpc ON c.id = cpc.channel_id
+            WHERE cpc.playlist_id = ? {only}
+            ORDER BY cpc.position, c.name
+        """
+    # I gruppi nascosti restano fuori dall'export
+    return f"""
+        SELECT {columns}, c.position
+        FROM channels c
+        WHERE c.playlist_id = ? {only} AND NOT EXISTS (
+            SELECT 1 FROM channel_groups g
+            WHERE g.playlist_id = c.playlist_id AND g.name = {GROUP_KEY} AND g.hidden
+        )
+        ORDER BY c.position, c.created_at
+    """
+
+def export_channels(cursor, playlist: Dict, channel_ids: Optional[List[int]] = None) -> List[Tuple[int, M3UChannel]]:
+    """(id, channel) pairs a playlist renders, all of them or only among `channel_ids`"""
+    if channel_ids is None:
+        rows = cursor.execute(export_query(playlist), (playlist['id'],)).fetchall()
+    else:
+        rows = []
+        for ids in chunked(channel_ids):
+            rows.extend(cursor.execute(export_query(playlist, len(ids)), (playlist['id'], *ids)).fetchall())
+    return [(row['id'], channel_from_row(row)) for row in load_tag_sets(cursor.connection, rows)]
+
+def iter_playlist_channels(cursor, playlist: Dict, batch_size: int) -> Iterator[List[Tuple[int, M3UChannel]]]:
+    """Yield the (id, channel) pairs of a playlist in render order, one batch at a time"""
+    cursor.execute(export_query(playlist), (playlist['id'],))
+
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        # Il cursore è a metà lettura: i tag set si caricano con la connessione
+        yield [(row['id'], channel_from_row(row)) for row in load_tag_sets(cursor.connection, rows)]
+
+def write_inserted_channels(user_id: int, playlist_id: int, channels: List[M3UChannel]):
+    """Append a batch of imported channels in one transaction (runs in a worker thread)"""
+    with get_user_db(user_id) as db:
+        cursor = db.cursor()
+        tag_sets = TagSetWriter(db)
+        cursor.execute("BEGIN TRANSACTION")
+        try:
+            tag_ids = tag_sets.ids([channel.extra_tags for channel in channels])
+            cursor.executemany(
+                """
+                INSERT INTO channels
+                (playlist_id, name, url, group_title, logo_url,
+                 tvg_id, position, tag_set_id, attributes)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                [
+                    (
+                        playlist_id, channel.name, channel.url,
+                        channel.group, channel.logo, channel.tvg_id,
+                        channel.position, tag_set_id,
+                        json.dumps(channel.attributes)
+                    )
+                    for channel, tag_set_id in zip(channels, tag_ids)
+                ]
+            )
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+        tag_sets.commit()
+
+def finish_imported_playlist(user_id: int, playlist_id: int, name: str, epg_url: Optional[str]):
+    """Name, EPG, groups, change log and rule playlists of an imported playlist (runs in a worker thread)"""
+    with get_user_db(user_id) as db:
+        cursor = db.cursor()
+        # EPG dall'header #EXTM3U, se non indicato
+        if not epg_url:
+            first = load_tag_sets(db, cursor.execute(
+                "SELECT tag_set_id FROM channels WHERE playlist_id = ? ORDER BY position LIMIT 1",
+                (playlist_id,)
+            ).fetchall())
+            epg_url = first[0]['extra_tags'].get('epg_url') if first else None
+        cursor.execute(
+            "UPDATE playlists SET name = ?, epg_url = ? WHERE id = ?",
+            (name, epg_url, playlist_id)
+        )
+        refresh_groups(cursor, playlist_id)
+        # Canali scritti a blocchi senza log: chi ha una versione precedente riparte da uno snapshot
+        reset_changes(cursor, playlist_id)
+
+        new_ids = [
+            row['id'] for row in cursor.execute(
+                "SELECT id FROM channels WHERE playlist_id = ?",
+                (playlist_id,)
+            ).fetchall()
+        ]
+        refresh_rule_playlists(cursor, user_id, new_ids)
+
+def write_synced_channels(user_id: int, playlist_id: int, channels: List[M3UChannel],
+                          progress: Callable[..., None]) -> SyncDiff:
+    """Diff and apply the parsed channels in one transaction (runs in a worker thread)"""
+    with get_user_db(user_id) as db:
+        cursor = db.cursor()
+        tag_sets = TagSetWriter(db)
+        # IMMEDIATE: sync concorrenti (es. dello stesso download condiviso) attendono il
+        # lock di scrittura invece di fallire con "database is locked" dopo la lettura
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            # Confronta con i canali esistenti e applica solo le differenze
+            progress(stage="diff")
+            with SYNC_STAGE_SECONDS.time(stage="diff"):
+                existing = load_tag_sets(db, load_existing_channels(cursor, playlist_id))
+                diff = diff_channels(existing, channels)
+
+            progress(
+                stage="write",
+                rows_total=len(diff.added) + len(diff.updated) + len(diff.removed)
+            )
+            with SYNC_STAGE_SECONDS.time(stage="write"):
+                # Playlist custom che contengono i canali modificati, prima che quelli rimossi spariscano
+                members = custom_memberships(cursor, diff.removed + [row[0] for row in diff.updated])
+                touched = apply_diff(
+                    cursor, playlist_id, diff, tag_sets.ids,
+                    progress=lambda written: progress(rows_written=written)
+                )
+
+                # Aggiorna gruppi e playlist basate su regole solo per i canali modificati
+                if diff.changed:
+                    refresh_groups(cursor, playlist_id, diff_groups(existing, diff))
+                    changes = sync_changes(existing, diff, touched[len(diff.updated):])
+                    record_changes(cursor, playlist_id, changes)
+                    # Le playlist custom hanno un ordine proprio: gli spostamenti non le riguardano
+                    kinds = dict(changes)
+                    for custom_id, channel_ids in members.items():
+                        record_changes(cursor, custom_id, [
+                            (channel_id, kinds[channel_id]) for channel_id in channel_ids if kinds[channel_id] != MOVED
+                        ])
+                    refresh_rule_playlists(cursor, user_id, touched + diff.removed)
+
+                cursor.execute(
+                    """
+                    UPDATE playlists
+                    SET last_sync = CURRENT_TIMESTAMP
+                    WHERE id = ? AND user_id = ?
+                    """,
+                    (playlist_id, user_id)
+                )
+
+                cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+        tag_sets.commit()
+    return diff
+
+class SQLiteRepository(Repository):
+    name = 'sqlite'
+
+    async def init(self):
+        init_db()
+
+    # Utenti
+    async def get_user(self, username: str) -> Optional[Dict]:
+        with get_db() as db:
+            return db.execute(
+                "SELECT * FROM users WHERE username = ?",
+                (username,)
+            ).fetchone()
+
+    async def set_password_hash(self, user_id: int, password_hash: str):
+        with get_db() as db:
+            db.execute(
+                "UPDATE users SET password_hash = ? WHERE id = ?",
+                (password_hash, user_id)
+            )
+
+    # Playlist
+    async def list_playlists(self, user_id: int) -> List[Dict]:
+        with get_user_db(user_id) as db:
+            cursor = db.cursor()
+            playlists = []
+            # Get only playlists for current user
+            for playlist in cursor.execute(
+                "SELECT * FROM playlists WHERE user_id = ? ORDER BY created_at",
+                (user_id,)
+            ).fetchall():
+                channels = cursor.execute("""
+                    SELECT * FROM channels
+                    WHERE playlist_id = ?
+                    ORDER BY position, created_at
+                """, (playlist['id'],)).fetchall()
+
+                playlist_dict = dict(playlist)
+                playlist_dict['channels'] = load_tag_sets(db, channels)
+                playlists.append(playlist_dict)
+
+            return playlists
+
+    async def get_playlist(self, user_id: int, playlist_id: int, custom_only: bool = False) -> Optional[Dict]:
+        query = "SELECT * FROM playlists WHERE id = ? AND user_id = ?"
+        if custom_only:
+            query += " AND is_custom = 1"
+        with get_user_db(user_id) as db:
+            return db.execute(query, (playlist_id, user_id)).fetchone()
+
+    async def get_playlist_channels(self, user_id: int, playlist_id: int) -> List[Dict]:
+        with get_user_db(user_id) as db:
+            return load_tag_sets(db, db.execute("""
+                SELECT * FROM channels
+                WHERE playlist_id = ?
+                ORDER BY position, created_at
+            """, (playlist_id,)).fetchall())
+
+    async def create_playlist(self, user_id: int, data: Dict) -> Dict:
+        with get_user_db(user_id) as db:
+            cursor = db.cursor()
+            try:
+                cursor.execute("BEGIN TRANSACTION")
+                cursor.execute(
+                    """
+                    INSERT INTO playlists
+                    (user_id, name, url, is_custom, public_token, epg_url, rules)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (
+                        user_id,
+                        data['name'],
+                        data.get('url'),
+                        data.get('is_custom', False),
+                        data.get('public_token'),
+                        data.get('epg_url'),
+                        data.get('rules')
+                    )
+                )
+
+                new_playlist = cursor.execute(
+                    "SELECT * FROM playlists WHERE id = ?",
+                    (cursor.lastrowid,)
+                ).fetchone()
+
+                # Popola subito le playlist basate su regole
+                if new_playlist['rules']:
+                    materialize_playlist(cursor, new_playlist)
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+
+            # Indice dei token (altro file in per_user): solo per playlist salvate
+            set_public_token(user_id, new_playlist['id'], new_playlist['public_token'])
+            return dict(new_playlist)
+
+    async def update_playlist(self, user_id: int, playlist_id: int, fields: Dict):
+        if not fields:
+            return
+        with get_user_db(user_id) as db:
+            cursor = db.cursor()
+            columns = [name for name in fields]
+            assignments = [f'{name} = ?' for name in columns]
+            # Nessun canale cambiato, ma l'export sì: le copie pubblicate vanno rifatte
+            if any(name in fields for name in PLAYLIST_EXPORT_FIELDS):
+                assignments.append('version = version + 1')
+            try:
+                cursor.execute("BEGIN TRANSACTION")
+                cursor.execute(
+                    f"""
+                    UPDATE playlists
+                    SET {', '.join(assignments)}
+                    WHERE id = ? AND user_id = ?
+                    """,
+                    (*[fields[name] for name in columns], playlist_id, user_id)
+                )
+
+                # Regole e appartenenza cambiano insieme, come in set_rules
+                if fields.get('rules') is not None:
+                    materialize_playlist(cursor, {
+                        'id': playlist_id,
+                        'user_id': user_id,
+                        'rules': fields['rules']
+                    })
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+
+    async def delete_playlist(self, user_id: int, playlist_id: int):
+        with get_user_db(user_id) as db:
+            cursor = db.cursor()
+            try:
+                cursor.execute("BEGIN TRANSACTION")
+                channel_ids = [
+                    row['id'] for row in cursor.execute(
+                        "SELECT id FROM channels WHERE playlist_id = ?", (playlist_id,)
+                    ).fetchall()
+                ]
+                members = custom_memberships(cursor, channel_ids)
+                members.pop(playlist_id, None)
+                # Le foreign key non sono attive in SQLite: rimuovi esplicitamente le righe collegate
+                cursor.execute(
+                    """
+                    DELETE FROM custom_playlist_channels
+                    WHERE playlist_id = ?
+                       OR channel_id IN (SELECT id FROM channels WHERE playlist_id = ?)
+                    """,
+                    (playlist_id, playlist_id)
+                )
+                cursor.execute("DELETE FROM channels WHERE playlist_id = ?", (playlist_id,))
+                cursor.execute("DELETE FROM channel_groups WHERE playlist_id = ?", (playlist_id,))
+                cursor.execute("DELETE FROM playlist_changes WHERE playlist_id = ?", (playlist_id,))
+                record_member_changes(cursor, members, REMOVED)
+                cursor.execute(
+                    "DELETE FROM playlists WHERE id = ? AND user_id = ?",
+                    (playlist_id, user_id)
+                )
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+        set_public_token(user_id, playlist_id, None)
+
+    async def set_public_token(self, user_id: int, playlist_id: int, token: Optional[str]):
+        with get_user_db(user_id) as db:
+            db.execute(
+                "UPDATE playlists SET public_token = ? WHERE id = ?",
+                (token, playlist_id)
+            )
+        set_public_token(user_id, playlist_id, token)
+
+    async def find_public_playlist(self, token: str) -> Optional[Dict]:
+        return find_public_playlist(token)
+
+    async def public_playlists(self, user_id: int) -> List[Dict]:
+        with get_user_db(user_id) as db:
+            return db.execute(
+                "SELECT * FROM playlists WHERE user_id = ? AND public_token IS NOT NULL ORDER BY id",
+                (user_id,)
+            ).fetchall()
+
+    async def public_playlist_owners(self) -> List[int]:
+        return public_playlist_owners()
+
+    # Canali
+    async def add_channel(self, user_id: int, playlist_id: int, data: Dict) -> Dict:
+        with get_user_db(user_id) as db:
+            cursor = db.cursor()
+            # Il tag set e il canale che lo usa insieme: un set appena scritto non
+            # deve risultare orfano alla manutenzione
+            cursor.execute("BEGIN TRANSACTION")
+            try:
+                # Trova la posizione massima attuale
+                max_pos = cursor.execute(
+                    """
+                    SELECT MAX(position) as max_pos
+                    FROM channels
+                    WHERE playlist_id = ?
+                    """,
+                    (playlist_id,)
+                ).fetchone()
+
+                next_pos = (max_pos['max_pos'] or 0) + 1 if max_pos else 1
+
+                tag_sets = TagSetWriter(db)
+                tag_set_id = tag_sets.id(data.get('extra_tags'))
+                cursor.execute(
+                    """
+                    INSERT INTO channels
+                    (playlist_id, name, url, group_title, logo_url, position, tvg_id,
+                     tag_set_id, attributes, is_dead)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (
+                        playlist_id, data['name'], data['url'],
+                        data.get('group_title'), data.get('logo_url'), next_pos,
+                        data.get('tvg_id'), tag_set_id,
+                        json.dumps(data.get('attributes') or {}), data.get('is_dead', False)
+                    )
+                )
+
+                new_channel = cursor.execute(
+                    "SELECT * FROM channels WHERE id = ?",
+                    (cursor.lastrowid,)
+                ).fetchone()
+
+                refresh_groups(cursor, playlist_id, {group_name(new_channel['group_title'])})
+                record_changes(cursor, playlist_id, [(new_channel['id'], ADDED)])
+                refresh_rule_playlists(cursor, user_id, [new_channel['id']])
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+            tag_sets.commit()
+            return load_tag_sets(db, [new_channel])[0]
+
+    async def get_channel(self, user_id: int, channel_id: int) -> Optional[Dict]:
+        with get_user_db(user_id) as db:
+            # Verifica che il canale appartenga a una playlist dell'utente
+            channel = db.execute("""
+                SELECT c.*
+                FROM channels c
+                JOIN playlists p ON c.playlist_id = p.id
+                WHERE c.id = ? AND p.user_id = ?
+            """, (channel_id, user_id)).fetchone()
+            return load_tag_sets(db, [channel])[0] if channel else None
+
+    async def update_channel(self, user_id: int, channel_id: int, fields: Dict) -> Optional[Dict]:
+        with get_user_db(user_id) as db:
+            cursor = db.cursor()
+            tag_sets = TagSetWriter(db)
+            try:
+                cursor.execute("BEGIN TRANSACTION")
+                previous = cursor.execute(
+                    "SELECT playlist_id, group_title FROM channels WHERE id = ?",
+                    (channel_id,)
+                ).fetchone()
+                if previous is None:
+                    cursor.execute("ROLLBACK")
+                    return None
+
+                if fields:
+                    fields = dict(fields)
+                    if 'extra_tags' in fields:
+                        fields['tag_set_id'] = tag_sets.id(fields.pop('extra_tags'))
+                    columns = [name for name in fields]
+                    values = [
+                        json.dumps(fields[name]) if name == 'attributes' else fields[name]
+                        for name in columns
+                    ]
+                    cursor.execute(
+                        f"""
+                        UPDATE channels
+                        SET {', '.join(f'{name} = ?' for name in columns)}
+                        WHERE id = ?
+                        """,
+                        (*values, channel_id)
+                    )
+
+                    if 'group_title' in fields:
+                        refresh_groups(cursor, previous['playlist_id'], {
+                            group_name(previous['group_title']), group_name(fields['group_title'])
+                        })
+                    record_changes(cursor, previous['playlist_id'], [(channel_id, UPDATED)])
+                    record_member_changes(cursor, custom_memberships(cursor, [channel_id]), UPDATED)
+                    refresh_rule_playlists(cursor, user_id, [channel_id])
+
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+            # Gli id dei tag set si ricordano solo dopo il commit
+            tag_sets.commit()
+
+            return load_tag_sets(db, cursor.execute(
+                "SELECT * FROM channels WHERE id = ?",
+                (channel_id,)
+            ).fetchall())[0]
+
+    async def delete_channel(self, user_id: int, channel_id: int):
+        with get_user_db(user_id) as db:
+            cursor = db.cursor()
+            try:
+                cursor.execute("BEGIN TRANSACTION")
+                channel = cursor.execute(
+                    "SELECT playlist_id, group_title FROM channels WHERE id = ?",
+                    (channel_id,)
+                ).fetchone()
+                members = custom_memberships(cursor, [channel_id])
+                cursor.execute(
+                    "DELETE FROM custom_playlist_channels WHERE channel_id = ?",
+                    (channel_id,)
+                )
+                cursor.execute("DELETE FROM channels WHERE id = ?", (channel_id,))
+                if channel:
+                    refresh_groups(cursor, channel['playlist_id'], {group_name(channel['group_title'])})
+                    record_changes(cursor, channel['playlist_id'], [(channel_id, REMOVED)])
+                    record_member_changes(cursor, members, REMOVED)
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+
+    async def reorder_channels(self, user_id: int, playlist: Dict, orders: List[Tuple[int, int]]):
+        with get_user_db(user_id) as db:
+            cursor = db.cursor()
+            try:
+                cursor.execute("BEGIN TRANSACTION")
+
+                for channel_id, position in orders:
+                    if playlist['is_custom']:
+                        cursor.execute("""
+                            UPDATE custom_playlist_channels
+                            SET position = ?
+                            WHERE playlist_id = ? AND channel_id = ?
+                        """, (position, playlist['id'], channel_id))
+                    else:
+                        cursor.execute("""
+                            UPDATE channels
+                            SET position = ?
+                            WHERE id = ? AND playlist_id = ?
+                        """, (position, channel_id, playlist['id']))
+
+                if not playlist['is_custom']:
+                    refresh_groups(cursor, playlist['id'])
+                record_changes(cursor, playlist['id'], [(channel_id, MOVED) for channel_id, _ in orders])
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+
+    async def available_channels(self, user_id: int, playlist_id: int) -> List[Dict]:
+        with get_user_db(user_id) as db:
+            # Prendi tutti i canali che non sono già nella playlist custom
+            return load_tag_sets(db, db.execute("""
+                SELECT c.*, p.name as source_playlist_name
+                FROM channels c
+                JOIN playlists p ON c.playlist_id = p.id
+                WHERE p.user_id = ? AND c.id NOT IN (
+                    SELECT channel_id
+                    FROM custom_playlist_channels
+                    WHERE playlist_id = ?
+                )
+                ORDER BY p.name, c.position, c.name
+            """, (user_id, playlist_id)).fetchall())
+
+    # Playlist custom
+    async def add_custom_channel(self, user_id: int, playlist_id: int, channel_id: int):
+        with get_user_db(user_id) as db:
+            cursor = db.cursor()
+
+            # Trova la posizione massima attuale
+            max_pos = cursor.execute(
+                """
+                SELECT MAX(position) as max_pos
+                FROM custom_playlist_channels
+                WHERE playlist_id = ?
+                """,
+                (playlist_id,)
+            ).fetchone()
+
+            next_pos = (max_pos['max_pos'] or 0) + 1
+
+            try:
+                cursor.execute(
+                    """
+                    INSERT INTO custom_playlist_channels
+                    (playlist_id, channel_id, position)
+                    VALUES (?, ?, ?)
+                    """,
+                    (playlist_id, channel_id, next_pos)
+                )
+            except sqlite3.IntegrityError:
+                raise DuplicateChannelError()
+            record_changes(cursor, playlist_id, [(channel_id, ADDED)])
+
+    async def remove_custom_channel(self, user_id: int, playlist_id: int, channel_id: int):
+        with get_user_db(user_id) as db:
+            cursor = db.cursor()
+            cursor.execute(
+                """
+                DELETE FROM custom_playlist_channels
+                WHERE playlist_id = ? AND channel_id = ?
+                """,
+                (playlist_id, channel_id)
+            )
+            if cursor.rowcount:
+                record_changes(cursor, playlist_id, [(channel_id, REMOVED)])
+
+    async def set_rules(self, user_id: int, playlist: Dict, rules: Optional[Dict]) -> Dict[str, int]:
+        with get_user_db(user_id) as db:
+            cursor = db.cursor()
+            if rules is None:
+                # I canali già presenti restano nella playlist come selezione manuale
+                cursor.execute(
+                    "UPDATE playlists SET rules = NULL WHERE id = ?",
+                    (playlist['id'],)
+                )
+                return {}
+
+            try:
+                cursor.execute("BEGIN TRANSACTION")
+                cursor.execute(
+                    "UPDATE playlists SET rules = ? WHERE id = ?",
+                    (rules, playlist['id'])
+                )
+                changes = materialize_playlist(cursor, dict(playlist, rules=rules))
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+            return changes
+
+    async def refresh_rules(self, user_id: int, playlist: Dict) -> Dict[str, int]:
+        with get_user_db(user_id) as db:
+            cursor = db.cursor()
+            try:
+                cursor.execute("BEGIN TRANSACTION")
+                changes = materialize_playlist(cursor, playlist)
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+            return changes
+
+    # Gruppi
+    async def list_groups(self, user_id: int, playlist_id: int) -> List[Dict]:
+        with get_user_db(user_id) as db:
+            return groups.list_groups(db.cursor(), playlist_id)
+
+    async def get_group(self, user_id: int, playlist_id: int, name: str) -> Optional[Dict]:
+        with get_user_db(user_id) as db:
+            return groups.get_group(db.cursor(), playlist_id, name)
+
+    async def group_channels(self, user_id: int, playlist_id: int, name: str) -> List[Dict]:
+        with get_user_db(user_id) as db:
+            return load_tag_sets(db, groups.group_channels(db.cursor(), playlist_id, name))
+
+    async def rename_groups(self, user_id: int, playlist_id: int, names: List[str], new_name: str) -> int:
+        with get_user_db(user_id) as db:
+            cursor = db.cursor()
+            try:
+                cursor.execute("BEGIN TRANSACTION")
+                channel_ids = groups.rename_groups(cursor, playlist_id, names, new_name)
+                # Le regole possono filtrare per group-title
+                refresh_rule_playlists(cursor, user_id, channel_ids)
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+            return len(channel_ids)
+
+    async def set_groups_hidden(self, user_id: int, playlist_id: int, names: List[str], hidden: bool) -> int:
+        with get_user_db(user_id) as db:
+            return groups.set_groups_hidden(db.cursor(), playlist_id, names, hidden)
+
+    async def move_groups(self, user_id: int, playlist_id: int, names: List[str], before: Optional[str]) -> int:
+        with get_user_db(user_id) as db:
+            cursor = db.cursor()
+            try:
+                cursor.execute("BEGIN TRANSACTION")
+                changed = groups.move_groups(cursor, playlist_id, names, before)
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+            return changed
+
+    # Sync e import
+    async def sync_channels(self, user_id: int, playlist_id: int, channels: List[M3UChannel],
+                            progress: Optional[Callable[..., None]] = None) -> SyncDiff:
+        # In un thread: la transazione non blocca l'event loop
+        return await asyncio.to_thread(
+            write_synced_channels, user_id, playlist_id, channels,
+            progress or (lambda **fields: None)
+        )
+
+    async def insert_channels(self, user_id: int, playlist_id: int, channels: List[M3UChannel]):
+        # Come la sync: ogni blocco di un import grande resta fuori dall'event loop
+        await asyncio.to_thread(write_inserted_channels, user_id, playlist_id, channels)
+
+    async def finish_import(self, user_id: int, playlist_id: int, name: str, epg_url: Optional[str]):
+        # Gruppi e regole ricalcolati su tutta la playlist: anche questo in un thread
+        await asyncio.to_thread(finish_imported_playlist, user_id, playlist_id, name, epg_url)
+
+    # Export
+    async def iter_export_channels(self, playlist: Dict, batch_size: int) -> AsyncIterator[List[Tuple[int, M3UChannel]]]:
+        # Connessione dedicata: la risposta viene inviata dopo che la route è già terminata
+        with get_user_db(playlist['user_id']) as db:
+            for channels in iter_playlist_channels(db.cursor(), playlist, batch_size):
+                yield channels
+
+    async def playback_playlists(self, user_id: int) -> List[Dict]:
+        with get_user_db(user_id) as db:
+            return db.execute(
+                "SELECT id, is_custom, version, public_token FROM playlists WHERE user_id = ?",
+                (user_id,)
+            ).fetchall()
+
+    async def playback_sources(self, user_id: int, playlist: Dict) -> List[Dict]:
+        with get_user_db(user_id) as db:
+            return db.execute(
+                export_query(playlist, columns="c.id, c.name, c.tvg_id, c.url, c.is_dead"),
+                (playlist['id'],)
+            ).fetchall()
+
+    async def playlist_changes(self, playlist: Dict, since: Optional[int]) -> Dict:
+        with get_user_db(playlist['user_id']) as db:
+            cursor = db.cursor()
+            # Versione, log e canali letti dallo stesso snapshot del database
+            cursor.execute("BEGIN")
+            try:
+                state = read_version(cursor, playlist['id'])
+                if since is None or not state['changes_since'] <= since <= state['version']:
+                    return {
+                        "version": state['version'],
+                        "full": True,
+                        "channels": export_channels(cursor, playlist)
+                    }
+                entries = load_changes(cursor, playlist['id'], since)
+                current = export_channels(cursor, playlist, list({entry['channel_id'] for entry in entries}))
+                return {
+                    "version": state['version'],
+                    "full": False,
+                    "changes": resolve_changes(entries, dict(current))
+                }
+            finally:
+                cursor.execute("COMMIT")
@@ -0,0 +1,187 @@
+from typing import Callable, List, Dict, Optional
+import json
+
+from m3u_utils import M3UChannel
+
+# SQLite accetta al massimo 999 parametri per statement nelle versioni più vecchie
+SQL_CHUNK_SIZE = 500
+# Righe per executemany durante la scrittura di un diff (granularità del progresso)
+WRITE_CHUNK_SIZE = 5000
+
+def load_tags(value) -> Dict[str, str]:
+    """Decode an extra_tags column value (already decoded by the JSON converter or raw text)"""
+    if not value:
+        return {}
+    if isinstance(value, dict):
+        return value
+    return json.loads(value)
+
+def chunked(items: List, size: int = SQL_CHUNK_SIZE):
+    """Yield successive slices of at most `size` items"""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+class SyncDiff:
+    """Differences between the stored channels of a playlist and a freshly parsed list"""
+
+    def __init__(self):
+        self.added = []      # (position, channel, tvg_id, extra_tags)
+        self.updated = []    # (id, position, channel, tvg_id, extra_tags)
+        self.removed = []    # channel ids
+        self.unchanged = 0
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.added or self.updated or self.removed)
+
+    def summary(self) -> Dict[str, int]:
+        return {
+            "added": len(self.added),
+            "updated": len(self.updated),
+            "removed": len(self.removed),
+            "unchanged": self.unchanged
+        }
+
+def diff_channels(existing_rows: List[Dict], channels: List[M3UChannel]) -> SyncDiff:
+    """Match parsed channels to stored rows by URL and compute the minimal set of changes.
+
+    Like the previous delete-and-reinsert sync, manually edited tvg_id values and
+    stored extra_tags win over the ones coming from the upstream playlist.
+    """
+    diff = SyncDiff()
+
+    # Più canali possono condividere lo stesso URL: abbinali in ordine
+    by_url: Dict[str, List[Dict]] = {}
+    for row in existing_rows:
+        by_url.setdefault(row['url'], []).append(row)
+
+    for i, channel in enumerate(channels):
+        position = i + 1
+        candidates = by_url.get(channel.url)
+        row = candidates.pop(0) if candidates else None
+
+        if row is None:
+            diff.added.append((position, channel, channel.tvg_id, channel.extra_tags))
+            continue
+
+        tvg_id = row['tvg_id'] or channel.tvg_id
+        existing_tags = load_tags(row['extra_tags'])
+        if existing_tags:
+            extra_tags = dict(channel.extra_tags)
+            extra_tags.update(existing_tags)
+        else:
+            extra_tags = channel.extra_tags
+
+        if (
+            row['name'] != channel.name
+            or row['group_title'] != channel.group
+            or row['logo_url'] != channel.logo
+            or row['tvg_id'] != tvg_id
+            or row['position'] != position
+            or existing_tags != extra_tags
+            or load_tags(row['attributes']) != channel.attributes
+        ):
+            diff.updated.append((row['id'], position, channel, tvg_id, extra_tags))
+        else:
+            diff.unchanged += 1
+
+    for rows in by_url.values():
+        diff.removed.extend(row['id'] for row in rows)
+
+    return diff
+
+def load_existing_channels(cursor, playlist_id: int) -> List[Dict]:
+    """Load the columns needed by diff_channels for a playlist (tag sets still to be resolved)"""
+    return cursor.execute(
+        """
+        SELECT id, url, name, group_title, logo_url, tvg_id, position,
+               tag_set_id, attributes
+        FROM channels
+        WHERE playlist_id = ?
+        ORDER BY position, id
+        """,
+        (playlist_id,)
+    ).fetchall()
+
+def apply_diff(cursor, playlist_id: int, diff: SyncDiff,
+               tag_set_ids: Callable[[List[Dict[str, str]]], List[Optional[int]]],
+               progress: Optional[Callable[[int], None]] = None) -> List[int]:
+    """Write a SyncDiff inside the caller's transaction and return the ids of added/updated channels.
+
+    `tag_set_ids` turns a list of extra_tags into their tag set ids.
+    `progress`, if given, is called with the number of rows written so far.
+    """
+    touched = [row[0] for row in diff.updated]
+    written = 0
+
+    if diff.removed:
+        for ids in chunked(diff.removed):
+            placeholders = ','.join('?' * len(ids))
+            cursor.execute(
+                f"DELETE FROM custom_playlist_channels WHERE channel_id IN ({placeholders})",
+                ids
+            )
+            cursor.execute(
+                f"DELETE FROM channels WHERE id IN ({placeholders})",
+                ids
+            )
+            written += len(ids)
+            if progress:
+                progress(written)
+
+    for batch in chunked(diff.updated, WRITE_CHUNK_SIZE):
+        tag_ids = tag_set_ids([row[4] for row in batch])
+        cursor.executemany(
+            """
+            UPDATE channels
+            SET name = ?, group_title = ?, logo_url = ?, tvg_id = ?,
+                position = ?, tag_set_id = ?, attributes = ?
+            WHERE id = ?
+            """,
+            [
+                (
+                    channel.name, channel.group, channel.logo, tvg_id,
+                    position, tag_set_id,
+                    json.dumps(channel.attributes), channel_id
+                )
+                for (channel_id, position, channel, tvg_id, _), tag_set_id in zip(batch, tag_ids)
+            ]
+        )
+        written += len(batch)
+        if progress:
+            progress(written)
+
+    if diff.added:
+        last_id = cursor.execute(
+            "SELECT COALESCE(MAX(id), 0) AS last_id FROM channels"
+        ).fetchone()['last_id']
+        for batch in chunked(diff.added, WRITE_CHUNK_SIZE):
+            tag_ids = tag_set_ids([row[3] for row in batch])
+            cursor.executemany(
+                """
+                INSERT INTO channels
+                (playlist_id, name, url, group_title, logo_url,
+                 tvg_id, position, tag_set_id, attributes)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                [
+                    (
+                        playlist_id, channel.name, channel.url,
+                        channel.group, channel.logo, tvg_id,
+                        position, tag_set_id,
+                        json.dumps(channel.attributes)
+                    )
+                    for (position, channel, tvg_id, _), tag_set_id in zip(batch, tag_ids)
+                ]
+            )
+            written += len(batch)
+            if progress:
+                progress(written)
+        touched.extend(
+            row['id'] for row in cursor.execute(
+                "SELECT id FROM channels WHERE playlist_id = ? AND id > ?",
+                (playlist_id, last_id)
+            ).fetchall()
+        )
+
+    return touched
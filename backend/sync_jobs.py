@@ -0,0 +1,313 @@
+"""Playlist sync pipeline, runnable inline or as a background job with progress events.
+
+A SyncJob records how far the sync got (bytes fetched, channels parsed, rows
+written, final diff) and pushes every change to its subscribers, which the
+API exposes as a Server-Sent Events stream. With a shared cache configured the
+job state is also published there, so any worker can report on a job started
+by another one.
+"""
+from typing import AsyncIterator, Dict, List, Optional
+import asyncio
+import json
+import logging
+import time
+import uuid
+
+import aiohttp
+
+from repository import repo
+from upstream import SyncError, upstream
+from logos import logo_cache
+from cache import cache, SHARED_ERRORS
+from render_cache import render_cache
+from metrics import SYNC_RESULTS
+import profiler
+
+logger = logging.getLogger(__name__)
+
+# Intervallo minimo tra due eventi di progresso dello stesso job
+PROGRESS_INTERVAL = 0.25
+# Per quanto tempo un job concluso resta consultabile
+JOB_RETENTION_SECONDS = 600
+# Commento SSE inviato se non ci sono eventi, per tenere aperte le connessioni via proxy
+HEARTBEAT_SECONDS = 15
+
+class SyncJob:
+    """State of one playlist sync; every update is broadcast to the subscribed streams"""
+
+    def __init__(self, playlist_id: int, user_id: int):
+        self.id = uuid.uuid4().hex
+        self.playlist_id = playlist_id
+        self.user_id = user_id
+        self.status = "queued"
+        self.stage = "queued"
+        self.bytes_fetched = 0
+        self.bytes_total: Optional[int] = None
+        self.channels_parsed = 0
+        self.rows_written = 0
+        self.rows_total: Optional[int] = None
+        self.result: Optional[Dict] = None
+        self.error: Optional[Dict] = None
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self._loop = asyncio.get_running_loop()
+        self._listeners: List[asyncio.Queue] = []
+        self._last_event = 0.0
+        self._outbox: Optional[asyncio.Queue] = None
+        self._publisher: Optional[asyncio.Task] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("completed", "failed")
+
+    def snapshot(self) -> Dict:
+        return {
+            "id": self.id,
+            "playlist_id": self.playlist_id,
+            "status": self.status,
+            "stage": self.stage,
+            "bytes_fetched": self.bytes_fetched,
+            "bytes_total": self.bytes_total,
+            "channels_parsed": self.channels_parsed,
+            "rows_written": self.rows_written,
+            "rows_total": self.rows_total,
+            "result": self.result,
+            "error": self.error,
+        }
+
+    def update(self, force: bool = False, **fields):
+        """Set progress fields; may be called from worker threads"""
+        for name, value in fields.items():
+            setattr(self, name, value)
+        now = time.monotonic()
+        if force or "stage" in fields or now - self._last_event >= PROGRESS_INTERVAL:
+            self._last_event = now
+            self._emit("progress")
+
+    def complete(self, result: Dict):
+        self.status = "completed"
+        self.stage = "done"
+        self.result = result
+        self.finished_at = time.time()
+        self._emit("completed")
+
+    def fail(self, status_code: int, detail: str):
+        self.status = "failed"
+        self.error = {"status_code": status_code, "detail": detail}
+        self.finished_at = time.time()
+        self._emit("failed")
+
+    def _emit(self, event: str):
+        message = (event, self.snapshot())
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._deliver(message)
+        else:
+            self._loop.call_soon_threadsafe(self._deliver, message)
+
+    def _deliver(self, message):
+        for queue in self._listeners:
+            queue.put_nowait(message)
+        if cache.shared is not None:
+            if self._outbox is None:
+                self._outbox = asyncio.Queue()
+                self._publisher = asyncio.create_task(self._publish())
+            self._outbox.put_nowait(message)
+
+    async def _publish(self):
+        """Mirror the job state to the shared cache, in order, for the other workers"""
+        event = "progress"
+        while event == "progress":
+            event, data = await self._outbox.get()
+            # Se la rete è lenta basta pubblicare l'ultimo stato
+            while not self._outbox.empty():
+                event, data = self._outbox.get_nowait()
+            await self.share(event, data)
+
+    async def share(self, event: str = "progress", data: Optional[Dict] = None):
+        payload = json.dumps({
+            "user_id": self.user_id,
+            "event": event,
+            "snapshot": data or self.snapshot()
+        }).encode()
+        try:
+            await cache.shared.set(_shared_key(self.id), payload, JOB_RETENTION_SECONDS)
+            await cache.shared.publish(_shared_key(self.id), payload)
+        except SHARED_ERRORS as e:
+            logger.warning("sync job state not shared", extra={"job_id": self.id, "error": str(e)})
+
+    async def events(self) -> AsyncIterator[str]:
+        """Server-Sent Events: the current state, then every update until the job ends"""
+        queue: asyncio.Queue = asyncio.Queue()
+        self._listeners.append(queue)
+        try:
+            event = {"completed": "completed", "failed": "failed"}.get(self.status, "progress")
+            yield _format_event(event, self.snapshot())
+            while event == "progress":
+                try:
+                    event, data = await asyncio.wait_for(queue.get(), HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield _format_event(event, data)
+        finally:
+            self._listeners.remove(queue)
+
+def _format_event(event: str, data: Dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def _shared_key(job_id: str) -> str:
+    return f"omg:sync-job:{job_id}"
+
+async def _load_shared_state(job_id: str) -> Optional[Dict]:
+    try:
+        payload = await cache.shared.get(_shared_key(job_id))
+    except SHARED_ERRORS as e:
+        logger.warning("shared cache unavailable", extra={"error": str(e)})
+        return None
+    return json.loads(payload) if payload else None
+
+class RemoteSyncJob:
+    """A job running in another worker, followed through the shared cache"""
+
+    def __init__(self, job_id: str, state: Dict):
+        self.id = job_id
+        self._state = state
+
+    def snapshot(self) -> Dict:
+        return self._state["snapshot"]
+
+    async def events(self) -> AsyncIterator[str]:
+        subscription = await cache.shared.subscribe(_shared_key(self.id))
+        queue: asyncio.Queue = asyncio.Queue()
+
+        async def forward():
+            async for message in subscription.messages():
+                queue.put_nowait(message)
+
+        forwarder = asyncio.create_task(forward())
+        try:
+            # Stato riletto dopo la sottoscrizione, così nessun aggiornamento va perso
+            state = await _load_shared_state(self.id) or self._state
+            event = state["event"]
+            yield _format_event(event, state["snapshot"])
+            while event == "progress" and not forwarder.done():
+                try:
+                    message = await asyncio.wait_for(queue.get(), HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                state = json.loads(message)
+                event = state["event"]
+                yield _format_event(event, state["snapshot"])
+        finally:
+            forwarder.cancel()
+            await subscription.close()
+
+class SyncJobRegistry:
+    """In-memory registry of sync jobs (per worker process)"""
+
+    def __init__(self):
+        self._jobs: Dict[str, SyncJob] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    async def get(self, job_id: str, user_id: int):
+        """The job if it belongs to the user: a local SyncJob or a RemoteSyncJob of another worker"""
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return job if job.user_id == user_id else None
+        if cache.shared is None:
+            return None
+        state = await _load_shared_state(job_id)
+        if state is None or state["user_id"] != user_id:
+            return None
+        return RemoteSyncJob(job_id, state)
+
+    async def start(self, playlist: Dict, user_id: int) -> SyncJob:
+        """Start a sync of the playlist in the background, or return the one already running"""
+        self._prune()
+        for job in self._jobs.values():
+            if job.playlist_id == playlist['id'] and job.user_id == user_id and not job.finished:
+                return job
+
+        job = SyncJob(playlist['id'], user_id)
+        self._jobs[job.id] = job
+        if cache.shared is not None:
+            # Visibile agli altri worker prima della risposta (il client apre subito lo stream)
+            await job.share()
+        task = asyncio.create_task(run_job(job, playlist))
+        self._tasks[job.id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job.id, None))
+        return job
+
+    def _prune(self):
+        cutoff = time.time() - JOB_RETENTION_SECONDS
+        for job_id in [job.id for job in self._jobs.values() if job.finished and job.finished_at < cutoff]:
+            del self._jobs[job_id]
+
+sync_jobs = SyncJobRegistry()
+
+async def run_sync(playlist: Dict, user_id: int, job: SyncJob) -> Dict:
+    """Fetch, parse and store an upstream playlist; raises SyncError on failure"""
+    playlist_id = playlist['id']
+    logger.info("sync started", extra={"playlist_id": playlist_id, "user_id": user_id, "job_id": job.id})
+    job.status = "running"
+
+    try:
+        fetched = await upstream.get(playlist['url'], job)
+        channels = fetched.channels
+        logger.debug("playlist downloaded", extra={"playlist_id": playlist_id, "bytes": fetched.size})
+
+        try:
+            diff = await repo.sync_channels(
+                user_id, playlist_id, channels,
+                progress=lambda **fields: job.update(**fields)
+            )
+            job.update(force=True)
+        except Exception as e:
+            logger.exception("sync database error", extra={"playlist_id": playlist_id})
+            raise SyncError(500, f"Database error during sync: {str(e)}")
+
+        if diff.changed:
+            await render_cache.invalidate_user(user_id)
+        logo_cache.prefetch(channel.logo for channel in channels)
+
+    except SyncError:
+        SYNC_RESULTS.inc(result="error")
+        raise
+    except aiohttp.ClientError as e:
+        SYNC_RESULTS.inc(result="error")
+        logger.warning("playlist fetch failed", extra={"playlist_id": playlist_id, "error": str(e)})
+        raise SyncError(400, f"Failed to fetch playlist: {str(e)}")
+    except Exception as e:
+        SYNC_RESULTS.inc(result="error")
+        logger.exception("sync failed", extra={"playlist_id": playlist_id})
+        raise SyncError(500, f"Error syncing playlist: {str(e)}")
+
+    SYNC_RESULTS.inc(result="success")
+    logger.info(
+        "sync completed",
+        extra={"playlist_id": playlist_id, "channels": len(channels), **diff.summary()}
+    )
+    result = {
+        "message": "Playlist synchronized successfully",
+        "channels_count": len(channels),
+        "changes": diff.summary()
+    }
+    job.complete(result)
+    return result
+
+async def run_job(job: SyncJob, playlist: Dict):
+    """Background task body: failures end up in the job instead of being raised"""
+    # Il job sopravvive alla richiesta che l'ha avviato: le sue query non sono di quella route
+    profiler.detach()
+    try:
+        await run_sync(playlist, job.user_id, job)
+    except SyncError as e:
+        job.fail(e.status_code, e.detail)
+    except Exception as e:
+        logger.exception("sync job crashed", extra={"job_id": job.id})
+        job.fail(500, str(e))
@@ -0,0 +1,133 @@
+"""Interned extra_tags sets.
+
+Most channels carry one of a handful of identical tag sets (the same
+#EXTVLCOPT user-agent, the playlist's epg_url...), so channels reference a row
+of `tag_sets` by id instead of each storing its own JSON text; empty sets are
+stored as NULL. Tag sets are never modified once written, which lets every
+process cache the id <-> set mapping and decode each set once instead of once
+per row. The decoded dicts are shared between rows: treat them as read-only.
+
+The SQLite maintenance task deletes the sets no channel references any more.
+Ids are never reused (AUTOINCREMENT), so cached decodings stay right, but a
+cached id may be gone: writers confirm the ids they take from the cache inside
+their own transaction.
+"""
+from typing import Dict, Hashable, Iterable, List, Optional
+import json
+
+from m3u_utils import EMPTY_TAGS
+from sync import chunked
+
+def encode_tags(tags: Optional[Dict[str, str]]) -> Optional[str]:
+    """Canonical text of a tag set (None for an empty one).
+
+    Keys are not sorted on purpose: the tags are rendered back as #EXTVLCOPT
+    lines in the upstream order, so the same tags in another order are another
+    set.
+    """
+    return json.dumps(tags) if tags else None
+
+class TagSetCache:
+    """Mapping between the tag set ids of one database and their decoded sets"""
+
+    def __init__(self):
+        self._ids: Dict[str, int] = {}
+        self._sets: Dict[int, Dict[str, str]] = {}
+
+    def id_for(self, text: str) -> Optional[int]:
+        return self._ids.get(text)
+
+    def get(self, tag_set_id: Optional[int]) -> Dict[str, str]:
+        if tag_set_id is None:
+            return EMPTY_TAGS
+        return self._sets[tag_set_id]
+
+    def missing(self, ids: Iterable[Optional[int]]) -> List[int]:
+        """Ids not decoded yet, to be loaded from the database"""
+        return list({i for i in ids if i is not None and i not in self._sets})
+
+    def load(self, tag_set_id: int, text: str):
+        """Decode a set read from the database"""
+        if tag_set_id not in self._sets:
+            self._sets[tag_set_id] = json.loads(text)
+
+    def remember(self, tag_set_id: int, text: str):
+        """Record a committed set, so later writes reuse its id"""
+        self.load(tag_set_id, text)
+        self._ids[text] = tag_set_id
+
+    def attach(self, rows: List[Dict]) -> List[Dict]:
+        """Replace the tag_set_id of each row with its decoded extra_tags"""
+        for row in rows:
+            row['extra_tags'] = self.get(row.pop('tag_set_id'))
+        return rows
+
+_caches: Dict[Hashable, TagSetCache] = {}
+
+def tag_set_cache(database: Hashable) -> TagSetCache:
+    cache = _caches.get(database)
+    if cache is None:
+        cache = _caches.setdefault(database, TagSetCache())
+    return cache
+
+# Helper per SQLite; la cache è quella del file della connessione
+def load_tag_sets(db, rows: List[Dict]) -> List[Dict]:
+    """Decode the tag sets referenced by `rows` (see TagSetCache.attach)"""
+    cache = tag_set_cache(db.path)
+    for ids in chunked(cache.missing(row['tag_set_id'] for row in rows)):
+        placeholders = ','.join('?' * len(ids))
+        for row in db.execute(
+            f"SELECT id, tags FROM tag_sets WHERE id IN ({placeholders})",
+            ids
+        ).fetchall():
+            cache.load(row['id'], row['tags'])
+    return cache.attach(rows)
+
+class TagSetWriter:
+    """Intern tag sets inside the caller's transaction.
+
+    New ids are only added to the shared cache by commit(), after the caller's
+    transaction has committed: a rolled back id may be reused by SQLite.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.cache = tag_set_cache(db.path)
+        # testo -> id confermato o creato in questa transazione
+        self._created: Dict[str, int] = {}
+
+    def ids(self, sets: List[Optional[Dict[str, str]]]) -> List[Optional[int]]:
+        texts = [encode_tags(tags) for tags in sets]
+        wanted = {text for text in texts if text is not None and text not in self._created}
+        self._confirm({text: self.cache.id_for(text) for text in wanted})
+        unknown = sorted(wanted.difference(self._created))
+        for batch in chunked(unknown):
+            self.db.executemany(
+                "INSERT OR IGNORE INTO tag_sets (tags) VALUES (?)",
+                [(text,) for text in batch]
+            )
+            placeholders = ','.join('?' * len(batch))
+            for row in self.db.execute(
+                f"SELECT id, tags FROM tag_sets WHERE tags IN ({placeholders})",
+                batch
+            ).fetchall():
+                self._created[row['tags']] = row['id']
+        return [None if text is None else self._created[text] for text in texts]
+
+    def _confirm(self, cached: Dict[str, Optional[int]]):
+        # La manutenzione può aver cancellato un set rimasto orfano dopo la lettura in cache
+        by_id = {tag_set_id: text for text, tag_set_id in cached.items() if tag_set_id is not None}
+        for ids in chunked(list(by_id)):
+            placeholders = ','.join('?' * len(ids))
+            for row in self.db.execute(
+                f"SELECT id FROM tag_sets WHERE id IN ({placeholders})", ids
+            ).fetchall():
+                self._created[by_id[row['id']]] = row['id']
+
+    def id(self, tags: Optional[Dict[str, str]]) -> Optional[int]:
+        return self.ids([tags])[0]
+
+    def commit(self):
+        for text, tag_set_id in self._created.items():
+            self.cache.remember(tag_set_id, text)
+        self._created = {}
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# I moduli del backend si importano come top-level (come fa uvicorn da backend/)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,84 @@
+"""Two workers' cache tiers sharing one store.
+
+Each CacheTier stands for one uvicorn worker; the MemoryStore stands for the
+Redis-compatible server, pub/sub included.
+"""
+import asyncio
+
+import pytest
+
+from cache import CacheTier, LocalCache, MemoryStore
+
+pytestmark = pytest.mark.anyio
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+async def _until(condition):
+    # Il listener gira nel loop: gli si lascia il tempo di consegnare
+    for _ in range(100):
+        if condition():
+            return
+        await asyncio.sleep(0)
+    raise AssertionError("condition not reached")
+
+def _tier(store: MemoryStore) -> CacheTier:
+    return CacheTier(LocalCache(max_bytes=1024 * 1024, max_entry_bytes=64 * 1024), store)
+
+@pytest.fixture
+async def workers():
+    store = MemoryStore()
+    first, second = _tier(store), _tier(store)
+    for tier in (first, second):
+        await tier.start()
+        await _until(lambda: tier._subscribed)
+    yield first, second
+    for tier in (first, second):
+        await tier.close()
+
+async def test_set_in_one_worker_is_read_by_the_other(workers):
+    first, second = workers
+    key = await first.key("users", "auth:alice")
+    assert key == await second.key("users", "auth:alice")
+
+    await first.set(key, b"alice", "users")
+    assert await second.get(key, "users") == b"alice"
+    # Dopo la prima lettura dallo store condiviso la voce è anche in L1
+    assert second.local.get(key) == b"alice"
+
+async def test_bump_invalidates_every_worker(workers):
+    first, second = workers
+    old_key = await first.key("users", "auth:alice")
+    await first.set(old_key, b"alice", "users")
+    assert await second.get(old_key, "users") == b"alice"
+
+    await first.bump("users")
+    await _until(lambda: second._versions.get("users") == 1)
+
+    assert second.local.get(old_key) is None
+    new_key = await second.key("users", "auth:alice")
+    assert new_key != old_key
+    assert new_key == await first.key("users", "auth:alice")
+    assert await second.get(new_key, "users") is None
+
+async def test_bump_leaves_other_scopes_alone(workers):
+    first, second = workers
+    key = await first.key("playlists:1", "m3u:1")
+    await first.set(key, b"#EXTM3U", "playlists:1")
+    assert await second.get(key, "playlists:1") == b"#EXTM3U"
+
+    await first.bump("users")
+    await _until(lambda: second._versions.get("users") == 1)
+
+    assert await second.key("playlists:1", "m3u:1") == key
+    assert second.local.get(key) == b"#EXTM3U"
+
+async def test_unsubscribed_worker_reads_versions_from_the_store():
+    store = MemoryStore()
+    first, second = _tier(store), _tier(store)
+    await first.bump("users")
+    # Senza sottoscrizione la versione non viene tenuta in memoria
+    assert await second.key("users", "auth:alice") == "auth:alice:v1"
+    await first.bump("users")
+    assert await second.key("users", "auth:alice") == "auth:alice:v2"
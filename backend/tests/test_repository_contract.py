@@ -0,0 +1,229 @@
+"""Contract tests run against every storage backend.
+
+The same scenarios run on SQLite (shared and per_user, in a temporary
+directory) and on PostgreSQL when DATABASE_URL points to a server; each
+PostgreSQL test works in a schema of its own, dropped afterwards.
+"""
+import os
+import uuid
+
+import pytest
+
+import database
+from m3u_utils import M3UChannel
+from repository import DuplicateChannelError
+from sqlite_repository import SQLiteRepository
+
+BACKENDS = ["sqlite", "sqlite_per_user", "postgres"]
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+@pytest.fixture(params=BACKENDS)
+async def repo(request, tmp_path, monkeypatch):
+    if request.param == "postgres":
+        url = os.getenv("DATABASE_URL")
+        if not url:
+            pytest.skip("DATABASE_URL not set")
+        asyncpg = pytest.importorskip("asyncpg")
+        from postgres_repository import PostgresRepository
+
+        schema = f"contract_{uuid.uuid4().hex[:12]}"
+        conn = await asyncpg.connect(url)
+        await conn.execute(f"CREATE SCHEMA {schema}")
+        # asyncpg passa i parametri sconosciuti della DSN come impostazioni di sessione
+        separator = "&" if "?" in url else "?"
+        repository = PostgresRepository(f"{url}{separator}search_path={schema}")
+        try:
+            await repository.init()
+            yield repository
+        finally:
+            await repository.close()
+            await conn.execute(f"DROP SCHEMA {schema} CASCADE")
+            await conn.close()
+        return
+
+    monkeypatch.setattr(database, "DATABASE_PATH", tmp_path / "playlists.db")
+    monkeypatch.setattr(database, "USER_DATA_DIR", tmp_path / "users")
+    monkeypatch.setattr(database, "STORAGE_MODE", "per_user" if request.param == "sqlite_per_user" else "shared")
+    monkeypatch.setattr(database, "_ready_shards", set())
+    repository = SQLiteRepository()
+    await repository.init()
+    yield repository
+
+pytestmark = pytest.mark.anyio
+
+def channel(name, group=None, url=None, tvg_id=None, **tags):
+    return M3UChannel(name, url or f"http://example.com/{name}", group=group, tvg_id=tvg_id, extra_tags=tags)
+
+async def user_id(repo):
+    return (await repo.get_user("admin"))["id"]
+
+async def new_playlist(repo, uid, name="source", **fields):
+    data = {"name": name, "url": None, "is_custom": False, "public_token": None, "epg_url": None, "rules": None}
+    data.update(fields)
+    return await repo.create_playlist(uid, data)
+
+async def names(repo, uid, playlist_id):
+    return [row["name"] for row in await repo.get_playlist_channels(uid, playlist_id)]
+
+async def members(repo, uid, playlist_id):
+    return await exported(repo, await repo.get_playlist(uid, playlist_id))
+
+async def exported(repo, playlist):
+    rendered = []
+    async for batch in repo.iter_export_channels(playlist, 2):
+        rendered.extend(item.name for _, item in batch)
+    return rendered
+
+async def test_sync_diff(repo):
+    uid = await user_id(repo)
+    playlist = await new_playlist(repo, uid)
+
+    diff = await repo.sync_channels(uid, playlist["id"], [channel("A", "G1"), channel("B", "G1"), channel("C", "G2")])
+    assert diff.summary() == {"added": 3, "updated": 0, "removed": 0, "unchanged": 0}
+    assert await names(repo, uid, playlist["id"]) == ["A", "B", "C"]
+
+    diff = await repo.sync_channels(uid, playlist["id"], [channel("A", "G1"), channel("B", "G1"), channel("C", "G2")])
+    assert diff.summary() == {"added": 0, "updated": 0, "removed": 0, "unchanged": 3}
+
+    diff = await repo.sync_channels(uid, playlist["id"], [
+        channel("A", "G1"), channel("C", "G3"), channel("D", "G2", tvg_id="d.tv", catchup="1")
+    ])
+    summary = diff.summary()
+    assert summary["added"] == 1 and summary["removed"] == 1 and summary["unchanged"] == 1
+    rows = await repo.get_playlist_channels(uid, playlist["id"])
+    assert [(row["name"], row["group_title"], row["tvg_id"]) for row in rows] == [
+        ("A", "G1", None), ("C", "G3", None), ("D", "G2", "d.tv")
+    ]
+    assert rows[2]["extra_tags"] == {"catchup": "1"}
+
+async def test_custom_playlist_membership(repo):
+    uid = await user_id(repo)
+    source = await new_playlist(repo, uid)
+    await repo.sync_channels(uid, source["id"], [channel("A"), channel("B"), channel("C")])
+    ids = {row["name"]: row["id"] for row in await repo.get_playlist_channels(uid, source["id"])}
+    custom = await new_playlist(repo, uid, "custom", is_custom=True, public_token=str(uuid.uuid4()))
+
+    await repo.add_custom_channel(uid, custom["id"], ids["C"])
+    await repo.add_custom_channel(uid, custom["id"], ids["A"])
+    with pytest.raises(DuplicateChannelError):
+        await repo.add_custom_channel(uid, custom["id"], ids["A"])
+    assert await members(repo, uid, custom["id"]) == ["C", "A"]
+    assert [row["name"] for row in await repo.available_channels(uid, custom["id"])] == ["B"]
+
+    await repo.remove_custom_channel(uid, custom["id"], ids["C"])
+    assert await members(repo, uid, custom["id"]) == ["A"]
+
+    # Il canale sparisce dalla playlist di origine: anche dalla custom
+    await repo.sync_channels(uid, source["id"], [channel("B"), channel("C")])
+    assert await members(repo, uid, custom["id"]) == []
+
+    found = await repo.find_public_playlist(custom["public_token"])
+    assert found["id"] == custom["id"]
+
+async def test_rule_materialization(repo):
+    uid = await user_id(repo)
+    source = await new_playlist(repo, uid)
+    await repo.sync_channels(uid, source["id"], [
+        channel("Sport 1", "Sports"), channel("News", "News"), channel("Sport 2", "Sports", tvg_id="s2")
+    ])
+    rules = {"include_groups": ["^sports$"], "name_regex": None, "require_tvg_id": False,
+             "exclude_dead": True, "source_playlist_ids": []}
+    custom = await new_playlist(repo, uid, "rules", is_custom=True, rules=rules)
+    assert await members(repo, uid, custom["id"]) == ["Sport 1", "Sport 2"]
+
+    # Sync: i canali nuovi che corrispondono entrano, quelli non più corrispondenti escono
+    await repo.sync_channels(uid, source["id"], [
+        channel("Sport 1", "Other"), channel("News", "News"), channel("Sport 2", "Sports", tvg_id="s2"),
+        channel("Sport 3", "Sports")
+    ])
+    assert await members(repo, uid, custom["id"]) == ["Sport 2", "Sport 3"]
+
+    # Canale segnato come morto: escluso da exclude_dead
+    sport3 = [row for row in await repo.get_playlist_channels(uid, source["id"]) if row["name"] == "Sport 3"][0]
+    await repo.update_channel(uid, sport3["id"], {"is_dead": True})
+    assert await members(repo, uid, custom["id"]) == ["Sport 2"]
+
+    playlist = await repo.get_playlist(uid, custom["id"])
+    await repo.set_rules(uid, playlist, dict(rules, require_tvg_id=False, include_groups=[], name_regex="^news"))
+    assert await members(repo, uid, custom["id"]) == ["News"]
+
+async def test_groups(repo):
+    uid = await user_id(repo)
+    playlist = await new_playlist(repo, uid)
+    await repo.sync_channels(uid, playlist["id"], [
+        channel("A1", "A"), channel("A2", "A"), channel("B1", "B"), channel("N1"), channel("C1", "C")
+    ])
+    groups = await repo.list_groups(uid, playlist["id"])
+    assert [(group["name"], group["channel_count"], group["hidden"]) for group in groups] == [
+        ("A", 2, False), ("B", 1, False), ("", 1, False), ("C", 1, False)
+    ]
+
+    assert await repo.rename_groups(uid, playlist["id"], ["B", "C"], "BC") == 2
+    assert [row["name"] for row in await repo.group_channels(uid, playlist["id"], "BC")] == ["B1", "C1"]
+    assert await repo.get_group(uid, playlist["id"], "B") is None
+
+    assert await repo.set_groups_hidden(uid, playlist["id"], ["A"], True) == 1
+    assert (await repo.get_group(uid, playlist["id"], "A"))["hidden"]
+    playlist = await repo.get_playlist(uid, playlist["id"])
+    assert await exported(repo, playlist) == ["B1", "N1", "C1"]
+
+    await repo.move_groups(uid, playlist["id"], ["BC"], "A")
+    assert await names(repo, uid, playlist["id"]) == ["B1", "C1", "A1", "A2", "N1"]
+    await repo.move_groups(uid, playlist["id"], ["BC"], None)
+    assert [group["name"] for group in await repo.list_groups(uid, playlist["id"])] == ["A", "", "BC"]
+
+    # La visibilità resta dopo una sync, i group-title tornano quelli upstream
+    await repo.sync_channels(uid, playlist["id"], [channel("A1", "A"), channel("B1", "B")])
+    groups = {group["name"]: group["hidden"] for group in await repo.list_groups(uid, playlist["id"])}
+    assert groups == {"A": True, "B": False}
+
+async def test_playlist_changes(repo):
+    uid = await user_id(repo)
+    playlist = await new_playlist(repo, uid, public_token=str(uuid.uuid4()))
+    await repo.sync_channels(uid, playlist["id"], [channel("A"), channel("B"), channel("C")])
+    playlist = await repo.get_playlist(uid, playlist["id"])
+
+    snapshot = await repo.playlist_changes(playlist, None)
+    assert snapshot["full"] and [item.name for _, item in snapshot["channels"]] == ["A", "B", "C"]
+    since = snapshot["version"]
+    ids = {item.name: channel_id for channel_id, item in snapshot["channels"]}
+
+    assert (await repo.playlist_changes(playlist, since))["changes"] == []
+
+    await repo.update_channel(uid, ids["A"], {"name": "A+"})
+    await repo.delete_channel(uid, ids["B"])
+    await repo.sync_channels(uid, playlist["id"], [channel("A+", url="http://example.com/A"), channel("C"), channel("D")])
+
+    delta = await repo.playlist_changes(playlist, since)
+    assert not delta["full"] and delta["version"] > since
+    ops = {change["id"]: change["op"] for change in delta["changes"]}
+    assert ops[ids["A"]] == "updated" and ops[ids["B"]] == "removed"
+    added = [change for change in delta["changes"] if change["op"] == "added"]
+    assert [change["channel"].name for change in added] == ["D"]
+    assert ops[ids["C"]] == "moved"
+
+    assert (await repo.playlist_changes(playlist, delta["version"]))["changes"] == []
+    # Versione più vecchia del log: snapshot completo
+    stale = await repo.playlist_changes(playlist, -1)
+    assert stale["full"]
+
+async def test_export_fields_bump_version(repo):
+    uid = await user_id(repo)
+    playlist = await new_playlist(repo, uid, public_token=str(uuid.uuid4()))
+    await repo.sync_channels(uid, playlist["id"], [channel("A")])
+    since = (await repo.get_playlist(uid, playlist["id"]))["version"]
+
+    # L'URL sorgente non compare nell'export
+    await repo.update_playlist(uid, playlist["id"], {"url": "http://example.com/list.m3u"})
+    assert (await repo.get_playlist(uid, playlist["id"]))["version"] == since
+
+    await repo.update_playlist(uid, playlist["id"], {"epg_url": "http://example.com/epg.xml"})
+    await repo.update_playlist(uid, playlist["id"], {"name": "renamed"})
+    playlist = await repo.get_playlist(uid, playlist["id"])
+    assert playlist["version"] == since + 2
+    # Nessun canale cambiato: il delta è vuoto
+    delta = await repo.playlist_changes(playlist, since)
+    assert not delta["full"] and delta["changes"] == []
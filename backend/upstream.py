@@ -0,0 +1,196 @@
+"""Shared access to upstream playlists.
+
+Many users import the same provider URL. Concurrent syncs of one URL share a
+single download and parse: the first one fetches, the others wait for its
+result and follow its progress. Parsed channels are also kept for a short
+window (UPSTREAM_PARSE_CACHE_SECONDS) keyed by URL and content hash, so a sync
+that downloads an unchanged playlist skips the parse. Both work within one
+worker process.
+
+Parsed channels are shared between syncs: treat them as read-only.
+"""
+from typing import Dict, List, Optional, Tuple
+from collections import OrderedDict
+import asyncio
+import codecs
+import hashlib
+import logging
+import os
+import time
+
+import aiohttp
+
+from m3u_utils import M3UChannel, M3UStreamParser, parse_m3u_auto, PARALLEL_PARSE_THRESHOLD, PARALLEL_PARSE_WORKERS
+from metrics import (
+    SYNC_STAGE_SECONDS, SYNC_BYTES, SYNC_CHANNELS_PARSED, SYNC_PARSE_RATE,
+    UPSTREAM_FETCHES, UPSTREAM_PARSES
+)
+
+logger = logging.getLogger(__name__)
+
+# Caratteri passati al parser per ogni passo (un evento di progresso a passo)
+PARSE_SLICE_SIZE = 1024 * 1024
+
+class SyncError(Exception):
+    """Sync failure carrying the HTTP status and detail to report"""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+class UpstreamPlaylist:
+    """A downloaded and parsed upstream playlist"""
+
+    def __init__(self, channels: List[M3UChannel], size: int, content_hash: str):
+        self.channels = channels
+        self.size = size
+        self.content_hash = content_hash
+
+class FetchProgress:
+    """Progress of one upstream fetch, mirrored to every sync job waiting on it"""
+
+    def __init__(self):
+        self.fields: Dict = {}
+        self._jobs: List = []
+
+    def attach(self, job):
+        self._jobs.append(job)
+        if self.fields:
+            # Chi si aggancia a metà download riparte dallo stato attuale
+            job.update(force=True, **self.fields)
+
+    def detach(self, job):
+        self._jobs.remove(job)
+
+    def update(self, force: bool = False, **fields):
+        self.fields.update(fields)
+        for job in self._jobs:
+            job.update(force=force, **fields)
+
+async def fetch_playlist(url: str, progress) -> Tuple[str, int, str]:
+    """Download an upstream playlist, decoding it as it arrives; returns text, size and content hash"""
+    digest = hashlib.sha256()
+    size = 0
+    async with aiohttp.ClientSession() as session:
+        async with session.get(url) as response:
+            if response.status != 200:
+                raise SyncError(400, f"Failed to fetch playlist: HTTP {response.status}")
+
+            progress.update(stage="fetch", bytes_total=response.content_length)
+            decoder = codecs.getincrementaldecoder(response.charset or 'utf-8-sig')(errors='replace')
+            parts = []
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                digest.update(chunk)
+                size += len(chunk)
+                parts.append(decoder.decode(chunk))
+                progress.update(bytes_fetched=size)
+            parts.append(decoder.decode(b'', final=True))
+    progress.update(force=True)
+    return ''.join(parts), size, digest.hexdigest()
+
+async def parse_playlist(content: str, progress) -> List[M3UChannel]:
+    """Parse off the event loop; large playlists go to the process pool in one piece"""
+    progress.update(stage="parse")
+    if PARALLEL_PARSE_WORKERS > 1 and len(content) >= PARALLEL_PARSE_THRESHOLD:
+        channels = await asyncio.to_thread(parse_m3u_auto, content)
+    else:
+        parser = M3UStreamParser()
+        channels = []
+        for start in range(0, len(content), PARSE_SLICE_SIZE):
+            channels.extend(await asyncio.to_thread(parser.feed, content[start:start + PARSE_SLICE_SIZE]))
+            progress.update(channels_parsed=parser.count)
+        channels.extend(parser.close())
+    progress.update(force=True, channels_parsed=len(channels))
+    return channels
+
+class FetchCoordinator:
+    """Coalesces concurrent fetches of the same URL and caches recent parses"""
+
+    def __init__(self, ttl: float, max_channels: int):
+        self.ttl = ttl
+        self.max_channels = max_channels
+        self._inflight: Dict[str, Tuple[asyncio.Task, FetchProgress]] = {}
+        # URL -> (hash del contenuto, scadenza, canali), in ordine di inserimento
+        self._parsed: "OrderedDict[str, Tuple[str, float, List[M3UChannel]]]" = OrderedDict()
+        self._cached_channels = 0
+
+    async def get(self, url: str, job) -> UpstreamPlaylist:
+        """Download and parse `url`, or wait for the fetch of it already running; progress goes to `job`"""
+        inflight = self._inflight.get(url)
+        if inflight is None:
+            progress = FetchProgress()
+            task = asyncio.create_task(self._load(url, progress))
+            # Il risultato può restare senza nessuno in attesa (job annullati)
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            inflight = self._inflight[url] = (task, progress)
+            UPSTREAM_FETCHES.inc(result="fetched")
+        else:
+            UPSTREAM_FETCHES.inc(result="joined")
+
+        task, progress = inflight
+        progress.attach(job)
+        try:
+            # shield: l'annullamento di un job non interrompe il download degli altri
+            return await asyncio.shield(task)
+        finally:
+            progress.detach(job)
+
+    async def _load(self, url: str, progress: FetchProgress) -> UpstreamPlaylist:
+        try:
+            with SYNC_STAGE_SECONDS.time(stage="fetch"):
+                content, size, content_hash = await fetch_playlist(url, progress)
+            SYNC_BYTES.inc(size)
+
+            channels = self._cached(url, content_hash)
+            if channels is not None:
+                UPSTREAM_PARSES.inc(result="reused")
+                progress.update(force=True, stage="parse", channels_parsed=len(channels))
+                return UpstreamPlaylist(channels, size, content_hash)
+
+            try:
+                started = time.perf_counter()
+                channels = await parse_playlist(content, progress)
+                elapsed = time.perf_counter() - started
+                SYNC_STAGE_SECONDS.observe(elapsed, stage="parse")
+                SYNC_CHANNELS_PARSED.inc(len(channels))
+                if elapsed > 0:
+                    SYNC_PARSE_RATE.set(len(channels) / elapsed)
+            except Exception as e:
+                logger.warning("playlist parse failed", extra={"error": str(e)})
+                raise SyncError(400, f"Failed to parse M3U content: {str(e)}")
+            UPSTREAM_PARSES.inc(result="parsed")
+            self._store(url, content_hash, channels)
+            return UpstreamPlaylist(channels, size, content_hash)
+        finally:
+            del self._inflight[url]
+
+    def _expire(self, now: float):
+        while self._parsed:
+            url, (_, expires_at, channels) = next(iter(self._parsed.items()))
+            if expires_at > now and self._cached_channels <= self.max_channels:
+                break
+            del self._parsed[url]
+            self._cached_channels -= len(channels)
+
+    def _cached(self, url: str, content_hash: str) -> Optional[List[M3UChannel]]:
+        self._expire(time.monotonic())
+        entry = self._parsed.get(url)
+        if entry is None or entry[0] != content_hash:
+            return None
+        return entry[2]
+
+    def _store(self, url: str, content_hash: str, channels: List[M3UChannel]):
+        if self.ttl <= 0 or len(channels) > self.max_channels:
+            return
+        previous = self._parsed.pop(url, None)
+        if previous is not None:
+            self._cached_channels -= len(previous[2])
+        self._parsed[url] = (content_hash, time.monotonic() + self.ttl, channels)
+        self._cached_channels += len(channels)
+        self._expire(time.monotonic())
+
+upstream = FetchCoordinator(
+    ttl=float(os.getenv("UPSTREAM_PARSE_CACHE_SECONDS", 120)),
+    max_channels=int(os.getenv("UPSTREAM_PARSE_CACHE_MAX_CHANNELS", 500_000))
+)
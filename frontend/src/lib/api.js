@@ -59,10 +59,34 @@ export const playlists = {
     return data;
   },
   
-  sync: async (id) => {
-    const { data } = await api.post(`/playlists/${id}/sync`);
-    return data;
+  // Avvia la sincronizzazione come job e ne segue il progresso via SSE
+  sync: async (id, onProgress) => {
+    const { data: job } = await api.post(`/playlists/${id}/sync-jobs`);
+    return playlists.watchSyncJob(job.id, onProgress);
   },
+
+  watchSyncJob: (jobId, onProgress) => new Promise((resolve, reject) => {
+    const token = encodeURIComponent(getAuthToken() || '');
+    const source = new EventSource(`${api.defaults.baseURL}/sync-jobs/${jobId}/events?access_token=${token}`);
+    source.addEventListener('progress', (event) => {
+      onProgress?.(JSON.parse(event.data));
+    });
+    source.addEventListener('completed', (event) => {
+      source.close();
+      resolve(JSON.parse(event.data).result);
+    });
+    source.addEventListener('failed', (event) => {
+      source.close();
+      // Stessa forma degli errori axios, così i chiamanti leggono error.response.data.detail
+      reject({ response: { data: JSON.parse(event.data).error } });
+    });
+    source.onerror = () => {
+      // EventSource si riconnette da solo; se la connessione è chiusa definitivamente è un errore
+      if (source.readyState === EventSource.CLOSED) {
+        reject({ response: { data: { detail: 'Lost connection to sync job' } } });
+      }
+    };
+  }),
   
   generateToken: async (id) => {
     const { data } = await api.post(`/playlists/${id}/generate-token`);